@@ -19,6 +19,10 @@ setup(
     install_requires=[
         'nose',
     ],
+    extras_require={
+        # Vectorizes superperms.orgs.thresholds.suppressed_mask.
+        'numpy': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -0,0 +1,78 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+Support for ``has_perm`` on coroutine views. Python 3.5+ only; ``has_perm``
+imports this lazily, the first time it wraps a coroutine view.
+"""
+import asyncio
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+# Threads available for running permission lookups off the event loop.
+DEFAULT_ASYNC_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# ``(view, checks)`` of each coroutine view we've wrapped. Kept here rather
+# than on the function, where ``wraps`` would copy it onto other decorators.
+_wrapped_views = weakref.WeakKeyDictionary()
+
+
+def _get_executor():
+    """Return the bounded pool permission lookups run in."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(
+                settings, 'SUPERPERMS_ASYNC_WORKERS', DEFAULT_ASYNC_WORKERS
+            ))
+    return _executor
+
+
+def _run_checks(checks, request, view_kwargs):
+    """Run ``checks`` in order, returning the first denial, if any."""
+    try:
+        for check in checks:
+            denied = check(request, view_kwargs)
+            if denied is not None:
+                return denied
+        return None
+    finally:
+        # Pool threads outlive requests, so tidy up their connections.
+        close_old_connections()
+
+
+def wrap_async_view(fn, check):
+    """
+    Return a coroutine view that runs ``check`` before awaiting ``fn``.
+
+    ``check(request, view_kwargs)`` returns an error response or None. It
+    touches the ORM, so it runs in a bounded thread pool rather than on the
+    event loop. Directly stacked ``has_perm`` decorators are collapsed, so a
+    request makes a single trip to the pool however many perms it needs;
+    other decorators in between still run.
+    """
+    view, checks = _wrapped_views.get(fn, (fn, []))
+    checks = [check] + checks
+
+    @wraps(fn)
+    async def _wrapped(request, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        denied = await loop.run_in_executor(
+            _get_executor(), _run_checks, checks, request, kwargs
+        )
+        if denied is not None:
+            return denied
+
+        return await view(request, *args, **kwargs)
+
+    _wrapped_views[_wrapped] = (view, checks)
+    return _wrapped
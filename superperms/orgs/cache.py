@@ -0,0 +1,177 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+from superperms.orgs.utils import run_now_and_after_commit
+
+
+# Default lifetime of a cached role; entries are also invalidated by signals.
+# Kept short, as that's all that bounds a role re-cached from before a change
+# made inside someone else's transaction (see ``invalidate_roles``).
+DEFAULT_ROLE_CACHE_TIMEOUT = 5 * 60
+
+# Default lifetime of a cached effective config. Children are merged over
+# their parent's cached entry, so this bounds how long one built from a
+# stale parent can last.
+DEFAULT_CONFIG_CACHE_TIMEOUT = 5 * 60
+
+ROLE_KEY_TEMPLATE = 'superperms:role:{0}:{1}'
+
+EXPORTABLE_FIELDS_KEY_TEMPLATE = 'superperms:exportable_fields:{0}'
+
+CONFIG_KEY_TEMPLATE = 'superperms:config:{0}'
+
+
+def get_role_cache():
+    """
+    Return the Django cache holding (user, org) roles, or None.
+
+    Caching is off unless ``SUPERPERMS_ROLE_CACHE`` names a cache alias.
+    """
+    alias = getattr(settings, 'SUPERPERMS_ROLE_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _role_key(user_id, org_id):
+    return ROLE_KEY_TEMPLATE.format(user_id, org_id)
+
+
+def get_role(user_id, org_id):
+    """
+    Return the cached role entry for ``user_id`` in ``org_id``, or None.
+
+    An entry is a tuple of ``(org_user_id, role_level, status,
+    is_parent_org, is_parent_org_owner)``.
+    """
+    cache = get_role_cache()
+    if cache is None:
+        return None
+    return cache.get(_role_key(user_id, org_id))
+
+
+def set_role(org_user, is_parent_org, is_parent_org_owner):
+    """Cache the parts of ``org_user`` that permission checks rely on."""
+    cache = get_role_cache()
+    if cache is None:
+        return
+    timeout = getattr(
+        settings,
+        'SUPERPERMS_ROLE_CACHE_TIMEOUT',
+        DEFAULT_ROLE_CACHE_TIMEOUT
+    )
+    cache.set(
+        _role_key(org_user.user_id, org_user.organization_id),
+        (
+            org_user.pk,
+            org_user.role_level,
+            org_user.status,
+            is_parent_org,
+            is_parent_org_owner,
+        ),
+        timeout
+    )
+
+
+def invalidate_roles(pairs):
+    """
+    Drop cached roles for an iterable of ``(user_id, org_id)`` pairs, now
+    and again after the current transaction commits, so a check that read
+    the old role in between doesn't leave it cached.
+    """
+    cache = get_role_cache()
+    if cache is None:
+        return
+    keys = tuple(_role_key(user_id, org_id) for user_id, org_id in pairs)
+    if keys:
+        run_now_and_after_commit(keys, lambda: cache.delete_many(keys))
+
+
+def get_exportable_fields_cache():
+    """
+    Return the Django cache holding each org's exportable field names, or
+    None if ``SUPERPERMS_EXPORTABLE_FIELDS_CACHE`` isn't set.
+    """
+    alias = getattr(settings, 'SUPERPERMS_EXPORTABLE_FIELDS_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _exportable_fields_key(org_id):
+    return EXPORTABLE_FIELDS_KEY_TEMPLATE.format(org_id)
+
+
+def get_exportable_fields(org_id):
+    """Return ``{field_model: frozenset(names)}`` cached for ``org_id``."""
+    cache = get_exportable_fields_cache()
+    if cache is None:
+        return None
+    return cache.get(_exportable_fields_key(org_id))
+
+
+def set_exportable_fields(org_id, names):
+    cache = get_exportable_fields_cache()
+    if cache is None:
+        return
+    # Kept until the org's fields change.
+    cache.set(_exportable_fields_key(org_id), names, None)
+
+
+def invalidate_exportable_fields(org_id):
+    cache = get_exportable_fields_cache()
+    if cache is None:
+        return
+    cache.delete(_exportable_fields_key(org_id))
+
+
+def get_config_cache():
+    """
+    Return the Django cache holding each org's effective config, or None if
+    ``SUPERPERMS_CONFIG_CACHE`` isn't set.
+    """
+    alias = getattr(settings, 'SUPERPERMS_CONFIG_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _config_key(org_id):
+    return CONFIG_KEY_TEMPLATE.format(org_id)
+
+
+def get_effective_config(org_id):
+    """Return the effective config cached for ``org_id``, or None."""
+    cache = get_config_cache()
+    if cache is None:
+        return None
+    return cache.get(_config_key(org_id))
+
+
+def set_effective_config(org_id, config):
+    cache = get_config_cache()
+    if cache is None:
+        return
+    timeout = getattr(
+        settings,
+        'SUPERPERMS_CONFIG_CACHE_TIMEOUT',
+        DEFAULT_CONFIG_CACHE_TIMEOUT
+    )
+    cache.set(_config_key(org_id), config, timeout)
+
+
+def invalidate_effective_config(org_ids):
+    """
+    Drop the effective config of ``org_ids``, now and again after the
+    current transaction commits, like ``invalidate_roles``.
+    """
+    cache = get_config_cache()
+    if cache is None:
+        return
+    keys = tuple(_config_key(org_id) for org_id in org_ids)
+    if keys:
+        run_now_and_after_commit(keys, lambda: cache.delete_many(keys))
@@ -0,0 +1,277 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+Change single keys of ``Organization.config`` without writing back the
+whole document.
+
+On Postgres the change is made by the database, in one ``UPDATE`` using
+``jsonb`` operators, so concurrent edits to different keys don't clobber
+each other. Elsewhere the row is locked, read, changed and written back in
+a transaction.
+
+A path is a sequence of object keys, or a dotted string
+(``'features.export'``). Setting or merging creates any objects missing
+along the path, replacing whatever non-object is in the way.
+
+It also builds the ``WHERE`` clauses behind ``Organization.objects``'
+``with_config_key`` and ``with_config``: ``jsonb`` operators the GIN index
+serves on Postgres, JSON1 functions on SQLite.
+"""
+import copy
+import json
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+from django.utils import six
+from django.utils.encoding import force_text
+
+from superperms.orgs.utils import FrozenMapping
+
+
+SET = 'set'
+DELETE = 'delete'
+MERGE = 'merge'
+
+
+def split_path(path):
+    """Return ``path`` as a list of keys."""
+    if isinstance(path, six.string_types):
+        path = path.split('.') if path else []
+    return [force_text(key) for key in path]
+
+
+def _object(value):
+    return value if isinstance(value, dict) else {}
+
+
+def apply_change(config, op, path, value=None):
+    """Return a copy of ``config`` with the change made, in Python."""
+    config = copy.deepcopy(_object(config))
+    if op == DELETE:
+        target = config
+        for key in path[:-1]:
+            target = target.get(key)
+            if not isinstance(target, dict):
+                return config
+        target.pop(path[-1], None)
+        return config
+
+    target = config
+    keys = path if op == MERGE else path[:-1]
+    for key in keys:
+        target[key] = _object(target.get(key))
+        target = target[key]
+    if op == MERGE:
+        target.update(copy.deepcopy(value))
+    else:
+        target[path[-1]] = copy.deepcopy(value)
+    return config
+
+
+def freeze(value):
+    """Return ``value`` with dicts made read-only and lists tuples."""
+    if isinstance(value, Mapping):
+        return FrozenMapping(
+            (key, freeze(item)) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def merge(base, override):
+    """
+    Return ``override`` merged over ``base``, frozen: nested objects are
+    merged key by key, anything else in ``override`` wins.
+    """
+    merged = dict(base) if isinstance(base, Mapping) else {}
+    if not isinstance(override, Mapping):
+        override = {}
+    for key, value in override.items():
+        if isinstance(value, Mapping) and isinstance(merged.get(key), Mapping):
+            value = merge(merged[key], value)
+        merged[key] = value
+    return freeze(merged)
+
+
+def _object_at(column, path):
+    """SQL for the object at ``path`` in ``column``, or an empty one."""
+    sql = (
+        "CASE WHEN jsonb_typeof({0} #> %s::text[]) = 'object' "
+        "THEN {0} #> %s::text[] ELSE '{{}}'::jsonb END"
+    ).format(column)
+    return sql, [path, path]
+
+
+def change_sql(column, op, path, value=None):
+    """
+    Return ``(sql, params)`` for a ``jsonb`` expression making the change to
+    ``column`` (itself ``jsonb``).
+    """
+    if op == DELETE:
+        return '{0} #- %s::text[]'.format(column), [path]
+
+    sql, params = _object_at(column, [])
+    parents = path if op == MERGE else path[:-1]
+    for depth in range(1, len(parents) + 1):
+        parent_sql, parent_params = _object_at(column, parents[:depth])
+        sql = 'jsonb_set({0}, %s::text[], {1})'.format(sql, parent_sql)
+        params += [parents[:depth]] + parent_params
+
+    encoded = json.dumps(value, cls=DjangoJSONEncoder)
+    if op == MERGE:
+        target_sql, target_params = _object_at(column, path)
+        if not path:
+            return '{0} || %s::jsonb'.format(target_sql), (
+                target_params + [encoded]
+            )
+        target_sql = '{0} || %s::jsonb'.format(target_sql)
+        target_params += [encoded]
+    else:
+        target_sql, target_params = '%s::jsonb', [encoded]
+    return 'jsonb_set({0}, %s::text[], {1})'.format(sql, target_sql), (
+        params + [path] + target_params
+    )
+
+
+def change_config(org, op, path, value=None):
+    """
+    Make the change to ``org``'s saved config and to ``org.config``.
+
+    On Postgres ``org.config`` is changed in place, so keys other writers
+    changed since it was loaded stay stale; elsewhere it's replaced by the
+    whole saved config.
+    """
+    path = split_path(path)
+    if op != MERGE and not path:
+        raise ValueError('A config path needs at least one key.')
+    if op == MERGE and not isinstance(value, dict):
+        raise TypeError('Only a dict can be merged into config.')
+
+    model = type(org)
+    field = model._meta.get_field('config')
+    using = router.db_for_write(model, instance=org)
+    connection = connections[using]
+    rows = model._default_manager.db_manager(using).filter(pk=org.pk)
+
+    if connection.vendor == 'postgresql':
+        sql, params = change_sql(
+            '{0}::jsonb'.format(connection.ops.quote_name(field.column)),
+            op, path, value
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE {0} SET {1} = ({2})::{3} WHERE {4} = %s'.format(
+                    connection.ops.quote_name(model._meta.db_table),
+                    connection.ops.quote_name(field.column),
+                    sql,
+                    field.db_type(connection),
+                    connection.ops.quote_name(model._meta.pk.column),
+                ),
+                params + [org.pk]
+            )
+        org.config = apply_change(org.config, op, path, value)
+        return
+
+    with transaction.atomic(using=using):
+        saved = rows.select_for_update().values_list(
+            'config', flat=True
+        ).get()
+        config = apply_change(field.to_python(saved), op, path, value)
+        rows.update(config=config)
+    org.config = config
+
+
+def _sqlite_path(path):
+    """
+    Return a JSON1 path for ``path`` as a SQL literal. Inlined rather than a
+    parameter, so SQLite can match it to an index on the same expression.
+    """
+    if any('"' in key for key in path):
+        raise ValueError('Config keys with double quotes can\'t be queried.')
+    literal = '$' + ''.join('."{0}"'.format(key) for key in path)
+    return "'{0}'".format(literal.replace("'", "''").replace('%', '%%'))
+
+
+def _sqlite_match(value_sql, type_sql, value):
+    """SQL checking a JSON1 value and type against a plain ``value``."""
+    if value is None:
+        return "{0} = 'null'".format(type_sql), []
+    if isinstance(value, bool):
+        return "{0} = '{1}'".format(type_sql, 'true' if value else 'false'), []
+    if isinstance(value, six.integer_types + (float,)):
+        return "{0} IN ('integer', 'real') AND {1} = %s".format(
+            type_sql, value_sql
+        ), [value]
+    if isinstance(value, six.string_types):
+        return "{0} = 'text' AND {1} = %s".format(type_sql, value_sql), [value]
+    raise ValueError('Only plain values can be matched in a list on SQLite.')
+
+
+def _sqlite_contains(column, path, value):
+    json_path = _sqlite_path(path)
+    type_sql = 'json_type({0}, {1})'.format(column, json_path)
+    if isinstance(value, Mapping):
+        clauses, params = ["{0} = 'object'".format(type_sql)], []
+        for key, item in sorted(value.items()):
+            sql, item_params = _sqlite_contains(
+                column, path + [force_text(key)], item
+            )
+            clauses.append(sql)
+            params += item_params
+        return ' AND '.join(clauses), params
+    if isinstance(value, (list, tuple)):
+        # Like Postgres, each item need only be somewhere in the array.
+        clauses, params = ["{0} = 'array'".format(type_sql)], []
+        for item in value:
+            sql, item_params = _sqlite_match('value', 'type', item)
+            clauses.append(
+                'EXISTS (SELECT 1 FROM json_each({0}, {1}) WHERE {2})'.format(
+                    column, json_path, sql
+                )
+            )
+            params += item_params
+        return ' AND '.join(clauses), params
+    return _sqlite_match(
+        'json_extract({0}, {1})'.format(column, json_path), type_sql, value
+    )
+
+
+def has_key_sql(vendor, column, path):
+    """Return ``(sql, params)`` matching rows with a key at ``path``."""
+    path = split_path(path)
+    if not path:
+        raise ValueError('A config path needs at least one key.')
+    if vendor == 'postgresql':
+        if len(path) == 1:
+            return '{0} ? %s'.format(column), path
+        return '({0} #> %s::text[]) ? %s'.format(column), [
+            path[:-1], path[-1]
+        ]
+    if vendor == 'sqlite':
+        return 'json_type({0}, {1}) IS NOT NULL'.format(
+            column, _sqlite_path(path)
+        ), []
+    raise NotImplementedError('Config queries need Postgres or SQLite.')
+
+
+def contains_sql(vendor, column, values):
+    """
+    Return ``(sql, params)`` matching rows whose config contains the dict
+    ``values``: the same keys, nested objects and plain values, and arrays
+    holding at least the items given.
+    """
+    if not isinstance(values, dict):
+        raise TypeError('Config can only be matched against a dict.')
+    if vendor == 'postgresql':
+        return '{0} @> %s::jsonb'.format(column), [
+            json.dumps(values, cls=DjangoJSONEncoder)
+        ]
+    if vendor == 'sqlite':
+        return _sqlite_contains(column, [], values)
+    raise NotImplementedError('Config queries need Postgres or SQLite.')
@@ -3,80 +3,236 @@
 :license: see LICENSE for details.
 """
 import json
-from functools import wraps
+from bisect import bisect_right
+from timeit import default_timer
+from collections import OrderedDict, namedtuple
+from functools import partial, wraps
+
+try:
+    from asyncio import iscoroutinefunction
+except ImportError:
+    # No asyncio, so no coroutine views to worry about.
+    def iscoroutinefunction(fn):
+        return False
 
 from django.conf import settings
+from django.db.models import Q
 from django.http import HttpResponseForbidden
 
+from superperms.orgs import cache as role_cache
+from superperms.orgs.extract import get_org_id, request_cache
+from superperms.orgs.metrics import install_default_sinks
 from superperms.orgs.models import (
+    ROLE_LEVEL_CHOICES,
     ROLE_OWNER,
     ROLE_MEMBER,
     ROLE_VIEWER,
     Organization,
     OrganizationUser
 )
+from superperms.orgs.signals import perm_checked
 
 
 # Allow Super Users to ignore permissions.
 ALLOW_SUPER_USER_PERMS = getattr(settings, 'ALLOW_SUPER_USER_PERMS', True)
 
 
+PermRule = namedtuple(
+    'PermRule', ['min_role', 'top_level', 'parent_owner', 'superuser']
+)
+
+
+def perm_rule(min_role=None, top_level=False, parent_owner=False,
+              superuser=False):
+    """
+    Describe who gets a perm.
+
+    Members with at least ``min_role`` (any role, if None) have it, but
+    only in top-level orgs if ``top_level`` is set. With ``parent_owner``,
+    owners of the parent org have it regardless. With ``superuser``, only
+    Django superusers have it at all.
+    """
+    return PermRule(min_role, top_level, parent_owner, superuser)
+
+
+PERM_RULES = OrderedDict([
+    ('requires_parent_org_owner', perm_rule(ROLE_OWNER, top_level=True)),
+    ('requires_owner', perm_rule(ROLE_OWNER, parent_owner=True)),
+    ('requires_member', perm_rule(ROLE_MEMBER)),
+    ('requires_viewer', perm_rule(ROLE_VIEWER)),
+    ('requires_superuser', perm_rule(superuser=True)),
+    ('can_create_sub_org', perm_rule(ROLE_OWNER, top_level=True)),
+    ('can_remove_org', perm_rule(ROLE_OWNER, top_level=True)),
+    ('can_invite_member', perm_rule(ROLE_OWNER)),
+    ('can_remove_member', perm_rule(ROLE_OWNER)),
+    ('can_modify_member_roles', perm_rule(ROLE_OWNER)),
+    ('can_modify_org_settings', perm_rule(
+        ROLE_OWNER, top_level=True, parent_owner=True
+    )),
+    ('can_modify_query_thresh', perm_rule(ROLE_OWNER, top_level=True)),
+    ('can_view_sub_org_settings', perm_rule(ROLE_OWNER)),
+    ('can_view_sub_org_fields', perm_rule(ROLE_OWNER, top_level=True)),
+    ('can_modify_data', perm_rule(ROLE_MEMBER)),
+    ('can_view_data', perm_rule(ROLE_VIEWER)),
+])
+
+
+# Flags which, along with a role, make up a membership's state.
+STATE_PARENT_ORG = 1
+STATE_PARENT_ORG_OWNER = 2
+STATE_SUPERUSER = 4
+
+# ``PERM_RULES`` compiled into bitsets by ``_compile_rules``.
+_compiled = {}
+
+
+def _rule_grants(rule, role_level, state_flags):
+    """Return True if ``rule`` grants its perm in the given state."""
+    if rule.superuser and not state_flags & STATE_SUPERUSER:
+        return False
+    if rule.parent_owner and state_flags & STATE_PARENT_ORG_OWNER:
+        return True
+    if rule.top_level and not state_flags & STATE_PARENT_ORG:
+        return False
+    return rule.min_role is None or role_level >= rule.min_role
+
+
+def _compile_rules():
+    """
+    Give each rule a bit, and precompute the bitset of perms granted for
+    every (role, flags) state, so checking a perm is a single mask test.
+    """
+    # Every role threshold is a level, so bucketing a role_level down to
+    # the nearest level never changes which rules it satisfies.
+    levels = [float('-inf')] + sorted(set(
+        [role_level for role_level, _ in ROLE_LEVEL_CHOICES] +
+        [r.min_role for r in PERM_RULES.values() if r.min_role is not None]
+    ))
+    bits = dict((name, 1 << i) for i, name in enumerate(PERM_RULES))
+    all_flags = STATE_PARENT_ORG | STATE_PARENT_ORG_OWNER | STATE_SUPERUSER
+
+    masks = []
+    for level in levels:
+        row = []
+        for state_flags in range(all_flags + 1):
+            row.append(sum(
+                bits[name] for name, rule in PERM_RULES.items()
+                if _rule_grants(rule, level, state_flags)
+            ))
+        masks.append(row)
+
+    def bits_where(attr):
+        return sum(
+            bits[name] for name, rule in PERM_RULES.items()
+            if getattr(rule, attr)
+        )
+
+    _compiled.update({
+        'levels': levels,
+        'bits': bits,
+        'all_bits': sum(bits.values()),
+        'masks': masks,
+        'top_level_bits': bits_where('top_level'),
+        'parent_owner_bits': bits_where('parent_owner'),
+        'superuser_bits': bits_where('superuser'),
+    })
+
+
+_compile_rules()
+
+
+def _is_parent_org(org_user):
+    """Return True if ``org_user``'s organization has no parent org."""
+    # Set when ``org_user`` was rebuilt from the role cache.
+    cached = getattr(org_user, '_is_parent_org', None)
+    if cached is not None:
+        return cached
+    return org_user.organization.parent_org_id is None
+
+
+def _is_parent_org_owner(org_user):
+    """Return True if ``org_user.user`` is an owner of the parent org."""
+    return org_user.is_parent_org_owner
+
+
+def _perm_mask(org_user, wanted_bits):
+    """
+    Return the bitset of rule perms ``org_user`` has.
+
+    Only the parts of the state that matter to ``wanted_bits`` are looked
+    up, so we never load the org or user for a perm that doesn't need them.
+    """
+    state_flags = 0
+    if wanted_bits & _compiled['top_level_bits'] and _is_parent_org(org_user):
+        state_flags |= STATE_PARENT_ORG
+    if (
+        wanted_bits & _compiled['parent_owner_bits'] and
+        _is_parent_org_owner(org_user)
+    ):
+        state_flags |= STATE_PARENT_ORG_OWNER
+    if (
+        wanted_bits & _compiled['superuser_bits'] and
+        org_user.user.is_superuser
+    ):
+        state_flags |= STATE_SUPERUSER
+
+    level = bisect_right(_compiled['levels'], org_user.role_level) - 1
+    return _compiled['masks'][level][state_flags]
+
+
+def _rule_allows(perm_name, org_user):
+    """Return True if ``org_user`` has the rule-based perm ``perm_name``."""
+    bit = _compiled['bits'][perm_name]
+    return bool(_perm_mask(org_user, bit) & bit)
+
+
 def requires_parent_org_owner(org_user):
     """Only allow owners of parent orgs to view child org perms."""
-    return (
-        org_user.role_level >= ROLE_OWNER and
-        not org_user.organization.parent_org
-    )
+    return _rule_allows('requires_parent_org_owner', org_user)
 
 
 def requires_owner(org_user):
     """Owners, and only owners have owner perms."""
-    is_parent_org_owner = False
-    parent = org_user.organization.parent_org
-    if parent:
-        is_parent_org_owner = OrganizationUser.objects.filter(
-            organization=parent, user=org_user.user, role_level__gte=ROLE_OWNER
-        ).exists()
-    return is_parent_org_owner or org_user.role_level >= ROLE_OWNER
+    return _rule_allows('requires_owner', org_user)
 
 
 def requires_member(org_user):
     """Members and owners are considered to have member perms."""
-    return org_user.role_level >= ROLE_MEMBER
+    return _rule_allows('requires_member', org_user)
 
 
 def requires_viewer(org_user):
     """Everybody is considered to have viewer perms."""
-    return org_user.role_level >= ROLE_VIEWER
+    return _rule_allows('requires_viewer', org_user)
 
 
 def requires_superuser(org_user):
     """Only Django superusers have superuser perms."""
-    return org_user.user.is_superuser
+    return _rule_allows('requires_superuser', org_user)
 
 
 def can_create_sub_org(org_user):
-    return requires_parent_org_owner(org_user)
+    return _rule_allows('can_create_sub_org', org_user)
 
 
 def can_remove_org(org_user):
-    return requires_parent_org_owner(org_user)
+    return _rule_allows('can_remove_org', org_user)
 
 
 def can_invite_member(org_user):
-    return org_user.role_level >= ROLE_OWNER
+    return _rule_allows('can_invite_member', org_user)
 
 
 def can_remove_member(org_user):
-    return org_user.role_level >= ROLE_OWNER
+    return _rule_allows('can_remove_member', org_user)
 
 
 def can_modify_member_roles(org_user):
-    return org_user.role_level >= ROLE_OWNER
+    return _rule_allows('can_modify_member_roles', org_user)
 
 
 def can_modify_query_thresh(org_user):
-    return requires_parent_org_owner(org_user)
+    return _rule_allows('can_modify_query_thresh', org_user)
 
 
 def can_modify_org_settings(org_user):
@@ -84,34 +240,23 @@ def can_modify_org_settings(org_user):
     Owners of an org can modify its settings (fields, name, query threshold)
     and a suborg's settings can also be modified by its parent's owner.
     """
-    # check for ownership of this org (and that it has no parent)
-    if requires_parent_org_owner(org_user):
-        return True
-    # otherwise, there may be a parent org, so see if this user
-    # is an owner of the parent.
-    org = org_user.organization
-    if (
-        org.parent_org is not None and
-        org.parent_org.is_owner(org_user.user)
-    ):
-        return True
-    return False
+    return _rule_allows('can_modify_org_settings', org_user)
 
 
 def can_view_sub_org_settings(org_user):
-    return org_user.role_level >= ROLE_OWNER
+    return _rule_allows('can_view_sub_org_settings', org_user)
 
 
 def can_view_sub_org_fields(org_user):
-    return requires_parent_org_owner(org_user)
+    return _rule_allows('can_view_sub_org_fields', org_user)
 
 
 def can_modify_data(org_user):
-    return org_user.role_level >= ROLE_MEMBER
+    return _rule_allows('can_modify_data', org_user)
 
 
 def can_view_data(org_user):
-    return org_user.role_level >= ROLE_VIEWER
+    return _rule_allows('can_view_data', org_user)
 
 
 PERMS = {
@@ -134,6 +279,88 @@ PERMS = {
 }
 
 
+def register_perm(perm_name, min_role=None, top_level=False,
+                  parent_owner=False, superuser=False):
+    """
+    Add a custom perm to the rule table, for use with ``has_perm``,
+    ``check_perms`` and ``Organization.objects.with_perm``.
+
+    See ``perm_rule`` for what the arguments mean.
+    """
+    PERM_RULES[perm_name] = perm_rule(
+        min_role, top_level, parent_owner, superuser
+    )
+    _compile_rules()
+    PERMS[perm_name] = partial(_rule_allows, perm_name)
+
+
+def check_perms(user, org_ids, perm_names):
+    """
+    Return ``{org_id: {perm_name: bool}}`` for ``user`` across many orgs.
+
+    Uses the same rules as ``has_perm`` in a single query, however many
+    orgs are asked about. Orgs ``user`` doesn't belong to get all False.
+    """
+    org_ids = [int(org_id) for org_id in org_ids]
+    allow_all = user.is_superuser and ALLOW_SUPER_USER_PERMS
+    matrix = dict(
+        (org_id, dict((name, allow_all) for name in perm_names))
+        for org_id in org_ids
+    )
+    if allow_all or not org_ids:
+        return matrix
+
+    bits = _compiled['bits']
+    org_users = OrganizationUser.objects.with_perm_context().filter(
+        user=user, organization_id__in=org_ids
+    )
+    for org_user in org_users:
+        _prime_org_user(org_user, user)
+        mask = _perm_mask(org_user, _compiled['all_bits'])
+        matrix[org_user.organization_id] = dict(
+            (
+                name,
+                bool(mask & bits[name]) if name in bits
+                else PERMS.get(name, lambda x: False)(org_user)
+            )
+            for name in perm_names
+        )
+
+    return matrix
+
+
+def perm_filter(user, perm_name):
+    """
+    Return a ``Q`` over ``Organization`` for orgs where ``user`` has
+    ``perm_name``, or None if it isn't in ``PERM_RULES``.
+
+    As with ``has_perm``, ``user`` must be a member of the org itself; being
+    an owner of the parent org is on top of that.
+    """
+    rule = PERM_RULES.get(perm_name)
+    if rule is None:
+        return None
+
+    if user.is_superuser and ALLOW_SUPER_USER_PERMS:
+        return Q()
+    if rule.superuser and not user.is_superuser:
+        return Q(pk__in=[])
+
+    is_member = Q(organizationuser__user=user)
+    has_role = Q()
+    if rule.min_role is not None:
+        has_role &= Q(organizationuser__role_level__gte=rule.min_role)
+    if rule.top_level:
+        has_role &= Q(parent_org__isnull=True)
+    if not has_role:
+        # Any member will do.
+        return is_member
+    if rule.parent_owner:
+        has_role |= Q(organizationuser__is_parent_org_owner=True)
+
+    return is_member & has_role
+
+
 ERROR_MESSAGES = {
     'org_dne': 'Organization does not exist',
     'user_dne': 'No relationship to organization',
@@ -141,6 +368,10 @@ ERROR_MESSAGES = {
 }
 RESPONSE_TEMPLATE = {'status': 'error', 'message': ''}
 
+# The outcome ``perm_checked`` reports for a passed check; failed checks
+# report their ``ERROR_MESSAGES`` key.
+ALLOWED = 'allowed'
+
 
 def _make_resp(message_name):
     """Return Http Error response with appropriate message."""
@@ -154,44 +385,166 @@ def _make_resp(message_name):
     )
 
 
-def _get_org_id(request):
-    """Extract the ``organization_id`` regardless of HTTP method type."""
-    org_id = request.GET.get('organization_id')
+def _prime_org_user(org_user, user):
+    """Finish off a membership loaded by ``with_perm_context``."""
+    # Hang on to the user we already have so perms checks don't requery.
+    org_user.user = user
+
+
+def _org_user_from_cache(user, org_id):
+    """Rebuild ``user``'s membership in ``org_id`` from the role cache."""
+    try:
+        org_id = int(org_id)
+    except (TypeError, ValueError):
+        return None
+
+    entry = role_cache.get_role(user.pk, org_id)
+    if entry is None:
+        return None
+
+    pk, role_level, status, is_parent_org, is_parent_org_owner = entry
+    org_user = OrganizationUser(
+        pk=pk,
+        user=user,
+        organization_id=org_id,
+        role_level=role_level,
+        status=status,
+        is_parent_org_owner=is_parent_org_owner
+    )
+    # ``org_user.organization`` is only loaded if the view asks for it.
+    org_user._is_parent_org = is_parent_org
+    return org_user
+
+
+def _fetch_org_user(user, org_id, stats):
+    """
+    Return ``(org_user, error_name)`` for ``user``'s role in ``org_id``,
+    noting in ``stats`` where it came from and the queries it took.
+    """
+    org_user = _org_user_from_cache(user, org_id)
+    if org_user is not None:
+        stats['cache_hit'] = True
+        return org_user, None
+
+    stats['cache_hit'] = False
+    stats['queries'] += 1
+    try:
+        org_user = OrganizationUser.objects.with_perm_context().get(
+            user=user, organization_id=org_id
+        )
+    except OrganizationUser.DoesNotExist:
+        # Only now do we need to know why there's no membership.
+        stats['queries'] += 1
+        if Organization.objects.filter(pk=org_id).exists():
+            return None, 'user_dne'
+        return None, 'org_dne'
+
+    _prime_org_user(org_user, user)
+    role_cache.set_role(
+        org_user, _is_parent_org(org_user), org_user.is_parent_org_owner
+    )
+
+    return org_user, None
+
+
+def _new_stats():
+    return {'cache_hit': None, 'queries': 0}
+
+
+def _resolve_org_user(request, org_id, stats):
+    """
+    Return ``(org_user, error_name)`` for ``request.user`` in ``org_id``.
+
+    Results are memoized on the request, so stacked ``has_perm`` decorators
+    and the view itself share one set of queries.
+    """
+    cache = request_cache(request)
+    key = ('org_user', org_id)
+    if key in cache:
+        stats['cache_hit'] = True
+    else:
+        cache[key] = _fetch_org_user(request.user, org_id, stats)
+    return cache[key]
+
+
+def get_org_user(request, org_id=None):
+    """
+    Return the ``OrganizationUser`` for ``request.user``, or None.
+
+    Inside a ``has_perm`` decorated view this reuses the membership the
+    decorator already loaded, along with ``org_user.organization`` unless
+    the membership came from the role cache.
+    """
     if org_id is None:
-        try:
-            org_id = json.loads(request.body).get('organization_id')
-        except ValueError:
-            # no JSON body to load, org_id being None will raise an error
-            pass
+        org_id = get_org_id(request)
+    return _resolve_org_user(request, org_id, _new_stats())[0]
 
-    return org_id
 
+def _perm_outcome(request, view_kwargs, perm_name, org_id_sources, stats):
+    """Return ``ALLOWED``, or the reason ``request.user`` lacks the perm."""
+    # Skip perms checks if settings allow super_users to bypass.
+    if request.user.is_superuser and ALLOW_SUPER_USER_PERMS:
+        return ALLOWED
 
-def has_perm(perm_name):
-    """Proceed if user from request has ``perm_name``."""
-    def decorator(fn):
-        @wraps(fn)
-        def _wrapped(request, *args, **kwargs):
-            # Skip perms checks if settings allow super_users to bypass.
-            if request.user.is_superuser and ALLOW_SUPER_USER_PERMS:
-                return fn(request, *args, **kwargs)
+    org_id = get_org_id(request, view_kwargs, org_id_sources)
+    org_user, error = _resolve_org_user(request, org_id, stats)
+    if error:
+        return error
 
-            org_id = _get_org_id(request)
+    if not PERMS.get(perm_name, lambda x: False)(org_user):
+        return 'perm_denied'
 
-            try:
-                org = Organization.objects.get(pk=org_id)
-            except Organization.DoesNotExist:
-                return _make_resp('org_dne')
+    return ALLOWED
 
-            try:
-                org_user = OrganizationUser.objects.get(
-                    user=request.user, organization=org
-                )
-            except OrganizationUser.DoesNotExist:
-                return _make_resp('user_dne')
 
-            if not PERMS.get(perm_name, lambda x: False)(org_user):
-                return _make_resp('perm_denied')
+def _check_perm(request, view_kwargs, perm_name, org_id_sources):
+    """
+    Return an error response if ``request.user`` lacks ``perm_name``, and
+    tell any ``perm_checked`` receivers how it went.
+    """
+    stats = _new_stats()
+    start = default_timer()
+    outcome = _perm_outcome(
+        request, view_kwargs, perm_name, org_id_sources, stats
+    )
+    if perm_checked.has_listeners():
+        perm_checked.send(
+            sender=None,
+            request=request,
+            perm_name=perm_name,
+            outcome=outcome,
+            cache_hit=stats['cache_hit'],
+            queries=stats['queries'],
+            elapsed=default_timer() - start
+        )
+
+    if outcome != ALLOWED:
+        return _make_resp(outcome)
+    return None
+
+
+def has_perm(perm_name, org_id_sources=None):
+    """
+    Proceed if user from request has ``perm_name``.
+
+    ``org_id_sources`` overrides where the ``organization_id`` is looked
+    for; see ``superperms.orgs.extract.get_org_id``. Coroutine views are
+    supported too, see ``superperms.orgs.async_perms``.
+    """
+    def check(request, view_kwargs):
+        return _check_perm(request, view_kwargs, perm_name, org_id_sources)
+
+    def decorator(fn):
+        if iscoroutinefunction(fn):
+            # Only importable on Python 3.
+            from superperms.orgs.async_perms import wrap_async_view
+            return wrap_async_view(fn, check)
+
+        @wraps(fn)
+        def _wrapped(request, *args, **kwargs):
+            denied = check(request, kwargs)
+            if denied is not None:
+                return denied
 
             # Logic to see if person has permission required.
             return fn(request, *args, **kwargs)
@@ -199,3 +552,6 @@ def has_perm(perm_name):
         return _wrapped
 
     return decorator
+
+
+install_default_sinks()
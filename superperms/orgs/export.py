@@ -0,0 +1,151 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+Export only what an org's ``ExportableField`` rows allow, streamed so the
+size of an export doesn't matter.
+
+Rows are fetched with ``values_list`` over just the allowed fields, a
+chunk at a time in primary key order (``pk > last seen pk``), so memory
+use stays flat however many rows there are, on any database backend.
+"""
+import csv
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+from django.utils.encoding import force_text
+
+
+# Rows fetched per query.
+DEFAULT_EXPORT_CHUNK_SIZE = 2000
+
+
+def export_fields(org, model):
+    """
+    Return the names of ``model``'s fields that ``org`` may export, fields
+    in declaration order then related lookups (``'owner__name'``) sorted.
+
+    Names that aren't fields of ``model``, or lookups through its foreign
+    keys and one-to-one fields, are left out. Reverse and many-to-many
+    relations would give several rows per object, which paging by primary
+    key can't handle.
+    """
+    allowed = org.get_exportable_field_names().get(
+        model.__name__, frozenset()
+    )
+    fields = [
+        field.name for field in model._meta.concrete_fields
+        if field.name in allowed
+    ]
+    for name in sorted(allowed):
+        if '__' in name and _is_forward_lookup(model, name.split('__')):
+            fields.append(name)
+    return fields
+
+
+def _is_forward_lookup(model, parts):
+    """Whether ``parts`` lead through single-valued relations to a field."""
+    try:
+        for part in parts[:-1]:
+            field = model._meta.get_field(part)
+            if not (field.concrete and (field.many_to_one or
+                                        field.one_to_one)):
+                return False
+            model = field.related_model
+        field = model._meta.get_field(parts[-1])
+        return field.concrete and not field.many_to_many
+    except FieldDoesNotExist:
+        return False
+
+
+def _resolve_fields(org, model, fields):
+    """Return ``fields``, or all of them, if ``org`` may export them."""
+    allowed = export_fields(org, model)
+    if fields is None:
+        return allowed
+    disallowed = set(fields) - set(allowed)
+    if disallowed:
+        raise ValueError('Not exportable: {0}'.format(
+            ', '.join(sorted(disallowed))
+        ))
+    return list(fields)
+
+
+def _iter_rows(queryset, fields, chunk_size):
+    if not fields:
+        return
+    chunk_size = chunk_size or DEFAULT_EXPORT_CHUNK_SIZE
+
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        rows = list(chunk.values_list('pk', *fields)[:chunk_size])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1][0]
+
+
+def iter_rows(org, queryset, fields=None, chunk_size=None):
+    """
+    Yield a tuple of the exportable ``fields`` for each row of the unsliced
+    ``queryset``, in primary key order. ``fields`` defaults to all of
+    ``export_fields``; asking for others raises ``ValueError``.
+    """
+    fields = _resolve_fields(org, queryset.model, fields)
+    return _iter_rows(queryset, fields, chunk_size)
+
+
+class _Echo(object):
+    """A file-like object that hands back what's written to it."""
+
+    def write(self, value):
+        return value
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    value = force_text(value)
+    # The Python 2 csv module only deals in bytes.
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def iter_csv(org, queryset, fields=None, chunk_size=None):
+    """Yield an export as CSV, a line at a time, header first."""
+    fields = _resolve_fields(org, queryset.model, fields)
+    writer = csv.writer(_Echo())
+    yield writer.writerow([_csv_cell(field) for field in fields])
+    for row in _iter_rows(queryset, fields, chunk_size):
+        yield writer.writerow([_csv_cell(value) for value in row])
+
+
+def iter_jsonl(org, queryset, fields=None, chunk_size=None):
+    """Yield an export as JSON lines, one object per row."""
+    fields = _resolve_fields(org, queryset.model, fields)
+    encoder = DjangoJSONEncoder(sort_keys=True)
+    for row in _iter_rows(queryset, fields, chunk_size):
+        yield encoder.encode(dict(zip(fields, row))) + '\n'
+
+
+def write_csv(org, queryset, out, fields=None, chunk_size=None):
+    """Write a CSV export to the file-like ``out``; returns rows written."""
+    return _write(iter_csv(org, queryset, fields, chunk_size), out) - 1
+
+
+def write_jsonl(org, queryset, out, fields=None, chunk_size=None):
+    """Write a JSON lines export to ``out``; returns rows written."""
+    return _write(iter_jsonl(org, queryset, fields, chunk_size), out)
+
+
+def _write(lines, out):
+    count = 0
+    for line in lines:
+        out.write(line)
+        count += 1
+    return count
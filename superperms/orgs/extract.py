@@ -0,0 +1,229 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+import json
+import re
+
+from django.conf import settings
+from django.utils import six
+
+
+# Name of the request attribute we memoize per-request lookups on.
+REQUEST_CACHE_ATTR = '_superperms_cache'
+
+# Where ``X-Organization-Id`` shows up in ``request.META``.
+ORG_ID_HEADER = 'HTTP_X_ORGANIZATION_ID'
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Strings are matched whole so brackets inside them aren't counted.
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_CONTAINER_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+
+_decoder = json.JSONDecoder()
+
+
+class _Missing(object):
+    """Stands in for a key that isn't in the document."""
+    pass
+
+
+MISSING = _Missing()
+
+
+def request_cache(request):
+    """Return the dict we memoize lookups in for the life of ``request``."""
+    cache = getattr(request, REQUEST_CACHE_ATTR, None)
+    if cache is None:
+        cache = {}
+        setattr(request, REQUEST_CACHE_ATTR, cache)
+    return cache
+
+
+def _to_text(body):
+    if isinstance(body, six.binary_type) and six.PY3:
+        return body.decode('utf-8', 'ignore')
+    return body
+
+
+def get_json_body(request):
+    """
+    Return ``request.body`` parsed as JSON, or None if it isn't JSON.
+
+    The parse is memoized on the request, so the view can call this and
+    reuse anything superperms already parsed.
+    """
+    cache = request_cache(request)
+    if 'json_body' not in cache:
+        try:
+            cache['json_body'] = json.loads(_to_text(request.body))
+        except (TypeError, ValueError):
+            cache['json_body'] = None
+    return cache['json_body']
+
+
+def _skip_whitespace(text, pos):
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _skip_value(text, pos):
+    """Return the position just past the JSON value starting at ``pos``."""
+    char = text[pos]
+    if char == '"':
+        match = _STRING.match(text, pos)
+        if match is None:
+            raise ValueError('Unterminated string')
+        return match.end()
+
+    if char in '{[':
+        depth = 0
+        for match in _CONTAINER_TOKEN.finditer(text, pos):
+            token = match.group()
+            if token in '{[':
+                depth += 1
+            elif token in '}]':
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        raise ValueError('Unterminated container')
+
+    return _decoder.raw_decode(text, pos)[1]
+
+
+def scan_top_level_key(text, key):
+    """
+    Return the value of ``key`` in the JSON object ``text``, or ``MISSING``.
+
+    Skips over the values of other keys without decoding them. If ``key``
+    is repeated the last one wins, as with ``json.loads``, so the whole
+    object is always scanned. Raises ``ValueError`` for malformed or
+    truncated JSON.
+    """
+    value = MISSING
+    try:
+        pos = _skip_whitespace(text, 0)
+        if text[pos] != '{':
+            return MISSING
+        pos += 1
+
+        pos = _skip_whitespace(text, pos)
+        if text[pos] == '}':
+            return MISSING
+
+        while True:
+            name, pos = _decoder.raw_decode(text, pos)
+            pos = _skip_whitespace(text, pos)
+            if text[pos] != ':':
+                raise ValueError('Expected ":"')
+            pos = _skip_whitespace(text, pos + 1)
+
+            if name == key:
+                value, pos = _decoder.raw_decode(text, pos)
+            else:
+                pos = _skip_value(text, pos)
+            pos = _skip_whitespace(text, pos)
+
+            if text[pos] == '}':
+                return value
+            if text[pos] != ',':
+                raise ValueError('Expected ","')
+            pos = _skip_whitespace(text, pos + 1)
+    except IndexError:
+        raise ValueError('Truncated JSON')
+
+
+def find_body_org_id(request):
+    """
+    Return the top-level ``organization_id`` from a JSON request body.
+
+    Reuses a full parse if one was already done, otherwise scans the body,
+    unless it's over ``SUPERPERMS_ORG_ID_SCAN_LIMIT`` bytes (no limit if
+    None): a repeated ``organization_id`` past the limit would be the one
+    a full parse keeps, so there's no safe answer for a longer body.
+    """
+    cache = request_cache(request)
+    if cache.get('json_body') is not None:
+        parsed = cache['json_body']
+        if isinstance(parsed, dict):
+            return parsed.get('organization_id')
+        return None
+
+    body = request.body
+    if not body:
+        return None
+
+    limit = getattr(settings, 'SUPERPERMS_ORG_ID_SCAN_LIMIT', None)
+    if limit is not None and len(body) > limit:
+        return None
+
+    try:
+        org_id = scan_top_level_key(_to_text(body), 'organization_id')
+    except ValueError:
+        # Not JSON.
+        return None
+
+    return None if org_id is MISSING else org_id
+
+
+def _org_id_from_kwargs(request, view_kwargs):
+    return view_kwargs.get('organization_id')
+
+
+def _org_id_from_header(request, view_kwargs):
+    return request.META.get(ORG_ID_HEADER)
+
+
+def _org_id_from_query(request, view_kwargs):
+    return request.GET.get('organization_id')
+
+
+def _org_id_from_body(request, view_kwargs):
+    return find_body_org_id(request)
+
+
+ORG_ID_SOURCES = {
+    'kwargs': _org_id_from_kwargs,
+    'header': _org_id_from_header,
+    'query': _org_id_from_query,
+    'body': _org_id_from_body,
+}
+
+# Where the view itself reads the org from. A source the view doesn't act
+# on (say, a header) would let a client pass the check for one org while
+# the view works on another, so those are opt-in.
+DEFAULT_ORG_ID_SOURCES = ('query', 'body')
+
+
+def get_org_id(request, view_kwargs=None, sources=None):
+    """
+    Return the ``organization_id`` for ``request``, or None.
+
+    ``sources`` is an ordered sequence of ``ORG_ID_SOURCES`` names, or of
+    callables taking ``(request, view_kwargs)``; the first to find an id
+    wins. Defaults to ``SUPERPERMS_ORG_ID_SOURCES``, or
+    ``DEFAULT_ORG_ID_SOURCES`` if that isn't set.
+    """
+    if sources is None:
+        sources = getattr(
+            settings, 'SUPERPERMS_ORG_ID_SOURCES', DEFAULT_ORG_ID_SOURCES
+        )
+    sources = tuple(sources)
+
+    cache = request_cache(request)
+    if view_kwargs is not None:
+        cache['view_kwargs'] = view_kwargs
+    key = ('org_id', sources)
+    if key in cache:
+        return cache[key]
+
+    view_kwargs = cache.get('view_kwargs', {})
+    org_id = None
+    for source in sources:
+        if not callable(source):
+            source = ORG_ID_SOURCES[source]
+        org_id = source(request, view_kwargs)
+        if org_id is not None:
+            break
+
+    cache[key] = org_id
+    return org_id
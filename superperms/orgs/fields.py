@@ -0,0 +1,18 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+from djorm_pgjson.fields import JSONField
+
+
+class JSONBField(JSONField):
+    """
+    A ``JSONField`` stored as ``jsonb`` on Postgres (9.4 or later), so it
+    can be indexed and searched by the database. Other databases keep JSON
+    text.
+    """
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'jsonb'
+        return super(JSONBField, self).db_type(connection)
@@ -0,0 +1,133 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+An in-process copy of the organization tree, so questions about parents,
+children and inherited settings don't need a query.
+
+The tree is loaded in one query and kept until the shared version number
+in the ``SUPERPERMS_HIERARCHY_CACHE`` cache changes. Saving or deleting an
+organization bumps the version, before and after it commits, so every
+process reloads on its next question. Queryset ``update()`` calls skip the
+bump; call ``invalidate()`` after them.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from superperms.orgs.utils import run_now_and_after_commit
+
+
+HIERARCHY_VERSION_KEY = 'superperms:hierarchy:version'
+
+_tree = None
+_tree_lock = threading.Lock()
+
+
+def get_hierarchy_cache():
+    """
+    Return the Django cache holding the tree's version, or None.
+
+    The tree is off unless ``SUPERPERMS_HIERARCHY_CACHE`` names a cache
+    alias.
+    """
+    alias = getattr(settings, 'SUPERPERMS_HIERARCHY_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _fresh_version():
+    # Never repeats an evicted version, which would pass off a stale tree.
+    return int(time.time() * 1e6)
+
+
+def _current_version(cache):
+    version = cache.get(HIERARCHY_VERSION_KEY)
+    if version is None:
+        cache.add(HIERARCHY_VERSION_KEY, _fresh_version(), None)
+        version = cache.get(HIERARCHY_VERSION_KEY)
+    return version
+
+
+def invalidate():
+    """
+    Make every process reload the tree before using it again. Inside a
+    transaction, the version is bumped again once it commits, as others
+    reloading in between still see the old rows.
+    """
+    cache = get_hierarchy_cache()
+    if cache is None:
+        return
+    run_now_and_after_commit(HIERARCHY_VERSION_KEY, lambda: _bump(cache))
+
+
+def _bump(cache):
+    global _tree
+    _tree = None
+    try:
+        cache.incr(HIERARCHY_VERSION_KEY)
+    except ValueError:
+        cache.set(HIERARCHY_VERSION_KEY, _fresh_version(), None)
+
+
+class OrgTree(object):
+    """Parents, children and query thresholds of every organization."""
+
+    def __init__(self, rows, version):
+        """``rows`` are ``(org_id, parent_org_id, query_threshold)``."""
+        self.version = version
+        self._parents = {}
+        self._children = {}
+        self._thresholds = {}
+        for org_id, parent_id, query_threshold in rows:
+            self._parents[org_id] = parent_id
+            self._thresholds[org_id] = query_threshold
+            if parent_id is not None:
+                self._children.setdefault(parent_id, []).append(org_id)
+
+    def __contains__(self, org_id):
+        return org_id in self._parents
+
+    def parent_id(self, org_id):
+        return self._parents[org_id]
+
+    def child_ids(self, org_id):
+        return list(self._children.get(org_id, []))
+
+    def top_id(self, org_id):
+        """Return the id of the top-level org above (or at) ``org_id``."""
+        while self._parents[org_id] is not None:
+            org_id = self._parents[org_id]
+        return org_id
+
+    def query_threshold(self, org_id):
+        """Return ``org_id``'s own saved ``query_threshold``."""
+        return self._thresholds[org_id]
+
+
+def get_tree():
+    """Return an up to date ``OrgTree``, or None if it's turned off."""
+    global _tree
+    cache = get_hierarchy_cache()
+    if cache is None:
+        return None
+
+    version = _current_version(cache)
+    tree = _tree
+    if tree is not None and tree.version == version:
+        return tree
+
+    with _tree_lock:
+        tree = _tree
+        if tree is None or tree.version != version:
+            from superperms.orgs.models import Organization
+            tree = _tree = OrgTree(
+                Organization.objects.order_by().values_list(
+                    'pk', 'parent_org_id', 'query_threshold'
+                ),
+                version
+            )
+    return tree
@@ -0,0 +1,78 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from superperms.orgs import metrics
+
+
+HEADER = (
+    'perm', 'outcome', 'checks', 'hit %', 'q/check', 'mean ms', 'p50 ms',
+    'p95 ms', 'p99 ms'
+)
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '{0:g}'.format(seconds * 1000)
+
+
+def _row(perm_name, outcome, stats):
+    checks = stats['checks']
+    lookups = stats['cache_hits'] + stats['cache_misses']
+    return (
+        perm_name,
+        outcome,
+        str(checks),
+        '{0:.0f}'.format(100.0 * stats['cache_hits'] / lookups)
+        if lookups else '-',
+        '{0:.2f}'.format(float(stats['queries']) / checks) if checks else '-',
+        '{0:.3f}'.format(stats['elapsed_us'] / 1000.0 / checks)
+        if checks else '-',
+        _ms(metrics.percentile(stats['buckets'], 0.5)),
+        _ms(metrics.percentile(stats['buckets'], 0.95)),
+        _ms(metrics.percentile(stats['buckets'], 0.99)),
+    )
+
+
+class Command(BaseCommand):
+    help = 'Show has_perm metrics gathered in the SUPERPERMS_METRICS cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--json', action='store_true', default=False,
+            help='Print the raw counters as JSON.'
+        )
+        parser.add_argument(
+            '--reset', action='store_true', default=False,
+            help='Clear the counters after printing them.'
+        )
+
+    def handle(self, *args, **options):
+        alias = getattr(settings, 'SUPERPERMS_METRICS', None)
+        if alias is None:
+            raise CommandError('SUPERPERMS_METRICS is not set.')
+
+        gathered = metrics.read_metrics(alias)
+        if options['json']:
+            self.stdout.write(json.dumps([
+                dict(stats, perm_name=perm_name, outcome=outcome)
+                for (perm_name, outcome), stats in sorted(gathered.items())
+            ], indent=2, sort_keys=True))
+        else:
+            rows = [HEADER] + [
+                _row(perm_name, outcome, stats)
+                for (perm_name, outcome), stats in sorted(gathered.items())
+            ]
+            widths = [max(len(row[i]) for row in rows) for i in range(9)]
+            for row in rows:
+                self.stdout.write('  '.join(
+                    cell.ljust(width) if i < 2 else cell.rjust(width)
+                    for i, (cell, width) in enumerate(zip(row, widths))
+                ))
+
+        if options['reset']:
+            metrics.reset_metrics(alias)
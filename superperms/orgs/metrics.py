@@ -0,0 +1,249 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+Receivers for ``superperms.orgs.signals.perm_checked``.
+
+``PermMetrics`` counts checks and buckets their latency in process, and
+every so often adds its counts to a Django cache shared by all processes,
+where ``manage.py superperms_metrics`` reads them. ``StatsdSink`` forwards
+each check to a statsd-style client instead.
+"""
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from superperms.orgs.signals import perm_checked
+
+
+# Upper bounds, in seconds, of the latency histogram's buckets; a final
+# bucket catches anything slower.
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0
+)
+
+# Checks counted in process before they're added to the shared cache.
+DEFAULT_METRICS_FLUSH_EVERY = 100
+
+METRICS_KEY_PREFIX = 'superperms:metrics'
+# Lists the ``(perm_name, outcome)`` pairs with counts in the cache.
+METRICS_INDEX_KEY = METRICS_KEY_PREFIX + ':index'
+
+# Counters kept for each ``(perm_name, outcome)``; elapsed is in
+# microseconds so it can be incremented in the cache.
+COUNTERS = ('checks', 'cache_hits', 'cache_misses', 'queries', 'elapsed_us')
+
+
+def _empty_stats():
+    stats = dict((counter, 0) for counter in COUNTERS)
+    stats['buckets'] = [0] * (len(LATENCY_BUCKETS) + 1)
+    return stats
+
+
+def _counter_key(perm_name, outcome, counter):
+    return '{0}:{1}:{2}:{3}'.format(
+        METRICS_KEY_PREFIX, perm_name, outcome, counter
+    )
+
+
+def _stat_keys(perm_name, outcome):
+    """Return ``[(cache_key, counter, bucket)]`` for one pair's stats."""
+    keys = [
+        (_counter_key(perm_name, outcome, counter), counter, None)
+        for counter in COUNTERS
+    ]
+    keys.extend(
+        (_counter_key(perm_name, outcome, 'bucket_{0}'.format(i)),
+         'buckets', i)
+        for i in range(len(LATENCY_BUCKETS) + 1)
+    )
+    return keys
+
+
+def percentile(buckets, fraction):
+    """
+    Return the upper bound of the latency bucket holding the ``fraction``
+    (e.g. 0.95) point of ``buckets``; None for the overflow bucket or if
+    there's nothing counted.
+    """
+    total = sum(buckets)
+    if not total:
+        return None
+    running = 0
+    for i, count in enumerate(buckets):
+        running += count
+        if running >= fraction * total:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+
+
+class PermMetrics(object):
+    """
+    Aggregates ``perm_checked`` into counters and latency histograms for
+    each ``(perm_name, outcome)``.
+
+    With a ``cache_alias``, counts are added to that Django cache every
+    ``flush_every`` checks, and on ``flush()``.
+    """
+
+    def __init__(self, cache_alias=None, flush_every=None):
+        self.cache_alias = cache_alias
+        self.flush_every = flush_every or DEFAULT_METRICS_FLUSH_EVERY
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._unflushed = 0
+
+    def record(self, perm_name, outcome, cache_hit, queries, elapsed):
+        """Count one check."""
+        bucket = bisect_left(LATENCY_BUCKETS, elapsed)
+        with self._lock:
+            stats = self._stats.get((perm_name, outcome))
+            if stats is None:
+                stats = self._stats[(perm_name, outcome)] = _empty_stats()
+            stats['checks'] += 1
+            if cache_hit is not None:
+                stats['cache_hits' if cache_hit else 'cache_misses'] += 1
+            stats['queries'] += queries
+            stats['elapsed_us'] += int(elapsed * 1e6)
+            stats['buckets'][bucket] += 1
+            self._unflushed += 1
+            should_flush = (
+                self.cache_alias is not None and
+                self._unflushed >= self.flush_every
+            )
+        if should_flush:
+            self.flush()
+
+    def receive(self, sender, perm_name, outcome, cache_hit, queries,
+                elapsed, **kwargs):
+        self.record(perm_name, outcome, cache_hit, queries, elapsed)
+
+    def connect(self):
+        perm_checked.connect(self.receive, weak=False)
+
+    def disconnect(self):
+        perm_checked.disconnect(self.receive)
+
+    def snapshot(self):
+        """Return ``{(perm_name, outcome): stats}`` counted in process."""
+        with self._lock:
+            return dict(
+                (pair, dict(stats, buckets=list(stats['buckets'])))
+                for pair, stats in self._stats.items()
+            )
+
+    def flush(self):
+        """Add our counts to the shared cache, and start counting afresh."""
+        with self._lock:
+            stats, self._stats = self._stats, {}
+            self._unflushed = 0
+        if self.cache_alias is None or not stats:
+            return
+
+        cache = caches[self.cache_alias]
+        # Racing processes may drop each other's new pairs; they're put back
+        # on their next flush.
+        index = cache.get(METRICS_INDEX_KEY) or []
+        new_pairs = [list(pair) for pair in stats if list(pair) not in index]
+        if new_pairs:
+            cache.set(METRICS_INDEX_KEY, index + new_pairs, None)
+
+        for (perm_name, outcome), pair_stats in stats.items():
+            for key, counter, bucket in _stat_keys(perm_name, outcome):
+                value = pair_stats[counter]
+                if bucket is not None:
+                    value = value[bucket]
+                if value and not cache.add(key, value, None):
+                    cache.incr(key, value)
+
+
+def read_metrics(cache_alias):
+    """Return ``{(perm_name, outcome): stats}`` from the shared cache."""
+    cache = caches[cache_alias]
+    pairs = [tuple(pair) for pair in cache.get(METRICS_INDEX_KEY) or []]
+    keys = dict((pair, _stat_keys(*pair)) for pair in pairs)
+    values = cache.get_many(
+        [key for pair_keys in keys.values() for key, _, _ in pair_keys]
+    )
+
+    metrics = {}
+    for pair, pair_keys in keys.items():
+        stats = metrics[pair] = _empty_stats()
+        for key, counter, bucket in pair_keys:
+            value = values.get(key, 0)
+            if bucket is None:
+                stats[counter] = value
+            else:
+                stats['buckets'][bucket] = value
+    return metrics
+
+
+def reset_metrics(cache_alias):
+    """Drop everything counted in the shared cache."""
+    cache = caches[cache_alias]
+    pairs = [tuple(pair) for pair in cache.get(METRICS_INDEX_KEY) or []]
+    cache.delete_many(
+        [key for pair in pairs for key, _, _ in _stat_keys(*pair)] +
+        [METRICS_INDEX_KEY]
+    )
+
+
+class StatsdSink(object):
+    """
+    Forwards ``perm_checked`` to a statsd-style ``client``, one with
+    ``incr(name, count)`` and ``timing(name, milliseconds)``.
+    """
+
+    def __init__(self, client, prefix='superperms'):
+        self.client = client
+        self.prefix = prefix
+
+    def receive(self, sender, perm_name, outcome, cache_hit, queries,
+                elapsed, **kwargs):
+        name = '{0}.{1}'.format(self.prefix, perm_name)
+        self.client.incr('{0}.{1}'.format(name, outcome), 1)
+        self.client.timing('{0}.latency'.format(name), elapsed * 1000.0)
+        if cache_hit is not None:
+            self.client.incr('{0}.{1}'.format(
+                self.prefix, 'cache_hit' if cache_hit else 'cache_miss'
+            ), 1)
+        if queries:
+            self.client.incr('{0}.queries'.format(self.prefix), queries)
+
+    def connect(self):
+        perm_checked.connect(self.receive, weak=False)
+
+    def disconnect(self):
+        perm_checked.disconnect(self.receive)
+
+
+# Set up by ``install_default_sinks`` from settings.
+default_metrics = None
+default_statsd = None
+
+
+def install_default_sinks():
+    """
+    Connect the sinks asked for in settings: a ``PermMetrics`` aggregating
+    into the ``SUPERPERMS_METRICS`` cache alias, and a ``StatsdSink`` for
+    the client at dotted path ``SUPERPERMS_STATSD_CLIENT``.
+    """
+    global default_metrics, default_statsd
+
+    alias = getattr(settings, 'SUPERPERMS_METRICS', None)
+    if alias is not None and default_metrics is None:
+        default_metrics = PermMetrics(alias, getattr(
+            settings, 'SUPERPERMS_METRICS_FLUSH_EVERY',
+            DEFAULT_METRICS_FLUSH_EVERY
+        ))
+        default_metrics.connect()
+
+    client_path = getattr(settings, 'SUPERPERMS_STATSD_CLIENT', None)
+    if client_path is not None and default_statsd is None:
+        default_statsd = StatsdSink(
+            import_string(client_path),
+            getattr(settings, 'SUPERPERMS_STATSD_PREFIX', 'superperms')
+        )
+        default_statsd.connect()
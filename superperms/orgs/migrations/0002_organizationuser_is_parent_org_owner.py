@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+ROLE_OWNER = 20
+
+
+def set_parent_org_owners(apps, schema_editor):
+    """Flag memberships of child orgs whose users own the parent org."""
+    OrganizationUser = apps.get_model('orgs', 'OrganizationUser')
+    owners = OrganizationUser.objects.filter(
+        role_level__gte=ROLE_OWNER
+    ).values_list('user_id', 'organization_id')
+    for user_id, org_id in owners:
+        OrganizationUser.objects.filter(
+            user_id=user_id, organization__parent_org_id=org_id
+        ).update(is_parent_org_owner=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organizationuser',
+            name='is_parent_org_owner',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(
+            set_parent_org_owners, migrations.RunPython.noop
+        ),
+    ]
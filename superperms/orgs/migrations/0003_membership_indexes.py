@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+import uuid
+
+
+STATUS_ACCEPTED = 'accepted'
+
+
+def dedupe_memberships(apps, schema_editor):
+    """
+    Collapse duplicate memberships into the highest ranking one, so the
+    unique constraint can go on. It keeps any acceptance or parent ownership
+    the duplicates had.
+    """
+    OrganizationUser = apps.get_model('orgs', 'OrganizationUser')
+    dupes = OrganizationUser.objects.values(
+        'user_id', 'organization_id'
+    ).annotate(n=Count('pk')).filter(n__gt=1).order_by()
+    for dupe in dupes:
+        rows = list(OrganizationUser.objects.filter(
+            user_id=dupe['user_id'], organization_id=dupe['organization_id']
+        ).order_by('-role_level', 'pk'))
+        keep, extras = rows[0], rows[1:]
+        if any(row.status == STATUS_ACCEPTED for row in rows):
+            keep.status = STATUS_ACCEPTED
+        keep.is_parent_org_owner = any(
+            row.is_parent_org_owner for row in rows
+        )
+        keep.save()
+        OrganizationUser.objects.filter(
+            pk__in=[row.pk for row in extras]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0002_organizationuser_is_parent_org_owner'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            dedupe_memberships, migrations.RunPython.noop
+        ),
+        migrations.AlterField(
+            model_name='organization',
+            name='uid',
+            field=models.UUIDField(default=uuid.uuid4, db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='organizationuser',
+            unique_together=set([('user', 'organization')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='organizationuser',
+            index_together=set([('organization', 'role_level')]),
+        ),
+    ]
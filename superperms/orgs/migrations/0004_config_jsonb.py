@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+import superperms.orgs.fields
+
+
+CONFIG_INDEX = 'orgs_organization_config_gin'
+
+
+def _table(apps, schema_editor):
+    Organization = apps.get_model('orgs', 'Organization')
+    return schema_editor.quote_name(Organization._meta.db_table)
+
+
+def config_to_jsonb(apps, schema_editor):
+    """
+    Store config as jsonb, with a GIN index for key and containment
+    lookups. Only Postgres has either; elsewhere config stays JSON text.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = _table(apps, schema_editor)
+    # Django won't add the USING clause json needs to become jsonb.
+    schema_editor.execute(
+        'ALTER TABLE {0} ALTER COLUMN "config" TYPE jsonb '
+        'USING "config"::jsonb'.format(table)
+    )
+    schema_editor.execute(
+        'CREATE INDEX {0} ON {1} USING gin ("config")'.format(
+            schema_editor.quote_name(CONFIG_INDEX), table
+        )
+    )
+
+
+def config_to_json(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'DROP INDEX IF EXISTS {0}'.format(
+            schema_editor.quote_name(CONFIG_INDEX)
+        )
+    )
+    schema_editor.execute(
+        'ALTER TABLE {0} ALTER COLUMN "config" TYPE json '
+        'USING "config"::json'.format(_table(apps, schema_editor))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0003_membership_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(config_to_jsonb, config_to_json),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='organization',
+                    name='config',
+                    field=superperms.orgs.fields.JSONBField(
+                        default={}, null=True, blank=True
+                    ),
+                ),
+            ],
+        ),
+    ]
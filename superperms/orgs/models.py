@@ -3,15 +3,23 @@
 :license: see LICENSE for details.
 """
 from django.conf import settings
-from django.db import models
+from django.db import OperationalError, connections, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 
-from djorm_pgjson.fields import JSONField
+from superperms.orgs import cache as org_cache
+from superperms.orgs import config as org_config
+from superperms.orgs.cache import get_role_cache, invalidate_roles
 from superperms.orgs.exceptions import TooManyNestedOrgs
+from superperms.orgs.fields import JSONBField
+from superperms.orgs import hierarchy
+from superperms.orgs.utils import FrozenMapping, flush_after_commit
+import threading
 import uuid
 
 # django 1.8 includes UUIDField natively
-uuidfield_options = {'default': uuid.uuid4}
+uuidfield_options = {'default': uuid.uuid4, 'db_index': True}
 try:
     from django.db.models import UUIDField
 except ImportError:
@@ -35,6 +43,20 @@ ROLE_LEVEL_CHOICES = (
 )
 
 
+# Keep ``IN`` clauses under SQLite's limit on query parameters.
+MEMBERSHIP_BATCH_SIZE = 500
+
+# How many times to try changes that lock organizations, e.g. on deadlock.
+DEFAULT_ORG_LOCK_ATTEMPTS = 3
+
+# Set while a queryset delete is running, so receivers leave the tidying up
+# of each row to it.
+_bulk_delete = threading.local()
+
+# Stands in for an ``Organization.parent_org_id`` that was deferred.
+_NOT_LOADED = object()
+
+
 # Invite status
 STATUS_PENDING = 'pending'
 STATUS_ACCEPTED = 'accepted'
@@ -66,9 +88,89 @@ class ExportableField(models.Model):
         )
 
 
+class OrganizationUserQuerySet(models.QuerySet):
+
+    def with_perm_context(self):
+        """
+        Load memberships with everything permission checks need.
+
+        The organization and its parent come along via ``select_related``,
+        and parent ownership is kept on ``is_parent_org_owner``, so checking
+        any of the built-in perms takes no further queries.
+        """
+        return self.select_related('organization', 'organization__parent_org')
+
+    def delete(self):
+        """Ensure we preserve at least one Owner for each affected org."""
+        members = {}
+        for org_id, user_id in self.order_by().values_list(
+            'organization_id', 'user_id'
+        ):
+            members.setdefault(org_id, []).append(user_id)
+
+        def delete_and_ensure_owners():
+            _delete_rows(self)
+            # Roles read before we held the locks may be stale (a member
+            # promoted meanwhile), so this doesn't rely on them: nobody
+            # removed owns the parent of these orgs' children any more, and
+            # every org gets checked for an owner.
+            for org_id, user_ids in members.items():
+                _set_child_parent_ownership(user_ids, org_id, False)
+            _ensure_owners(sorted(members))
+
+        _with_org_locks(members, delete_and_ensure_owners)
+        for org_id, user_ids in members.items():
+            _invalidate_member_roles(org_id, user_ids)
+
+    def refresh_parent_org_owners(self):
+        """
+        Recompute ``is_parent_org_owner`` for these memberships from their
+        parent orgs' owners. ``save()`` and our own methods keep it current;
+        this is for after ``update()`` or ``bulk_create`` calls that change
+        roles, memberships or ``parent_org``. Returns how many rows changed.
+        """
+        with transaction.atomic():
+            rows = list(self.order_by().values_list(
+                'pk', 'user_id', 'organization_id',
+                'organization__parent_org_id', 'is_parent_org_owner'
+            ))
+            parent_ids = list(set(
+                row[3] for row in rows if row[3] is not None
+            ))
+            owners = set()
+            for i in range(0, len(parent_ids), MEMBERSHIP_BATCH_SIZE):
+                owners.update(OrganizationUser.objects.filter(
+                    organization_id__in=parent_ids[
+                        i:i + MEMBERSHIP_BATCH_SIZE
+                    ],
+                    role_level__gte=ROLE_OWNER
+                ).order_by().values_list('user_id', 'organization_id'))
+
+            changed = {True: [], False: []}
+            pairs = []
+            for pk, user_id, org_id, parent_id, flag in rows:
+                is_owner = (user_id, parent_id) in owners
+                if is_owner != flag:
+                    changed[is_owner].append(pk)
+                    pairs.append((user_id, org_id))
+            for is_owner, pks in changed.items():
+                for i in range(0, len(pks), MEMBERSHIP_BATCH_SIZE):
+                    OrganizationUser.objects.filter(
+                        pk__in=pks[i:i + MEMBERSHIP_BATCH_SIZE]
+                    ).update(is_parent_org_owner=is_owner)
+            invalidate_roles(pairs)
+        flush_after_commit()
+        return len(pairs)
+
+
 class OrganizationUser(models.Model):
     class Meta:
         ordering = ['organization', '-role_level']
+        unique_together = ('user', 'organization')
+        # Serves role filters and owner succession within an org.
+        index_together = ('organization', 'role_level')
+
+    objects = OrganizationUserQuerySet.as_manager()
 
     user = models.ForeignKey(USER_MODEL)
     organization = models.ForeignKey('Organization')
@@ -78,28 +180,57 @@ class OrganizationUser(models.Model):
     role_level = models.IntegerField(
         default=ROLE_OWNER, choices=ROLE_LEVEL_CHOICES
     )
+    # Whether ``user`` owns ``organization``'s parent, which makes them an
+    # owner here too. Kept up to date as memberships and parents change.
+    is_parent_org_owner = models.BooleanField(default=False)
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        """Keep parent ownership current for this and child memberships."""
+        if update_fields is None and not self._state.adding:
+            # Ours may have changed since we were loaded, and it's kept
+            # current in the database, so don't write back a stale copy.
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name != 'is_parent_org_owner'
+            ]
+        with transaction.atomic():
+            if self._state.adding:
+                self.is_parent_org_owner = OrganizationUser.objects.filter(
+                    user_id=self.user_id,
+                    organization__child_orgs=self.organization_id,
+                    role_level__gte=ROLE_OWNER
+                ).exists()
+            super(OrganizationUser, self).save(
+                force_insert, force_update, using, update_fields
+            )
+            _set_child_parent_ownership(
+                [self.user_id],
+                self.organization_id,
+                self.role_level >= ROLE_OWNER
+            )
+        flush_after_commit()
 
     def delete(self, *args, **kwargs):
         """Ensure we preserve at least one Owner for this org."""
-        # If we're removing an owner
-        if self.role_level == ROLE_OWNER:
-            # If there are users, but no other owners in this organization.
-            if (
-                OrganizationUser.objects.all().exclude(pk=self.pk).exists() and
-                OrganizationUser.objects.filter(
-                    organization=self.organization,
-                    role_level=ROLE_OWNER
-                ).exclude(pk=self.pk).count() == 0
-            ):
-                    # Make next most high ranking person the owner.
-                other_user = OrganizationUser.objects.filter(
-                    organization=self.organization
-                ).exclude(pk=self.pk)[0]
-
-                other_user.role_level = ROLE_OWNER
-                other_user.save()
-
-        super(OrganizationUser, self).delete(*args, **kwargs)
+        pk = self.pk
+
+        def delete_and_ensure_owner():
+            # A rolled back attempt has already cleared our pk.
+            self.pk = pk
+            # We may have been made the owner while waiting for the lock.
+            role_level = OrganizationUser.objects.filter(
+                pk=pk
+            ).order_by().values_list('role_level', flat=True).first()
+            if role_level is not None:
+                self.role_level = role_level
+            super(OrganizationUser, self).delete(*args, **kwargs)
+            # If we're removing an owner
+            if self.role_level >= ROLE_OWNER:
+                _ensure_owners([self.organization_id])
+
+        _with_org_locks([self.organization_id], delete_and_ensure_owner)
 
     def __unicode__(self):
         return u'OrganizationUser: {0} <{1}> ({2})'.format(
@@ -107,11 +238,57 @@ class OrganizationUser(models.Model):
         )
 
 
+class OrganizationQuerySet(models.QuerySet):
+
+    def with_perm(self, user, perm_name):
+        """
+        Return the orgs where ``user`` has ``perm_name``, filtered in SQL
+        with the same rules ``has_perm`` uses.
+        """
+        # Perm rules live alongside the decorators that enforce them.
+        from superperms.orgs.decorators import perm_filter
+
+        q = perm_filter(user, perm_name)
+        if q is None:
+            return self.none()
+        # One filter() call joins memberships once, and a user has at most
+        # one per org, so rows don't repeat and DISTINCT isn't needed (nor
+        # possible over a Postgres json column).
+        return self.filter(q)
+
+    def with_config_key(self, path):
+        """
+        Return the orgs whose own config has a key at ``path``. Top-level
+        keys use the config index on Postgres.
+        """
+        return self._config_where(org_config.has_key_sql, path)
+
+    def with_config(self, values):
+        """
+        Return the orgs whose own config contains the dict ``values``, like
+        Postgres' ``@>``, which uses the config index.
+        """
+        return self._config_where(org_config.contains_sql, values)
+
+    def _config_where(self, build_sql, arg):
+        connection = connections[self.db]
+        column = '{0}.{1}'.format(
+            connection.ops.quote_name(self.model._meta.db_table),
+            connection.ops.quote_name(
+                self.model._meta.get_field('config').column
+            )
+        )
+        sql, params = build_sql(connection.vendor, column, arg)
+        return self.extra(where=[sql], params=params)
+
+
 class Organization(models.Model):
     """A group of people that optionally contains another sub group."""
     class Meta:
         ordering = ['name']
 
+    objects = OrganizationQuerySet.as_manager()
+
     uid = UUIDField(**uuidfield_options)
     name = models.CharField(max_length=100)
     users = models.ManyToManyField(
@@ -125,31 +302,119 @@ class Organization(models.Model):
     )
 
     # whatever extra configuration can go here
-    config = JSONField()
+    config = JSONBField()
 
     # If below this threshold, we don't show results from this Org
     # in exported views of its data.
     query_threshold = models.IntegerField(blank=True, null=True)
 
+    def __init__(self, *args, **kwargs):
+        super(Organization, self).__init__(*args, **kwargs)
+        # So ``save`` can tell when we've been moved to a new parent. Read
+        # from ``__dict__`` so a deferred ``parent_org_id`` isn't loaded.
+        self._saved_parent_org_id = self.__dict__.get(
+            'parent_org_id', _NOT_LOADED
+        )
+
     def save(self, *args, **kwargs):
         """Perform checks before saving."""
+        # A deferred parent nobody has read or set isn't being changed, or
+        # saved.
+        parent_loaded = 'parent_org_id' in self.__dict__
+
         # There can only be one.
         if (
-            self.parent_org is not None and
-            self.parent_org.parent_org is not None
+            parent_loaded and
+            self.parent_org_id is not None and
+            self._grandparent_id() is not None
         ):
             raise TooManyNestedOrgs
 
-        super(Organization, self).save(*args, **kwargs)
+        # Loaded since we were, we can't tell, so assume it changed.
+        parent_changed = (
+            not self._state.adding and
+            parent_loaded and
+            self.parent_org_id != self._saved_parent_org_id
+        )
+        with transaction.atomic():
+            super(Organization, self).save(*args, **kwargs)
+            if parent_changed:
+                self._update_parent_ownership()
+        flush_after_commit()
+        self._saved_parent_org_id = self.__dict__.get(
+            'parent_org_id', _NOT_LOADED
+        )
+
+    def delete(self, *args, **kwargs):
+        """Our memberships go too, so re-drop their roles once committed."""
+        super(Organization, self).delete(*args, **kwargs)
+        flush_after_commit()
+
+    def _loaded_parent(self):
+        """Return ``parent_org`` if it's already loaded, else None."""
+        cache_name = self._meta.get_field('parent_org').get_cache_name()
+        return getattr(self, cache_name, None)
+
+    def _grandparent_id(self):
+        """Return our parent's ``parent_org_id``, from the tree if we can."""
+        if self._loaded_parent() is None:
+            tree = hierarchy.get_tree()
+            if tree is not None and self.parent_org_id in tree:
+                return tree.parent_id(self.parent_org_id)
+        return self.parent_org.parent_org_id
+
+    def _update_parent_ownership(self):
+        """
+        Recompute ``is_parent_org_owner`` for all our memberships, and drop
+        their cached roles, after ``parent_org`` changes.
+        """
+        members = OrganizationUser.objects.filter(organization=self)
+        members.update(is_parent_org_owner=False)
+        if self.parent_org_id is not None:
+            members.filter(
+                user_id__in=OrganizationUser.objects.filter(
+                    organization_id=self.parent_org_id,
+                    role_level__gte=ROLE_OWNER
+                ).values('user_id')
+            ).update(is_parent_org_owner=True)
+        # Our child orgs' cached roles rest on our owners, which haven't
+        # changed, so only ours need to go.
+        if get_role_cache() is not None:
+            invalidate_roles([
+                (user_id, self.pk)
+                for user_id in members.values_list('user_id', flat=True)
+            ])
 
     def is_member(self, user):
         """Return True if user object has a relation to this organization."""
-        return user in self.users.all()
+        return OrganizationUser.objects.filter(
+            organization=self, user=user
+        ).exists()
+
+    def filter_members(self, users):
+        """Return the set of ids of those ``users`` who are members."""
+        return set(row[0] for row in _member_rows(self.pk, users, 'user_id'))
+
+    def get_member_roles(self, users):
+        """Return ``{user_id: role_level}`` for those ``users`` in this org."""
+        roles = {}
+        for user_id, role_level in _member_rows(
+            self.pk, users, 'user_id', 'role_level'
+        ):
+            roles[user_id] = max(role_level, roles.get(user_id, role_level))
+        return roles
+
+    def get_member_role(self, user):
+        """Return ``user``'s role_level in this org, or None."""
+        return self.get_member_roles([user]).get(getattr(user, 'pk', user))
 
     def add_member(self, user, role=ROLE_OWNER):
-        """Add a user to an organization."""
+        """
+        Add a user to an organization. Like ``add_members``, an existing
+        member keeps their role.
+        """
         return OrganizationUser.objects.get_or_create(
-            user=user, organization=self, role_level=role
+            user=user, organization=self, defaults={'role_level': role}
         )
 
     def remove_member(self, user):
@@ -158,6 +423,121 @@ class Organization(models.Model):
             user=user, organization=self
         ).delete()
 
+    def _parent_owner_ids(self, user_ids):
+        """Return which of ``user_ids`` own our parent org."""
+        if self.parent_org_id is None:
+            return set()
+        return set(
+            user_id for user_id, role_level in _member_rows(
+                self.parent_org_id, user_ids, 'user_id', 'role_level'
+            ) if role_level >= ROLE_OWNER
+        )
+
+    def add_members(self, users, role=ROLE_OWNER):
+        """
+        Add many users (objects or ids) at once with ``role``. Users who are
+        already members are left as they are.
+
+        Returns the list of new ``OrganizationUser`` objects.
+        """
+        return self.upsert_members(
+            dict((getattr(user, 'pk', user), role) for user in users),
+            update=False
+        )
+
+    def upsert_members(self, roles, update=True):
+        """
+        Give each user in ``roles``, a dict of ``{user: role_level}``, that
+        role, adding them as members where needed. Users are objects or ids.
+
+        Runs a fixed handful of queries however many users there are, and
+        makes sure we still have an owner at the end. Returns the list of
+        new ``OrganizationUser`` objects.
+        """
+        roles = dict(
+            (getattr(user, 'pk', user), role) for user, role in roles.items()
+        )
+        created, changed_ids = _with_org_locks(
+            [self.pk], lambda: self._upsert_members(roles, update)
+        )
+        _invalidate_member_roles(self.pk, changed_ids)
+        return created
+
+    def _upsert_members(self, roles, update):
+        """Return new memberships, and users whose role we changed."""
+        existing = self.get_member_roles(roles)
+        new_ids = [user_id for user_id in roles if user_id not in existing]
+        parent_owner_ids = self._parent_owner_ids(new_ids)
+        created = [
+            OrganizationUser(
+                user_id=user_id,
+                organization=self,
+                role_level=roles[user_id],
+                is_parent_org_owner=user_id in parent_owner_ids
+            ) for user_id in new_ids
+        ]
+        OrganizationUser.objects.bulk_create(
+            created, batch_size=MEMBERSHIP_BATCH_SIZE
+        )
+
+        changed = dict(
+            (user_id, role) for user_id, role in roles.items()
+            if update and user_id in existing and existing[user_id] != role
+        )
+        by_role = {}
+        for user_id, role in changed.items():
+            by_role.setdefault(role, []).append(user_id)
+        for role, user_ids in by_role.items():
+            for i in range(0, len(user_ids), MEMBERSHIP_BATCH_SIZE):
+                OrganizationUser.objects.filter(
+                    organization=self,
+                    user_id__in=user_ids[i:i + MEMBERSHIP_BATCH_SIZE]
+                ).update(role_level=role)
+
+        # Owning this org makes you an owner of our child orgs.
+        became_owners = [
+            user_id for user_id in new_ids if roles[user_id] >= ROLE_OWNER
+        ] + [
+            user_id for user_id, role in changed.items()
+            if role >= ROLE_OWNER > existing[user_id]
+        ]
+        stopped_owning = [
+            user_id for user_id, role in changed.items()
+            if existing[user_id] >= ROLE_OWNER > role
+        ]
+        _set_child_parent_ownership(became_owners, self.pk, True)
+        _set_child_parent_ownership(stopped_owning, self.pk, False)
+
+        if stopped_owning:
+            _ensure_owners([self.pk])
+
+        return created, list(changed) + became_owners
+
+    def remove_members(self, users):
+        """
+        Remove many users (objects or ids) at once, making sure we still
+        have an owner afterwards. Returns how many memberships went.
+        """
+        user_ids = list(set(getattr(user, 'pk', user) for user in users))
+
+        def remove_and_ensure_owner():
+            removed = 0
+            for i in range(0, len(user_ids), MEMBERSHIP_BATCH_SIZE):
+                org_users = OrganizationUser.objects.filter(
+                    organization=self,
+                    user_id__in=user_ids[i:i + MEMBERSHIP_BATCH_SIZE]
+                )
+                removed += org_users.count()
+                _delete_rows(org_users)
+            # Once for the whole call, rather than per batch.
+            _set_child_parent_ownership(user_ids, self.pk, False)
+            _ensure_owners([self.pk])
+            return removed
+
+        removed = _with_org_locks([self.pk], remove_and_ensure_owner)
+        _invalidate_member_roles(self.pk, user_ids)
+        return removed
+
     def is_owner(self, user):
         """
         Return True if the user has a relation to this org, with a role of
@@ -167,30 +547,274 @@ class Organization(models.Model):
             user=user, role_level=ROLE_OWNER, organization=self,
         ).exists()
 
+    def set_config(self, path, value):
+        """
+        Set the config value at ``path``, a sequence of keys or a dotted
+        string, saving only that change. See ``superperms.orgs.config``.
+        """
+        org_config.change_config(self, org_config.SET, path, value)
+        _invalidate_effective_config(self)
+
+    def delete_config(self, path):
+        """Remove the config key at ``path``, if it's there."""
+        org_config.change_config(self, org_config.DELETE, path)
+        _invalidate_effective_config(self)
+
+    def merge_config(self, values, path=()):
+        """Update the config object at ``path`` with the dict ``values``."""
+        org_config.change_config(self, org_config.MERGE, path, values)
+        _invalidate_effective_config(self)
+
+    def get_effective_config(self):
+        """
+        Return our config merged over our parent's, as a read-only mapping
+        (lists become tuples). Nested objects are merged key by key; any
+        other value of ours replaces the parent's.
+
+        Cached in the ``SUPERPERMS_CONFIG_CACHE`` until either org changes,
+        or for ``SUPERPERMS_CONFIG_CACHE_TIMEOUT`` seconds at most.
+        """
+        config = org_cache.get_effective_config(self.pk)
+        if config is not None:
+            return config
+        if self.parent_org_id is None:
+            config = org_config.merge({}, self.config)
+        else:
+            parent_config = org_cache.get_effective_config(self.parent_org_id)
+            if parent_config is None:
+                parent_config = self.parent_org.get_effective_config()
+            config = org_config.merge(parent_config, self.config)
+        org_cache.set_effective_config(self.pk, config)
+        return config
+
     def get_exportable_fields(self):
         """Default to parent definition of exportable fields."""
-        if self.parent_org:
-            return self.parent_org.get_exportable_fields()
-        return self.exportable_fields.all()
+        # Orgs only nest one deep, so the parent's fields are the top's.
+        return ExportableField.objects.filter(
+            organization_id=self.parent_org_id or self.pk
+        )
+
+    def get_exportable_field_names(self):
+        """
+        Return a read-only ``{field_model: frozenset(names)}`` of our
+        exportable fields, which default to the parent's like
+        ``get_exportable_fields``. Cached in the
+        ``SUPERPERMS_EXPORTABLE_FIELDS_CACHE`` until the fields change.
+        """
+        org_id = self.parent_org_id or self.pk
+        names = org_cache.get_exportable_fields(org_id)
+        if names is None:
+            grouped = {}
+            for field_model, name in ExportableField.objects.filter(
+                organization_id=org_id
+            ).order_by().values_list('field_model', 'name'):
+                grouped.setdefault(field_model, set()).add(name)
+            names = dict(
+                (field_model, frozenset(field_names))
+                for field_model, field_names in grouped.items()
+            )
+            org_cache.set_exportable_fields(org_id, names)
+        return FrozenMapping(names)
 
     def get_query_threshold(self):
         """Default to parent definition of query threshold."""
-        if self.parent_org:
-            return self.parent_org.get_query_threshold()
-        return self.query_threshold
+        if self.parent_org_id is None:
+            return self.query_threshold
+        if self._loaded_parent() is None:
+            tree = hierarchy.get_tree()
+            if tree is not None and self.parent_org_id in tree:
+                return tree.query_threshold(tree.top_id(self.parent_org_id))
+        return self.parent_org.get_query_threshold()
 
     @property
     def is_parent(self):
-        return not self.parent_org
+        return self.parent_org_id is None
 
     def get_parent(self):
         """
         Returns the top-most org in this org's tree.
         That could be this org, or it could be this org's parent.
+
+        For a child org that's a query, unless ``parent_org`` was loaded
+        with ``select_related``; use ``get_parent_id`` if the id will do.
         """
         if self.is_parent:
             return self
         return self.parent_org
 
+    def get_parent_id(self):
+        """Return the id of ``get_parent()``, without loading it."""
+        if self.is_parent:
+            return self.pk
+        return self.parent_org_id
+
     def __unicode__(self):
         return u'Organization: {0}({1})'.format(self.name, self.pk)
+
+
+def _member_rows(org_id, users, *fields):
+    """Yield ``fields`` of ``org_id``'s memberships for ``users``."""
+    user_ids = list(set(getattr(user, 'pk', user) for user in users))
+    for i in range(0, len(user_ids), MEMBERSHIP_BATCH_SIZE):
+        rows = OrganizationUser.objects.filter(
+            organization_id=org_id,
+            user_id__in=user_ids[i:i + MEMBERSHIP_BATCH_SIZE]
+        ).order_by().values_list(*fields)
+        for row in rows:
+            yield row
+
+
+def _with_org_locks(org_ids, fn):
+    """
+    Call ``fn`` in a transaction holding row locks on ``org_ids``.
+
+    Membership changes to the same org queue up behind each other, so two
+    of them can't each leave the other to be the org's last owner, while
+    changes to other orgs carry on in parallel. Locks are taken in pk order
+    to avoid deadlocks; if one happens anyway we retry, unless we're inside
+    someone else's transaction. Returns what ``fn`` returns.
+    """
+    org_ids = sorted(set(org_ids))
+    attempts = getattr(
+        settings, 'SUPERPERMS_ORG_LOCK_ATTEMPTS', DEFAULT_ORG_LOCK_ATTEMPTS
+    )
+    if transaction.get_connection().in_atomic_block:
+        attempts = 1
+
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                if org_ids:
+                    list(Organization.objects.select_for_update().filter(
+                        pk__in=org_ids
+                    ).order_by('pk').values_list('pk', flat=True))
+                result = fn()
+        except OperationalError:
+            if attempt == attempts - 1:
+                raise
+        else:
+            flush_after_commit()
+            return result
+
+
+def _delete_rows(org_users):
+    """
+    Delete the memberships in ``org_users``, leaving the caller to tidy up
+    per org rather than the receiver per row.
+    """
+    _bulk_delete.active = True
+    try:
+        models.QuerySet.delete(org_users)
+    finally:
+        _bulk_delete.active = False
+
+
+def _ensure_owners(org_ids):
+    """
+    Make sure each of ``org_ids`` with members has an owner, promoting its
+    highest ranking member where needed; one query per org, and two more
+    per promotion.
+    """
+    for org_id in org_ids:
+        while True:
+            top = OrganizationUser.objects.filter(
+                organization_id=org_id
+            ).order_by('-role_level', 'pk').first()
+            if top is None or top.role_level >= ROLE_OWNER:
+                break
+            # Make next most high ranking person the owner.
+            if OrganizationUser.objects.filter(pk=top.pk).update(
+                role_level=ROLE_OWNER
+            ):
+                _set_child_parent_ownership([top.user_id], org_id, True)
+                _invalidate_member_roles(org_id, [top.user_id])
+                break
+            # They went (without the org lock) before we got to them;
+            # find someone else.
+
+
+def _set_child_parent_ownership(user_ids, org_id, is_owner):
+    """Set whether ``user_ids`` own the parent of ``org_id``'s child orgs."""
+    for i in range(0, len(user_ids), MEMBERSHIP_BATCH_SIZE):
+        OrganizationUser.objects.filter(
+            user_id__in=user_ids[i:i + MEMBERSHIP_BATCH_SIZE],
+            organization__parent_org_id=org_id
+        ).update(is_parent_org_owner=is_owner)
+
+
+def _child_org_ids(org_id):
+    """Return the ids of ``org_id``'s child orgs, from the tree if we can."""
+    tree = hierarchy.get_tree()
+    if tree is not None and org_id in tree:
+        return tree.child_ids(org_id)
+    return list(Organization.objects.filter(
+        parent_org_id=org_id
+    ).values_list('pk', flat=True))
+
+
+def _invalidate_effective_config(org, created=False):
+    """Drop the cached effective config of ``org`` and its children."""
+    if org_cache.get_config_cache() is None:
+        return
+    org_ids = [org.pk]
+    # Only top-level orgs have children, and new ones have none yet.
+    if org.parent_org_id is None and not created:
+        org_ids.extend(_child_org_ids(org.pk))
+    org_cache.invalidate_effective_config(org_ids)
+
+
+def _invalidate_member_roles(org_id, user_ids, include_children=True):
+    """Drop cached roles for ``user_ids`` in ``org_id`` (and its children)."""
+    if get_role_cache() is None:
+        return
+    org_ids = [org_id]
+    if include_children:
+        # Owning a parent org confers ownership of its children, too.
+        org_ids.extend(_child_org_ids(org_id))
+    invalidate_roles(
+        [(user_id, each_org_id) for user_id in user_ids
+         for each_org_id in org_ids]
+    )
+
+
+@receiver(post_delete, sender=OrganizationUser)
+def _org_user_deleted(sender, instance, **kwargs):
+    """A removed owner no longer owns anything through this org."""
+    if getattr(_bulk_delete, 'active', False):
+        return
+    was_owner = instance.role_level >= ROLE_OWNER
+    if was_owner:
+        _set_child_parent_ownership(
+            [instance.user_id], instance.organization_id, False
+        )
+    _invalidate_member_roles(
+        instance.organization_id, [instance.user_id], was_owner
+    )
+
+
+@receiver(post_save, sender=OrganizationUser)
+def _org_user_saved(sender, instance, **kwargs):
+    """Drop cached roles affected by a membership changing."""
+    _invalidate_member_roles(instance.organization_id, [instance.user_id])
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def _invalidate_hierarchy(sender, instance, **kwargs):
+    """Parents or query thresholds may have changed."""
+    hierarchy.invalidate()
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def _invalidate_organization_config(sender, instance, created=False,
+                                    **kwargs):
+    """Children inherit our config, so theirs may have changed too."""
+    _invalidate_effective_config(instance, created)
+
+
+@receiver(post_save, sender=ExportableField)
+@receiver(post_delete, sender=ExportableField)
+def _invalidate_exportable_fields(sender, instance, **kwargs):
+    """Children share their parent's entry, so this covers them too."""
+    org_cache.invalidate_exportable_fields(instance.organization_id)
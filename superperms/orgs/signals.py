@@ -0,0 +1,20 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+from django.dispatch import Signal
+
+
+# Sent after every ``has_perm`` check, with:
+#   request:    the request checked.
+#   perm_name:  the perm asked for.
+#   outcome:    'allowed', or why not: 'org_dne', 'user_dne' or
+#               'perm_denied'.
+#   cache_hit:  True if the membership came from the request or the role
+#               cache, False if from the database, None if there was no
+#               lookup (superusers).
+#   queries:    database queries the check issued.
+#   elapsed:    seconds the check took.
+perm_checked = Signal(providing_args=[
+    'request', 'perm_name', 'outcome', 'cache_hit', 'queries', 'elapsed'
+])
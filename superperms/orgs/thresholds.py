@@ -0,0 +1,144 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+Hide aggregated results for groups too small to show, per each org's
+``query_threshold``, across many orgs at once.
+
+A group is suppressed when its count is below its org's resolved
+threshold (see ``Organization.get_query_threshold``). Orgs without a
+threshold show everything; orgs missing from the thresholds given show
+nothing.
+"""
+from django.db.models import Q
+from django.db.models.query import QuerySet
+
+from superperms.orgs import hierarchy
+
+try:
+    import numpy
+except ImportError:
+    # Fall back to plain Python; same results, only slower.
+    numpy = None
+
+
+def resolve_thresholds(org_ids):
+    """
+    Return ``{org_id: threshold}`` for ``org_ids``, using the parent's
+    threshold for child orgs. One query at most, none with the tree cached.
+
+    ``org_ids`` may be a ``values_list`` queryset, used as a subquery.
+    """
+    tree = hierarchy.get_tree()
+    if isinstance(org_ids, QuerySet):
+        tree = None
+    else:
+        org_ids = set(org_ids)
+    if tree is not None and all(org_id in tree for org_id in org_ids):
+        return dict(
+            (org_id, tree.query_threshold(tree.top_id(org_id)))
+            for org_id in org_ids
+        )
+
+    from superperms.orgs.models import Organization
+    rows = Organization.objects.filter(
+        pk__in=org_ids
+    ).order_by().values_list(
+        'pk', 'parent_org_id', 'query_threshold',
+        'parent_org__query_threshold'
+    )
+    return dict(
+        (pk, own if parent_id is None else parents)
+        for pk, parent_id, own, parents in rows
+    )
+
+
+def suppressed_mask(counts, org_ids, thresholds):
+    """
+    Return which groups to suppress, given parallel sequences of each
+    group's ``counts`` and ``org_ids``, and ``{org_id: threshold}``.
+
+    With NumPy this is a NumPy boolean array worked out in one vectorized
+    pass, otherwise a list of bools.
+    """
+    if numpy is None:
+        suppressed = []
+        for count, org_id in zip(counts, org_ids):
+            if org_id not in thresholds:
+                suppressed.append(True)
+            else:
+                threshold = thresholds[org_id]
+                suppressed.append(
+                    threshold is not None and count < threshold
+                )
+        return suppressed
+
+    counts = numpy.asarray(counts, dtype=float)
+    unique_ids, group_orgs = numpy.unique(
+        numpy.asarray(org_ids), return_inverse=True
+    )
+    # Unknown orgs hide everything, orgs with no threshold nothing.
+    limits = numpy.array([
+        numpy.inf if org_id not in thresholds
+        else -numpy.inf if thresholds[org_id] is None
+        else thresholds[org_id]
+        for org_id in unique_ids.tolist()
+    ], dtype=float)
+    return counts < limits[group_orgs]
+
+
+def suppress(rows, thresholds, count_field='count',
+             org_field='organization_id'):
+    """
+    Return the dicts in ``rows`` (e.g. from ``values().annotate()``) whose
+    ``count_field`` meets their org's threshold.
+    """
+    rows = list(rows)
+    mask = suppressed_mask(
+        [row[count_field] for row in rows],
+        [row[org_field] for row in rows],
+        thresholds
+    )
+    return [row for row, hidden in zip(rows, mask) if not hidden]
+
+
+def threshold_having(thresholds, count_alias='count',
+                     org_field='organization_id'):
+    """
+    Return a Q that, filtered on after ``annotate()``, keeps only groups
+    meeting their org's threshold; Django puts it in the HAVING clause.
+
+    Orgs sharing a threshold share a condition, so there's one per distinct
+    threshold rather than per org.
+    """
+    by_threshold = {}
+    for org_id, threshold in thresholds.items():
+        by_threshold.setdefault(threshold, []).append(org_id)
+    if not by_threshold:
+        return Q(pk__in=[])
+
+    q = Q()
+    for threshold, org_ids in sorted(
+        by_threshold.items(), key=lambda item: (item[0] is not None, item[0])
+    ):
+        group = Q(**{'{0}__in'.format(org_field): sorted(org_ids)})
+        if threshold is not None:
+            group &= Q(**{'{0}__gte'.format(count_alias): threshold})
+        q |= group
+    return q
+
+
+def apply_threshold(queryset, thresholds=None, count_alias='count',
+                    org_field='organization_id'):
+    """
+    Filter an aggregated ``queryset`` (already ``values().annotate()``-ed,
+    grouped by ``org_field``) down to groups meeting their org's threshold,
+    in SQL. ``thresholds`` defaults to those of every org in the queryset.
+    """
+    if thresholds is None:
+        thresholds = resolve_thresholds(
+            queryset.order_by().values_list(org_field, flat=True)
+        )
+    return queryset.filter(
+        threshold_having(thresholds, count_alias, org_field)
+    )
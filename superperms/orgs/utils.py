@@ -0,0 +1,71 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+import threading
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from django.db import transaction
+
+
+_after_commit = threading.local()
+
+
+class FrozenMapping(Mapping):
+    """A read-only dict, safe to hand out from a cache."""
+
+    def __init__(self, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __hash__(self):
+        return hash(frozenset(self._data.items()))
+
+    def __repr__(self):
+        return 'FrozenMapping({0!r})'.format(self._data)
+
+
+def run_now_and_after_commit(key, fn):
+    """
+    Call ``fn`` now and, if we're inside a transaction, again once it's over.
+
+    Cache entries dropped inside a transaction can be put back by other
+    connections, which still see the old rows, until we commit. Django 1.8
+    has no ``on_commit``, so the second call happens at the next
+    ``flush_after_commit()`` made outside any atomic block; the models make
+    one as each of their own transactions finishes. Only the latest ``fn``
+    queued under a ``key`` runs.
+    """
+    fn()
+    if transaction.get_connection().in_atomic_block:
+        pending = _after_commit.__dict__.setdefault('pending', OrderedDict())
+        pending.pop(key, None)
+        pending[key] = fn
+
+
+def flush_after_commit():
+    """
+    Run what ``run_now_and_after_commit`` queued, unless we're still inside a
+    transaction. Call it after committing your own ``transaction.atomic()``
+    blocks that change organizations or memberships.
+    """
+    if transaction.get_connection().in_atomic_block:
+        return
+    pending = getattr(_after_commit, 'pending', None)
+    if not pending:
+        return
+    _after_commit.pending = OrderedDict()
+    for fn in pending.values():
+        fn()
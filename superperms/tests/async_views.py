@@ -0,0 +1,47 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+Coroutine views for ``test_async_perms``; Python 3 only, so they live
+outside the test module, which Python 2 still imports.
+"""
+from functools import wraps
+
+from django.http import HttpResponse
+
+from superperms.orgs import decorators
+
+
+@decorators.has_perm('can_invite_member')
+async def invite_user(request):
+    return HttpResponse()
+
+
+@decorators.has_perm('requires_member')
+@decorators.has_perm('can_modify_data')
+@decorators.has_perm('requires_viewer')
+async def stacked_view(request):
+    return HttpResponse()
+
+
+def audit(fn):
+    """Another coroutine decorator, which stacked checks mustn't skip."""
+    @wraps(fn)
+    async def _audited(request, *args, **kwargs):
+        request.audited = True
+        return await fn(request, *args, **kwargs)
+    return _audited
+
+
+@decorators.has_perm('requires_viewer')
+@audit
+@decorators.has_perm('requires_member')
+async def audited_view(request):
+    return HttpResponse()
+
+
+@decorators.has_perm('requires_member')
+async def org_user_view(request):
+    resp = HttpResponse()
+    resp.org_user = decorators.get_org_user(request)
+    return resp
@@ -0,0 +1,124 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils import six
+from django.utils.unittest import TestCase, skipIf
+
+from superperms.orgs import decorators
+from superperms.orgs.models import (
+    ROLE_MEMBER,
+    ROLE_OWNER,
+    ROLE_VIEWER,
+    Organization,
+    OrganizationUser,
+)
+from superperms.tests.test_decorators import FakeQueryRequest
+
+if six.PY3:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from superperms.orgs import async_perms
+    from superperms.tests import async_views
+
+    class CountingExecutor(ThreadPoolExecutor):
+        """A pool that counts the jobs it's given."""
+
+        def __init__(self, *args, **kwargs):
+            super(CountingExecutor, self).__init__(*args, **kwargs)
+            self.submitted = 0
+
+        def submit(self, *args, **kwargs):
+            self.submitted += 1
+            return super(CountingExecutor, self).submit(*args, **kwargs)
+
+
+@decorators.has_perm('requires_member')
+def _sync_view(request):
+    return HttpResponse()
+
+
+@skipIf(six.PY2, 'Coroutine views need Python 3.')
+class TestAsyncPerms(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.org = Organization.objects.create(name='Org')
+        self.owner = User.objects.create(username='owner')
+        self.member = User.objects.create(username='member')
+        self.viewer = User.objects.create(username='viewer')
+        OrganizationUser.objects.create(
+            user=self.owner, organization=self.org, role_level=ROLE_OWNER
+        )
+        OrganizationUser.objects.create(
+            user=self.member, organization=self.org, role_level=ROLE_MEMBER
+        )
+        OrganizationUser.objects.create(
+            user=self.viewer, organization=self.org, role_level=ROLE_VIEWER
+        )
+        self.executor = async_perms._executor = CountingExecutor(2)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.executor.shutdown()
+        async_perms._executor = None
+        OrganizationUser.objects.all().delete()
+        Organization.objects.all().delete()
+        User.objects.all().delete()
+        caches['default'].clear()
+
+    def _request(self, user):
+        return FakeQueryRequest(user, self.org.pk)
+
+    def _run(self, view, user):
+        return self.loop.run_until_complete(view(self._request(user)))
+
+    def test_allowed(self):
+        resp = self._run(async_views.invite_user, self.owner)
+        self.assertEqual(resp.__class__, HttpResponse)
+        self.assertEqual(self.executor.submitted, 1)
+
+    def test_denied(self):
+        resp = self._run(async_views.invite_user, self.member)
+        self.assertEqual(resp.status_code, 403)
+
+    def test_stacked_make_one_trip(self):
+        resp = self._run(async_views.stacked_view, self.member)
+        self.assertEqual(resp.__class__, HttpResponse)
+        self.assertEqual(self.executor.submitted, 1)
+
+        resp = self._run(async_views.stacked_view, self.viewer)
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(self.executor.submitted, 2)
+
+    def test_other_decorators_run(self):
+        """Checks aren't collapsed across decorators in between."""
+        request = self._request(self.member)
+        resp = self.loop.run_until_complete(async_views.audited_view(request))
+        self.assertEqual(resp.__class__, HttpResponse)
+        self.assertTrue(request.audited)
+        self.assertEqual(self.executor.submitted, 2)
+
+        request = self._request(self.viewer)
+        resp = self.loop.run_until_complete(async_views.audited_view(request))
+        self.assertEqual(resp.status_code, 403)
+        self.assertTrue(request.audited)
+
+    def test_view_sees_org_user(self):
+        resp = self._run(async_views.org_user_view, self.member)
+        self.assertEqual(resp.org_user.user, self.member)
+
+    def test_sync_views_unchanged(self):
+        self.assertFalse(asyncio.iscoroutinefunction(_sync_view))
+        self.assertEqual(
+            _sync_view(self._request(self.member)).__class__, HttpResponse
+        )
+        self.assertEqual(
+            _sync_view(self._request(self.viewer)).status_code, 403
+        )
+        self.assertEqual(self.executor.submitted, 0)
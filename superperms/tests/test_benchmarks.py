@@ -0,0 +1,212 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+Micro-benchmarks for the permission hot path. Skipped unless
+``SUPERPERMS_BENCHMARK`` is set in the environment::
+
+    SUPERPERMS_BENCHMARK=1 python manage.py test \\
+        superperms.tests.test_benchmarks --settings=test_settings
+
+The population is sized with ``SUPERPERMS_BENCH_ORGS``,
+``SUPERPERMS_BENCH_USERS``, ``SUPERPERMS_BENCH_CHILD_ORGS`` and the number
+of calls timed with ``SUPERPERMS_BENCH_ITERATIONS``. Results go to stderr as
+ops/sec and queries per call.
+"""
+import os
+import sys
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.unittest import TestCase, skipUnless
+
+from superperms.orgs import decorators
+from superperms.orgs.models import (
+    ROLE_LEVEL_CHOICES,
+    Organization,
+    OrganizationUser,
+)
+from superperms.tests.test_decorators import FakeQueryRequest
+
+
+BENCHMARK = os.environ.get('SUPERPERMS_BENCHMARK')
+
+# Calls made while counting queries; timing uses the full iteration count.
+QUERY_COUNT_CALLS = 20
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _view(request):
+    return HttpResponse()
+
+
+@skipUnless(BENCHMARK, 'Set SUPERPERMS_BENCHMARK to run the benchmarks')
+class BenchPermissions(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.num_orgs = _env_int('SUPERPERMS_BENCH_ORGS', 20)
+        cls.num_users = _env_int('SUPERPERMS_BENCH_USERS', 50)
+        cls.num_children = _env_int('SUPERPERMS_BENCH_CHILD_ORGS', 2)
+        cls.iterations = _env_int('SUPERPERMS_BENCH_ITERATIONS', 500)
+
+        User.objects.bulk_create([
+            User(username='bench-{0}@demo.com'.format(x))
+            for x in range(cls.num_users)
+        ])
+        cls.users = list(
+            User.objects.filter(username__startswith='bench-').order_by('pk')
+        )
+
+        # Each org gets every user, with roles dealt out round-robin, and
+        # each child org gets every other user.
+        roles = [level for level, name in ROLE_LEVEL_CHOICES]
+        cls.orgs = []
+        for x in range(cls.num_orgs):
+            org = Organization.objects.create(name='bench-{0}'.format(x))
+            org.upsert_members(dict(
+                (user, roles[(x + y) % len(roles)])
+                for y, user in enumerate(cls.users)
+            ))
+            cls.orgs.append(org)
+            for c in range(cls.num_children):
+                child = Organization.objects.create(
+                    name='bench-{0}-{1}'.format(x, c), parent_org=org
+                )
+                child.upsert_members(dict(
+                    (user, roles[(x + y + c) % len(roles)])
+                    for y, user in enumerate(cls.users[::2])
+                ))
+                cls.orgs.append(child)
+
+        cls.org_users = list(
+            OrganizationUser.objects.with_perm_context().filter(
+                organization__in=cls.orgs
+            )
+        )
+        cls.results = []
+        sys.stderr.write(
+            '\nsuperperms benchmarks: {0} orgs, {1} users, {2} memberships, '
+            '{3} iterations\n'.format(
+                len(cls.orgs), cls.num_users, len(cls.org_users),
+                cls.iterations
+            )
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        OrganizationUser.objects.filter(organization__in=cls.orgs).delete()
+        Organization.objects.filter(pk__in=[o.pk for o in cls.orgs]).delete()
+        User.objects.filter(pk__in=[u.pk for u in cls.users]).delete()
+
+        width = max(len(name) for name, ops, queries in cls.results)
+        for name, ops, queries in cls.results:
+            sys.stderr.write(
+                '{0}  {1:>12,.0f} ops/sec  {2:>6.2f} q/call\n'.format(
+                    name.ljust(width), ops, queries
+                )
+            )
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def _bench(self, name, fn):
+        """
+        Time ``iterations`` calls of ``fn(i)``, then count the queries a
+        few more calls make. Returns queries per call.
+        """
+        start = time.time()
+        for i in range(self.iterations):
+            fn(i)
+        elapsed = max(time.time() - start, 1e-9)
+
+        calls = min(self.iterations, QUERY_COUNT_CALLS)
+        with CaptureQueriesContext(connection) as ctx:
+            for i in range(calls):
+                fn(i)
+        queries = len(ctx) / float(calls)
+
+        self.results.append((name, self.iterations / elapsed, queries))
+        return queries
+
+    def _org_user(self, i):
+        return self.org_users[i % len(self.org_users)]
+
+    def _org(self, i):
+        return self.orgs[i % len(self.orgs)]
+
+    def _user(self, i):
+        return self.users[i % len(self.users)]
+
+    def test_perms(self):
+        """Perm functions work off the loaded membership alone."""
+        for perm_name, perm in sorted(decorators.PERMS.items()):
+            queries = self._bench(
+                'PERMS[{0!r}]'.format(perm_name),
+                lambda i: perm(self._org_user(i))
+            )
+            self.assertEqual(queries, 0, perm_name)
+
+    def _bench_has_perm(self, label):
+        for perm_name in sorted(decorators.PERMS):
+            view = decorators.has_perm(perm_name)(_view)
+
+            def call(i):
+                org_user = self._org_user(i)
+                view(FakeQueryRequest(org_user.user, org_user.organization_id))
+
+            self._bench('has_perm({0!r}){1}'.format(perm_name, label), call)
+
+    def test_has_perm(self):
+        self._bench_has_perm('')
+
+    @override_settings(SUPERPERMS_ROLE_CACHE='default')
+    def test_has_perm_role_cache(self):
+        self._bench_has_perm(' [role cache]')
+
+    def test_check_perms(self):
+        org_ids = [org.pk for org in self.orgs]
+        perm_names = sorted(decorators.PERMS)
+        self._bench(
+            'check_perms(all orgs, all perms)',
+            lambda i: decorators.check_perms(
+                self._user(i), org_ids, perm_names
+            )
+        )
+
+    def test_organization_helpers(self):
+        some_users = self.users[:10]
+        helpers = [
+            ('is_member', lambda i: self._org(i).is_member(self._user(i))),
+            ('filter_members',
+             lambda i: list(self._org(i).filter_members(some_users))),
+            ('get_member_roles',
+             lambda i: self._org(i).get_member_roles(some_users)),
+            ('get_member_role',
+             lambda i: self._org(i).get_member_role(self._user(i))),
+            ('is_owner', lambda i: self._org(i).is_owner(self._user(i))),
+            ('get_exportable_fields',
+             lambda i: list(self._org(i).get_exportable_fields())),
+            ('get_query_threshold',
+             lambda i: self._org(i).get_query_threshold()),
+            ('is_parent', lambda i: self._org(i).is_parent),
+            ('get_parent', lambda i: self._org(i).get_parent()),
+        ]
+        for name, fn in helpers:
+            self._bench('Organization.{0}'.format(name), fn)
+
+    def test_with_perm(self):
+        for perm_name in sorted(decorators.PERMS):
+            self._bench(
+                'Organization.objects.with_perm({0!r})'.format(perm_name),
+                lambda i: Organization.objects.with_perm(
+                    self._user(i), perm_name
+                ).count()
+            )
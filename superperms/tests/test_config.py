@@ -0,0 +1,325 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+from django.core.cache import caches
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.unittest import TestCase
+
+from superperms.orgs import cache as org_cache
+from superperms.orgs import config
+from superperms.orgs.models import Organization
+from superperms.orgs.utils import FrozenMapping
+
+
+class TestConfigChanges(TestCase):
+
+    def test_split_path(self):
+        self.assertEqual(config.split_path('a.b'), ['a', 'b'])
+        self.assertEqual(config.split_path(('a', 1)), ['a', '1'])
+        self.assertEqual(config.split_path(''), [])
+
+    def test_apply_change(self):
+        saved = {'a': {'b': 1}, 'c': 'x'}
+        self.assertEqual(
+            config.apply_change(saved, config.SET, ['a', 'd'], [1]),
+            {'a': {'b': 1, 'd': [1]}, 'c': 'x'}
+        )
+        # Non-objects in the way are replaced.
+        self.assertEqual(
+            config.apply_change(saved, config.SET, ['c', 'd'], 2),
+            {'a': {'b': 1}, 'c': {'d': 2}}
+        )
+        self.assertEqual(
+            config.apply_change(saved, config.DELETE, ['a', 'b']),
+            {'a': {}, 'c': 'x'}
+        )
+        self.assertEqual(
+            config.apply_change(saved, config.DELETE, ['c', 'd']), saved
+        )
+        self.assertEqual(
+            config.apply_change(saved, config.MERGE, [], {'c': 'y', 'e': 1}),
+            {'a': {'b': 1}, 'c': 'y', 'e': 1}
+        )
+        self.assertEqual(
+            config.apply_change(None, config.MERGE, ['f'], {'g': 1}),
+            {'f': {'g': 1}}
+        )
+        # The original is left alone.
+        self.assertEqual(saved, {'a': {'b': 1}, 'c': 'x'})
+
+    def test_change_sql(self):
+        sql, params = config.change_sql('c', config.SET, ['a', 'b'], True)
+        self.assertTrue(sql.startswith('jsonb_set(jsonb_set('))
+        self.assertEqual(sql.count('%s'), len(params))
+        self.assertEqual(params[-2:], [['a', 'b'], 'true'])
+
+        sql, params = config.change_sql('c', config.DELETE, ['a'])
+        self.assertEqual((sql, params), ('c #- %s::text[]', [['a']]))
+
+        sql, params = config.change_sql('c', config.MERGE, [], {'a': 1})
+        self.assertTrue(sql.endswith('|| %s::jsonb'))
+        self.assertEqual(sql.count('%s'), len(params))
+
+    def test_merge(self):
+        merged = config.merge(
+            {'a': {'b': 1, 'c': 2}, 'd': [1]},
+            {'a': {'c': 3}, 'd': 'x', 'e': [{'f': 1}]}
+        )
+        self.assertEqual(merged['a'], {'b': 1, 'c': 3})
+        self.assertEqual(merged['d'], 'x')
+        self.assertEqual(merged['e'][0]['f'], 1)
+        self.assertIsInstance(merged['e'], tuple)
+        self.assertIsInstance(merged['e'][0], FrozenMapping)
+        self.assertEqual(dict(config.merge(None, None)), {})
+
+
+class TestOrganizationConfig(TestCase):
+
+    def setUp(self):
+        self.org = Organization.objects.create(
+            name='Org', config={'features': {'export': False}, 'big': 'x'}
+        )
+
+    def tearDown(self):
+        Organization.objects.all().delete()
+
+    def _saved(self):
+        return Organization.objects.get(pk=self.org.pk).config
+
+    def test_set_config(self):
+        self.org.set_config('features.export', True)
+        self.org.set_config(['limits', 'rows'], 10)
+        expected = {
+            'features': {'export': True},
+            'limits': {'rows': 10},
+            'big': 'x',
+        }
+        self.assertEqual(self.org.config, expected)
+        self.assertEqual(self._saved(), expected)
+        self.assertRaises(ValueError, self.org.set_config, '', 1)
+
+    def test_delete_config(self):
+        self.org.delete_config('features.export')
+        self.org.delete_config('missing.key')
+        self.assertEqual(self._saved(), {'features': {}, 'big': 'x'})
+        self.assertEqual(self.org.config, self._saved())
+
+    def test_merge_config(self):
+        self.org.merge_config({'import': True}, 'features')
+        self.org.merge_config({'big': 'y'})
+        self.assertEqual(
+            self._saved(),
+            {'features': {'export': False, 'import': True}, 'big': 'y'}
+        )
+        self.assertRaises(TypeError, self.org.merge_config, ['nope'])
+
+    def test_keeps_others_changes(self):
+        """Edits to different keys from stale copies don't clobber."""
+        stale = Organization.objects.get(pk=self.org.pk)
+        self.org.set_config('a', 1)
+        stale.set_config('b', 2)
+        self.assertEqual(self._saved()['a'], 1)
+        self.assertEqual(stale.config['a'], 1)
+
+    def test_writes_only_config(self):
+        self.org.name = 'Unsaved'
+        with CaptureQueriesContext(connection) as ctx:
+            self.org.set_config('a', 1)
+        update = [
+            query['sql'] for query in ctx.captured_queries
+            if 'UPDATE' in query['sql']
+        ]
+        self.assertEqual(len(update), 1)
+        self.assertNotIn('"name"', update[0])
+        self.assertEqual(Organization.objects.get(pk=self.org.pk).name, 'Org')
+
+
+class TestEffectiveConfig(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.parent = Organization.objects.create(
+            name='Parent',
+            config={'features': {'export': True, 'beta': False}, 'rows': 10}
+        )
+        self.child = Organization.objects.create(
+            name='Child', parent_org=self.parent,
+            config={'features': {'beta': True}, 'tags': ['a']}
+        )
+
+    def tearDown(self):
+        Organization.objects.all().delete()
+        caches['default'].clear()
+
+    def _fresh(self, org):
+        return Organization.objects.get(pk=org.pk)
+
+    def test_merged_over_parent(self):
+        config = self._fresh(self.child).get_effective_config()
+        self.assertEqual(config['features']['export'], True)
+        self.assertEqual(config['features']['beta'], True)
+        self.assertEqual(config['rows'], 10)
+        self.assertEqual(config['tags'], ('a',))
+        self.assertEqual(
+            dict(self.parent.get_effective_config()['features']),
+            {'export': True, 'beta': False}
+        )
+
+    def test_read_only(self):
+        config = self.child.get_effective_config()
+        self.assertIsInstance(config, FrozenMapping)
+        self.assertIsInstance(config['features'], FrozenMapping)
+        self.assertFalse(hasattr(config, '__setitem__'))
+
+    def test_not_a_dict(self):
+        Organization.objects.filter(pk=self.child.pk).update(config=None)
+        self.assertEqual(
+            self._fresh(self.child).get_effective_config()['rows'], 10
+        )
+
+    @override_settings(SUPERPERMS_CONFIG_CACHE='default')
+    def test_cached(self):
+        child = self._fresh(self.child)
+        child.get_effective_config()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                self._fresh(self.child).get_effective_config()['rows'], 10
+            )
+        # Just loading the child.
+        self.assertEqual(len(ctx), 1)
+
+        # The parent's entry is used for a child that isn't cached yet.
+        other = Organization.objects.create(
+            name='Other', parent_org=self.parent
+        )
+        self.parent.get_effective_config()
+        other = self._fresh(other)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(other.get_effective_config()['rows'], 10)
+        self.assertEqual(len(ctx), 0)
+
+    @override_settings(SUPERPERMS_CONFIG_CACHE='default')
+    def test_invalidated(self):
+        self.child.get_effective_config()
+        self.parent.config['rows'] = 20
+        self.parent.save()
+        self.assertEqual(
+            self._fresh(self.child).get_effective_config()['rows'], 20
+        )
+
+        self.parent.set_config('rows', 30)
+        self.assertEqual(self.child.get_effective_config()['rows'], 30)
+        self.child.merge_config({'rows': 5})
+        self.assertEqual(self.child.get_effective_config()['rows'], 5)
+        self.child.delete_config('rows')
+        self.assertEqual(self.child.get_effective_config()['rows'], 30)
+
+        self.child.parent_org = None
+        self.child.save()
+        self.assertNotIn('rows', self.child.get_effective_config())
+
+    @override_settings(
+        SUPERPERMS_CONFIG_CACHE='default', SUPERPERMS_CONFIG_CACHE_TIMEOUT=0
+    )
+    def test_expires(self):
+        self.child.get_effective_config()
+        self.assertIsNone(org_cache.get_effective_config(self.child.pk))
+
+    @override_settings(SUPERPERMS_CONFIG_CACHE='default')
+    def test_invalidated_after_commit(self):
+        """A config re-cached before a save commits is dropped again."""
+        def cache_stale_config(sender, **kwargs):
+            # As another connection could, seeing the old rows.
+            org_cache.set_effective_config(
+                self.parent.pk, config.merge({}, {'rows': 10})
+            )
+
+        post_save.connect(cache_stale_config, sender=Organization)
+        try:
+            self.parent.config['rows'] = 20
+            self.parent.save()
+        finally:
+            post_save.disconnect(cache_stale_config, sender=Organization)
+        self.assertEqual(
+            self._fresh(self.child).get_effective_config()['rows'], 20
+        )
+
+
+class TestConfigFilters(TestCase):
+
+    def setUp(self):
+        self.gold = Organization.objects.create(name='Gold', config={
+            'plan': 'gold',
+            'features': {'export': True, 'beta': None},
+            'limits': {'rows': 100},
+            'tags': ['a', 'b', 1],
+        })
+        self.free = Organization.objects.create(name='Free', config={
+            'plan': 'free',
+            'features': {'export': False},
+            'limits': {'rows': '100'},
+            'tags': ['a'],
+        })
+        self.empty = Organization.objects.create(name='Empty', config=None)
+
+    def tearDown(self):
+        Organization.objects.all().delete()
+
+    def _names(self, queryset):
+        return sorted(queryset.values_list('name', flat=True))
+
+    def test_with_config_key(self):
+        orgs = Organization.objects
+        self.assertEqual(
+            self._names(orgs.with_config_key('plan')), ['Free', 'Gold']
+        )
+        self.assertEqual(
+            self._names(orgs.with_config_key('features.beta')), ['Gold']
+        )
+        self.assertEqual(self._names(orgs.with_config_key(['nope'])), [])
+        self.assertRaises(ValueError, orgs.with_config_key, '')
+
+    def test_with_config(self):
+        orgs = Organization.objects
+        self.assertEqual(
+            self._names(orgs.with_config({'features': {'export': True}})),
+            ['Gold']
+        )
+        self.assertEqual(
+            self._names(orgs.with_config({'features': {'beta': None}})),
+            ['Gold']
+        )
+        # Types have to match, too.
+        self.assertEqual(
+            self._names(orgs.with_config({'limits': {'rows': 100}})),
+            ['Gold']
+        )
+        self.assertEqual(
+            self._names(orgs.with_config({'limits': {'rows': '100'}})),
+            ['Free']
+        )
+        self.assertEqual(
+            self._names(orgs.with_config({'tags': ['a']})), ['Free', 'Gold']
+        )
+        self.assertEqual(
+            self._names(orgs.with_config({'tags': [1, 'b']})), ['Gold']
+        )
+        self.assertEqual(
+            self._names(orgs.with_config({'plan': 'gold', 'tags': ['c']})),
+            []
+        )
+        self.assertEqual(
+            self._names(orgs.with_config({})), ['Free', 'Gold']
+        )
+        self.assertRaises(TypeError, orgs.with_config, ['a'])
+
+    def test_chains(self):
+        self.assertEqual(
+            self._names(Organization.objects.filter(
+                name__startswith='G'
+            ).with_config_key('plan').with_config({'plan': 'gold'})),
+            ['Gold']
+        )
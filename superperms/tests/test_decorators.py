@@ -5,9 +5,14 @@
 import json
 
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils.unittest import TestCase
 from django.http import HttpResponse, HttpResponseForbidden
 
+from superperms.orgs import cache as org_cache
 from superperms.orgs import decorators
 from superperms.orgs.models import (
     ROLE_VIEWER,
@@ -16,6 +21,7 @@ from superperms.orgs.models import (
     Organization,
     OrganizationUser,
 )
+from superperms.orgs.utils import flush_after_commit
 
 #
 # Copied wholesale from django-brake's tests
@@ -31,8 +37,17 @@ class FakeRequest(object):
     body = None
 
     def __init__(self, headers=None):
-        if headers:
-            self.META.update(headers)
+        # Don't leak one test's headers into the next via the class attr.
+        self.META = dict(self.META, **(headers or {}))
+
+
+class FakeQueryRequest(FakeRequest):
+    """A request from ``user`` carrying ``org_id`` in the query string."""
+
+    def __init__(self, user, org_id):
+        super(FakeQueryRequest, self).__init__()
+        self.user = user
+        self.GET = {'organization_id': org_id}
 
 
 class FakeClient(object):
@@ -70,10 +85,35 @@ def _fake_invite_user(request):
     return HttpResponse()
 
 
+@decorators.has_perm('requires_owner')
+def _fake_owner_view(request):
+    return HttpResponse()
+
+
+@decorators.has_perm('requires_member')
+@decorators.has_perm('can_modify_data')
+@decorators.has_perm('requires_viewer')
+def _fake_stacked_view(request):
+    return HttpResponse()
+
+
+@decorators.has_perm('can_invite_member', org_id_sources=('kwargs',))
+def _fake_kwargs_view(request, organization_id):
+    return HttpResponse()
+
+
+@decorators.has_perm('requires_member')
+def _fake_org_user_view(request):
+    resp = HttpResponse()
+    resp.org_user = decorators.get_org_user(request)
+    return resp
+
+
 class TestDecorators(TestCase):
 
     def setUp(self):
         super(TestDecorators, self).setUp()
+        caches['default'].clear()
         self.client = FakeClient()
         self.fake_org = Organization.objects.create(name='fake org')
         self.fake_member = User.objects.create(
@@ -119,6 +159,7 @@ class TestDecorators(TestCase):
         User.objects.all().delete()
         Organization.objects.all().delete()
         OrganizationUser.objects.all().delete()
+        caches['default'].clear()
         super(TestDecorators, self).tearDown()
 
     # Test has_perm in various permutations.
@@ -207,6 +248,385 @@ class TestDecorators(TestCase):
 
         self.assertEqual(resp.__class__, HttpResponse)
 
+    def test_has_perm_stacked_decorators_share_lookups(self):
+        """Stacked decorators only look up the org and membership once."""
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.post(
+                _fake_stacked_view,
+                {'organization_id': self.fake_org.pk},
+                user=self.fake_member
+            )
+
+        self.assertEqual(resp.__class__, HttpResponse)
+        # The org and the membership come back together.
+        self.assertEqual(len(ctx), 1)
+
+    def test_get_org_user_reuses_decorator_lookup(self):
+        """Views can get the decorator's membership without a query."""
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.post(
+                _fake_org_user_view,
+                {'organization_id': self.fake_org.pk},
+                user=self.fake_member
+            )
+            self.assertEqual(resp.org_user, self.member_org_user)
+            self.assertEqual(resp.org_user.organization, self.fake_org)
+
+        self.assertEqual(len(ctx), 1)
+
+    def test_has_perm_child_org_single_query(self):
+        """Parent ownership is resolved in the same query as the role."""
+        baby_org = Organization.objects.create(
+            name='baby', parent_org=self.fake_org
+        )
+        OrganizationUser.objects.create(
+            user=self.fake_owner, organization=baby_org, role_level=ROLE_VIEWER
+        )
+        OrganizationUser.objects.create(
+            user=self.fake_member, organization=baby_org, role_level=ROLE_OWNER
+        )
+
+        # A parent owner, and an owner of just the child.
+        for user in (self.fake_owner, self.fake_member):
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.post(
+                    _fake_owner_view,
+                    {'organization_id': baby_org.pk},
+                    user=user
+                )
+            self.assertEqual(resp.__class__, HttpResponse)
+            self.assertEqual(len(ctx), 1)
+
+        resp = self.client.post(
+            _fake_owner_view,
+            {'organization_id': baby_org.pk},
+            user=self.fake_viewer
+        )
+        self.assertEqual(resp.status_code, 403)
+
+    def test_with_perm_context_checks_take_no_queries(self):
+        """Every built-in perm can be checked without touching the DB."""
+        baby_org = Organization.objects.create(
+            name='baby', parent_org=self.fake_org
+        )
+        OrganizationUser.objects.create(
+            user=self.fake_owner, organization=baby_org, role_level=ROLE_VIEWER
+        )
+        org_users = OrganizationUser.objects.with_perm_context().filter(
+            user=self.fake_owner
+        )
+
+        with CaptureQueriesContext(connection) as ctx:
+            org_users = list(org_users)
+            for org_user in org_users:
+                # ``requires_superuser`` looks at the user.
+                org_user.user = self.fake_owner
+                for perm in decorators.PERMS.values():
+                    perm(org_user)
+
+        self.assertEqual(len(ctx), 1)
+        baby_ou = [ou for ou in org_users if ou.organization == baby_org][0]
+        self.assertTrue(decorators.requires_owner(baby_ou))
+        self.assertTrue(decorators.can_modify_org_settings(baby_ou))
+        self.assertFalse(decorators.can_invite_member(baby_ou))
+
+    def test_get_org_user_not_in_org(self):
+        """We get None back for a user without a relationship to the org."""
+        request = self.client.post(
+            None, {'organization_id': self.fake_org.pk},
+            user=User.objects.create(username='f', email='d@d.com')
+        )
+        request.GET = {'organization_id': self.fake_org.pk}
+
+        self.assertIsNone(decorators.get_org_user(request))
+
+    def test_has_perm_org_id_sources(self):
+        """Decorators can be told to only look in the URL kwargs."""
+        request = self.client.post(
+            None, {'organization_id': 0}, user=self.fake_owner
+        )
+        request.GET = {}
+
+        resp = _fake_kwargs_view(request, organization_id=self.fake_org.pk)
+        self.assertEqual(resp.__class__, HttpResponse)
+
+        request = self.client.post(
+            None, {'organization_id': self.fake_org.pk}, user=self.fake_owner
+        )
+        request.GET = {}
+        resp = _fake_kwargs_view(request, organization_id=0)
+        self.assertEqual(resp.status_code, 403)
+
+    def test_has_perm_ignores_org_header_by_default(self):
+        """A header naming another org can't vouch for the body's org."""
+        other_org = Organization.objects.create(name='other org')
+        OrganizationUser.objects.create(
+            user=self.fake_owner, organization=other_org,
+            role_level=ROLE_VIEWER
+        )
+        headers = {'HTTP_X_ORGANIZATION_ID': str(self.fake_org.pk)}
+
+        resp = self.client.post(
+            _fake_invite_user, {'organization_id': other_org.pk},
+            headers=headers, user=self.fake_owner
+        )
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.post(
+            _fake_invite_user, {'organization_id': self.fake_org.pk},
+            headers=headers, user=self.fake_owner
+        )
+        self.assertEqual(resp.__class__, HttpResponse)
+
+    def test_has_perm_repeated_body_org_id(self):
+        """The last of a repeated organization_id is checked, as parsed."""
+        other_org = Organization.objects.create(name='other org')
+        OrganizationUser.objects.create(
+            user=self.fake_owner, organization=other_org,
+            role_level=ROLE_VIEWER
+        )
+        request = self.client.post(None, {}, user=self.fake_owner)
+        request.GET = {}
+        request.body = (
+            '{{"organization_id": {0}, "organization_id": {1}}}'.format(
+                self.fake_org.pk, other_org.pk
+            )
+        )
+        self.assertEqual(_fake_invite_user(request).status_code, 403)
+
+    @override_settings(SUPERPERMS_ROLE_CACHE='default')
+    def test_has_perm_role_cache(self):
+        """With the role cache on, repeat checks skip the database."""
+        data = {'organization_id': self.fake_org.pk}
+        self.client.post(_fake_invite_user, data, user=self.fake_owner)
+
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.post(
+                _fake_invite_user, data, user=self.fake_owner
+            )
+
+        self.assertEqual(resp.__class__, HttpResponse)
+        self.assertEqual(len(ctx), 0)
+
+    @override_settings(SUPERPERMS_ROLE_CACHE='default')
+    def test_has_perm_role_cache_invalidated_on_role_change(self):
+        """Changing a role drops the cached copy."""
+        data = {'organization_id': self.fake_org.pk}
+        resp = self.client.post(_fake_invite_user, data, user=self.fake_owner)
+        self.assertEqual(resp.__class__, HttpResponse)
+
+        self.owner_org_user.role_level = ROLE_MEMBER
+        self.owner_org_user.save()
+
+        resp = self.client.post(_fake_invite_user, data, user=self.fake_owner)
+        self.assertEqual(resp.status_code, 403)
+
+    @override_settings(SUPERPERMS_ROLE_CACHE='default')
+    def test_has_perm_role_cache_invalidated_after_commit(self):
+        """A role re-cached before a change commits is dropped again."""
+        data = {'organization_id': self.fake_org.pk}
+        stale = OrganizationUser.objects.get(pk=self.owner_org_user.pk)
+
+        def cache_stale_role(sender, **kwargs):
+            # Another connection, which can't see the change yet.
+            org_cache.set_role(stale, True, False)
+
+        post_save.connect(cache_stale_role, sender=OrganizationUser)
+        try:
+            self.owner_org_user.role_level = ROLE_MEMBER
+            self.owner_org_user.save()
+        finally:
+            post_save.disconnect(cache_stale_role, sender=OrganizationUser)
+        resp = self.client.post(_fake_invite_user, data, user=self.fake_owner)
+        self.assertEqual(resp.status_code, 403)
+
+        # Inside our own transaction, it's up to us to flush.
+        with transaction.atomic():
+            self.owner_org_user.role_level = ROLE_OWNER
+            self.owner_org_user.save()
+            stale.role_level = ROLE_MEMBER
+            org_cache.set_role(stale, True, False)
+        flush_after_commit()
+        resp = self.client.post(_fake_invite_user, data, user=self.fake_owner)
+        self.assertEqual(resp.__class__, HttpResponse)
+
+    @override_settings(SUPERPERMS_ROLE_CACHE='default')
+    def test_has_perm_role_cache_kept_on_rename(self):
+        """Saving an org that stays put leaves its members' roles alone."""
+        data = {'organization_id': self.fake_org.pk}
+        self.client.post(_fake_invite_user, data, user=self.fake_owner)
+
+        self.fake_org.name = 'renamed'
+        with CaptureQueriesContext(connection) as ctx:
+            self.fake_org.save()
+        self.assertFalse(any(
+            'orgs_organizationuser' in query['sql']
+            for query in ctx.captured_queries
+        ))
+
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.post(
+                _fake_invite_user, data, user=self.fake_owner
+            )
+        self.assertEqual(resp.__class__, HttpResponse)
+        self.assertEqual(len(ctx), 0)
+
+    @override_settings(SUPERPERMS_ROLE_CACHE='default')
+    def test_has_perm_role_cache_invalidated_on_parent_change(self):
+        """Losing ownership of a parent org drops child org roles."""
+        baby_org = Organization.objects.create(
+            name='baby', parent_org=self.fake_org
+        )
+        OrganizationUser.objects.create(
+            user=self.fake_owner, organization=baby_org, role_level=ROLE_MEMBER
+        )
+        data = {'organization_id': baby_org.pk}
+        resp = self.client.post(_fake_owner_view, data, user=self.fake_owner)
+        self.assertEqual(resp.__class__, HttpResponse)
+
+        self.owner_org_user.role_level = ROLE_MEMBER
+        self.owner_org_user.save()
+
+        resp = self.client.post(_fake_owner_view, data, user=self.fake_owner)
+        self.assertEqual(resp.status_code, 403)
+
+        # Moving the child under a parent we own restores the perm.
+        other_org = Organization.objects.create(name='other')
+        OrganizationUser.objects.create(
+            user=self.fake_owner, organization=other_org
+        )
+        baby_org.parent_org = other_org
+        baby_org.save()
+
+        resp = self.client.post(_fake_owner_view, data, user=self.fake_owner)
+        self.assertEqual(resp.__class__, HttpResponse)
+
+    def test_check_perms(self):
+        """We get an org by perm matrix matching the individual perms."""
+        baby_org = Organization.objects.create(
+            name='baby', parent_org=self.fake_org
+        )
+        OrganizationUser.objects.create(
+            user=self.fake_owner, organization=baby_org, role_level=ROLE_VIEWER
+        )
+        stranger_org = Organization.objects.create(name='stranger')
+        perm_names = ['requires_owner', 'can_invite_member', 'derp']
+
+        matrix = decorators.check_perms(
+            self.fake_owner,
+            [self.fake_org.pk, baby_org.pk, stranger_org.pk],
+            perm_names
+        )
+
+        self.assertDictEqual(matrix, {
+            self.fake_org.pk: {
+                'requires_owner': True,
+                'can_invite_member': True,
+                'derp': False,
+            },
+            baby_org.pk: {
+                'requires_owner': True,
+                'can_invite_member': False,
+                'derp': False,
+            },
+            stranger_org.pk: {
+                'requires_owner': False,
+                'can_invite_member': False,
+                'derp': False,
+            },
+        })
+
+    def test_check_perms_constant_queries(self):
+        """Asking about more orgs doesn't cost more queries."""
+        org_ids = []
+        for x in range(10):
+            org = Organization.objects.create(name='org-{0}'.format(x))
+            org.add_member(self.fake_member, role=ROLE_MEMBER)
+            org_ids.append(org.pk)
+
+        with CaptureQueriesContext(connection) as ctx:
+            matrix = decorators.check_perms(
+                self.fake_member, org_ids, list(decorators.PERMS)
+            )
+
+        self.assertEqual(len(ctx), 1)
+        for org_id in org_ids:
+            self.assertTrue(matrix[org_id]['can_modify_data'])
+            self.assertFalse(matrix[org_id]['requires_owner'])
+
+    def test_check_perms_super_user(self):
+        """Super users may do anything, as with ``has_perm``."""
+        matrix = decorators.check_perms(
+            self.fake_superuser, [self.fake_org.pk], ['requires_owner']
+        )
+
+        self.assertTrue(matrix[self.fake_org.pk]['requires_owner'])
+
+    def test_compiled_rules_match_rules(self):
+        """Every precomputed bitset agrees with evaluating the rules."""
+        compiled = decorators._compiled
+        for level_index, level in enumerate(compiled['levels']):
+            for flags, mask in enumerate(compiled['masks'][level_index]):
+                for name, rule in decorators.PERM_RULES.items():
+                    self.assertEqual(
+                        bool(mask & compiled['bits'][name]),
+                        decorators._rule_grants(rule, level, flags),
+                        (name, level, flags)
+                    )
+
+    def test_unlisted_role_levels(self):
+        """Roles between the standard levels get what they're above."""
+        self.member_org_user.role_level = ROLE_MEMBER + 5
+        self.assertTrue(decorators.can_modify_data(self.member_org_user))
+        self.assertFalse(decorators.can_invite_member(self.member_org_user))
+
+        self.member_org_user.role_level = ROLE_VIEWER - 5
+        self.assertFalse(decorators.can_view_data(self.member_org_user))
+
+    def test_register_perm(self):
+        """Custom perms go in the same table as the built-in ones."""
+        decorators.register_perm(
+            'can_approve', min_role=ROLE_MEMBER + 5, parent_owner=True
+        )
+        try:
+            self.assertIn('can_approve', decorators.PERMS)
+            self.assertFalse(
+                decorators.PERMS['can_approve'](self.member_org_user)
+            )
+            self.member_org_user.role_level = ROLE_MEMBER + 5
+            self.assertTrue(
+                decorators.PERMS['can_approve'](self.member_org_user)
+            )
+            self.assertTrue(
+                decorators.PERMS['can_approve'](self.owner_org_user)
+            )
+
+            baby_org = Organization.objects.create(
+                name='baby', parent_org=self.fake_org
+            )
+            baby_ou = OrganizationUser.objects.create(
+                user=self.fake_owner,
+                organization=baby_org,
+                role_level=ROLE_VIEWER
+            )
+            self.assertTrue(decorators.PERMS['can_approve'](baby_ou))
+            self.assertEqual(
+                decorators.check_perms(
+                    self.fake_owner, [baby_org.pk], ['can_approve']
+                ),
+                {baby_org.pk: {'can_approve': True}}
+            )
+            self.assertEqual(
+                list(Organization.objects.with_perm(
+                    self.fake_owner, 'can_approve'
+                )),
+                [baby_org, self.fake_org]
+            )
+        finally:
+            del decorators.PERM_RULES['can_approve']
+            del decorators.PERMS['can_approve']
+            decorators._compile_rules()
+
     # Test boolean functions for permission logic.
 
     def test_requires_parent_org_owner(self):
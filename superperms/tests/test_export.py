@@ -0,0 +1,156 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+import csv
+import json
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import six
+from django.utils.unittest import TestCase
+
+from superperms.orgs import export
+from superperms.orgs.models import (
+    ExportableField,
+    Organization,
+    OrganizationUser,
+)
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        self.org = Organization.objects.create(name='Org')
+        for model, name in (
+            ('User', 'email'),
+            ('User', 'username'),
+            ('User', 'password__startswith'),
+            ('User', 'nope'),
+            ('OrganizationUser', 'organization__name'),
+            ('OrganizationUser', 'organization__parent_org__name'),
+            ('OrganizationUser', 'role_level'),
+            ('Organization', 'child_orgs__name'),
+            ('Organization', 'users__username'),
+            ('Organization', 'parent_org__child_orgs__name'),
+            ('Organization', 'parent_org__users'),
+        ):
+            ExportableField.objects.create(
+                organization=self.org, field_model=model, name=name
+            )
+        self.users = [
+            User.objects.create(
+                username=u'user-{0}'.format(x),
+                email=u'us\xe9r-{0}@demo.com'.format(x) if x % 2 else ''
+            )
+            for x in range(5)
+        ]
+
+    def tearDown(self):
+        ExportableField.objects.all().delete()
+        Organization.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_export_fields(self):
+        """Allowed fields in declaration order; unknown names dropped."""
+        self.assertEqual(
+            export.export_fields(self.org, User), ['username', 'email']
+        )
+        self.assertEqual(export.export_fields(self.org, Organization), [])
+        self.assertEqual(
+            export.export_fields(self.org, OrganizationUser),
+            [
+                'role_level', 'organization__name',
+                'organization__parent_org__name'
+            ]
+        )
+
+    def test_no_many_valued_lookups(self):
+        """Lookups giving several rows per object would break paging."""
+        for name in self.org.get_exportable_field_names()['Organization']:
+            self.assertRaises(
+                ValueError, export.iter_rows,
+                self.org, Organization.objects.all(), [name]
+            )
+        for x in range(3):
+            Organization.objects.create(
+                name='Child {0}'.format(x), parent_org=self.org
+            )
+        OrganizationUser.objects.create(
+            user=self.users[0], organization=self.org
+        )
+        OrganizationUser.objects.create(
+            user=self.users[1], organization=Organization.objects.get(
+                name='Child 0'
+            )
+        )
+        rows = list(export.iter_rows(
+            self.org, OrganizationUser.objects.all(),
+            ['organization__name', 'organization__parent_org__name'],
+            chunk_size=1
+        ))
+        self.assertEqual(rows, [('Org', None), ('Child 0', 'Org')])
+
+    def test_iter_rows(self):
+        rows = list(export.iter_rows(self.org, User.objects.all()))
+        self.assertEqual(
+            rows, [(user.username, user.email) for user in self.users]
+        )
+
+        self.assertEqual(
+            list(export.iter_rows(
+                self.org, User.objects.filter(pk=self.users[1].pk),
+                fields=['email']
+            )),
+            [(self.users[1].email,)]
+        )
+        self.assertRaises(
+            ValueError, export.iter_rows,
+            self.org, User.objects.all(), ['username', 'password']
+        )
+        self.assertEqual(
+            list(export.iter_rows(self.org, Organization.objects.all())), []
+        )
+
+    def test_chunks(self):
+        """Rows are fetched a chunk at a time, whatever the ordering."""
+        queryset = User.objects.order_by('-username')
+        with CaptureQueriesContext(connection) as ctx:
+            rows = list(export.iter_rows(self.org, queryset, chunk_size=2))
+        self.assertEqual(
+            [row[0] for row in rows], [user.username for user in self.users]
+        )
+        # One for the exportable fields, then three chunks.
+        self.assertEqual(len(ctx), 4)
+        for query in ctx.captured_queries[1:]:
+            self.assertNotIn('password', query['sql'])
+            self.assertIn('LIMIT 2', query['sql'])
+
+    def test_csv(self):
+        out = six.BytesIO() if six.PY2 else six.StringIO()
+        written = export.write_csv(
+            self.org, User.objects.all(), out, chunk_size=3
+        )
+        self.assertEqual(written, 5)
+
+        out.seek(0)
+        rows = list(csv.reader(out))
+        if six.PY2:
+            rows = [[cell.decode('utf-8') for cell in row] for row in rows]
+        self.assertEqual(rows[0], ['username', 'email'])
+        self.assertEqual(
+            rows[1:], [[user.username, user.email] for user in self.users]
+        )
+
+    def test_jsonl(self):
+        out = six.StringIO()
+        written = export.write_jsonl(
+            self.org, User.objects.filter(email__contains='@'), out
+        )
+        self.assertEqual(written, 2)
+        self.assertEqual(
+            [json.loads(line) for line in out.getvalue().splitlines()],
+            [{'username': user.username, 'email': user.email}
+             for user in self.users[1::2]]
+        )
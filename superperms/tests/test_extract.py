@@ -0,0 +1,188 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+import json
+
+from django.test.utils import override_settings
+from django.utils.unittest import TestCase
+
+from superperms.orgs import extract
+
+
+class FakeRequest(object):
+    """A request with nothing but a body, headers and a query string."""
+
+    def __init__(self, body, META=None, GET=None):
+        self.body = body
+        self.META = META or {}
+        self.GET = GET or {}
+
+
+class UnreadableRequest(FakeRequest):
+    """Blows up if anybody reads the body."""
+
+    @property
+    def body(self):
+        raise AssertionError('Body was read')
+
+    @body.setter
+    def body(self, value):
+        pass
+
+
+class TestScanTopLevelKey(TestCase):
+
+    def test_finds_key(self):
+        """We pull out a top-level value regardless of its position."""
+        doc = json.dumps({
+            'rows': [{'organization_id': 'nested'}, [1, 2, {'a': '}'}]],
+            'name': 'a "quoted" {string}',
+            'flag': True,
+            'nothing': None,
+            'organization_id': 42,
+        })
+        self.assertEqual(
+            extract.scan_top_level_key(doc, 'organization_id'), 42
+        )
+
+    def test_missing_key(self):
+        """Nested keys of the same name don't count."""
+        doc = json.dumps({'rows': [{'organization_id': 1}], 'n': 1.5})
+        self.assertIs(
+            extract.scan_top_level_key(doc, 'organization_id'),
+            extract.MISSING
+        )
+        self.assertIs(
+            extract.scan_top_level_key('[1, 2]', 'organization_id'),
+            extract.MISSING
+        )
+        self.assertIs(
+            extract.scan_top_level_key(' { } ', 'organization_id'),
+            extract.MISSING
+        )
+
+    def test_repeated_key(self):
+        """The last of a repeated key wins, as with a full parse."""
+        doc = '{"organization_id": 1, "rows": [2], "organization_id": 3}'
+        self.assertEqual(
+            extract.scan_top_level_key(doc, 'organization_id'),
+            json.loads(doc)['organization_id']
+        )
+        # So we can't stop at the first one.
+        self.assertRaises(
+            ValueError, extract.scan_top_level_key,
+            '{"organization_id": "7", "rows": [this is not json',
+            'organization_id'
+        )
+
+    def test_malformed(self):
+        """Truncated or broken JSON raises ValueError."""
+        for doc in ('{"rows": [1, 2', '{"rows" 1}', '{"a": 1 "b": 2}', ''):
+            self.assertRaises(
+                ValueError,
+                extract.scan_top_level_key, doc, 'organization_id'
+            )
+
+
+class TestFindBodyOrgId(TestCase):
+
+    def test_find_body_org_id(self):
+        request = FakeRequest(json.dumps(
+            {'organization_id': 3, 'rows': list(range(100))}
+        ))
+        self.assertEqual(extract.find_body_org_id(request), 3)
+        # Scanning doesn't count as a full parse.
+        self.assertNotIn('json_body', extract.request_cache(request))
+
+    def test_not_json(self):
+        self.assertIsNone(extract.find_body_org_id(FakeRequest('a=b&c=d')))
+        self.assertIsNone(extract.find_body_org_id(FakeRequest('')))
+        self.assertIsNone(extract.find_body_org_id(FakeRequest(None)))
+
+    def test_repeated_key(self):
+        """has_perm checks the org a view parsing the body would act on."""
+        request = FakeRequest(
+            '{"organization_id": 1, "name": "x", "organization_id": 2}'
+        )
+        self.assertEqual(extract.find_body_org_id(request), 2)
+        self.assertEqual(
+            extract.get_json_body(request)['organization_id'], 2
+        )
+
+    def test_scan_limit(self):
+        """Bodies over the scan limit aren't scanned."""
+        body = '{"rows": ' + json.dumps(list(range(100))) + \
+            ', "organization_id": 3}'
+        request = FakeRequest(body)
+
+        with override_settings(SUPERPERMS_ORG_ID_SCAN_LIMIT=len(body) - 1):
+            self.assertIsNone(extract.find_body_org_id(request))
+
+        with override_settings(SUPERPERMS_ORG_ID_SCAN_LIMIT=len(body)):
+            self.assertEqual(extract.find_body_org_id(request), 3)
+
+    def test_reuses_full_parse(self):
+        """A body already parsed by ``get_json_body`` isn't scanned again."""
+        request = FakeRequest(json.dumps({'organization_id': 5}))
+        parsed = extract.get_json_body(request)
+        self.assertEqual(parsed, {'organization_id': 5})
+
+        request.body = 'no longer looked at'
+        self.assertEqual(extract.find_body_org_id(request), 5)
+        self.assertIs(extract.get_json_body(request), parsed)
+
+
+class TestGetOrgId(TestCase):
+
+    def test_default_order(self):
+        """The query string, then the body; nothing else unless asked."""
+        request = FakeRequest(
+            json.dumps({'organization_id': 4}),
+            META={extract.ORG_ID_HEADER: '3'},
+            GET={'organization_id': '2'}
+        )
+        self.assertEqual(
+            extract.get_org_id(request, {'organization_id': '1'}), '2'
+        )
+        self.assertEqual(extract.get_org_id(FakeRequest(
+            json.dumps({'organization_id': 4}),
+            META={extract.ORG_ID_HEADER: '3'},
+        ), {'organization_id': '1'}), 4)
+        self.assertIsNone(extract.get_org_id(FakeRequest(
+            '', META={extract.ORG_ID_HEADER: '3'}
+        ), {'organization_id': '1'}))
+
+    def test_short_circuits(self):
+        """We never read the body once an earlier source has the id."""
+        request = UnreadableRequest(None, GET={'organization_id': '2'})
+        self.assertEqual(extract.get_org_id(request), '2')
+
+    def test_sources(self):
+        """We only look where we're told to, in the order we're told."""
+        request = FakeRequest(
+            json.dumps({'organization_id': 4}),
+            GET={'organization_id': '2'}
+        )
+        self.assertEqual(
+            extract.get_org_id(request, sources=('body', 'query')), 4
+        )
+        self.assertIsNone(extract.get_org_id(request, sources=('kwargs',)))
+        self.assertEqual(
+            extract.get_org_id(
+                request, sources=[lambda request, view_kwargs: '9']
+            ),
+            '9'
+        )
+
+        with override_settings(SUPERPERMS_ORG_ID_SOURCES=('header', 'body')):
+            self.assertEqual(extract.get_org_id(FakeRequest(
+                json.dumps({'organization_id': 4}),
+                GET={'organization_id': '2'}
+            )), 4)
+
+    def test_remembers_view_kwargs(self):
+        """Later lookups without kwargs reuse the decorator's kwargs."""
+        request = FakeRequest('')
+        extract.get_org_id(request, {'organization_id': '1'}, ('query',))
+        self.assertEqual(extract.get_org_id(request, sources=('kwargs',)), '1')
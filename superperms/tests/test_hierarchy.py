@@ -0,0 +1,132 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+from django.core.cache import caches
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.unittest import TestCase
+
+from superperms.orgs import hierarchy
+from superperms.orgs.exceptions import TooManyNestedOrgs
+from superperms.orgs.models import Organization
+
+
+class TestHierarchy(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.hierarchy_cache = override_settings(
+            SUPERPERMS_HIERARCHY_CACHE='default'
+        )
+        self.hierarchy_cache.enable()
+        self.parent = Organization.objects.create(
+            name='Parent', query_threshold=10
+        )
+        self.child = Organization.objects.create(
+            name='Child', parent_org=self.parent
+        )
+        self.other = Organization.objects.create(name='Other')
+
+    def tearDown(self):
+        self.hierarchy_cache.disable()
+        caches['default'].clear()
+        Organization.objects.all().delete()
+
+    def _fresh(self, org):
+        return Organization.objects.get(pk=org.pk)
+
+    def test_tree(self):
+        tree = hierarchy.get_tree()
+        self.assertEqual(tree.parent_id(self.child.pk), self.parent.pk)
+        self.assertIsNone(tree.parent_id(self.parent.pk))
+        self.assertEqual(tree.child_ids(self.parent.pk), [self.child.pk])
+        self.assertEqual(tree.child_ids(self.other.pk), [])
+        self.assertEqual(tree.top_id(self.child.pk), self.parent.pk)
+        self.assertEqual(tree.top_id(self.other.pk), self.other.pk)
+        self.assertEqual(tree.query_threshold(self.parent.pk), 10)
+
+    def test_no_queries_once_loaded(self):
+        hierarchy.get_tree()
+        child = self._fresh(self.child)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertIs(hierarchy.get_tree(), hierarchy.get_tree())
+            self.assertEqual(child.get_query_threshold(), 10)
+            self.assertRaises(
+                TooManyNestedOrgs,
+                Organization(name='Grandchild', parent_org_id=child.pk).save
+            )
+        self.assertEqual(len(ctx), 0)
+
+    def test_invalidated_by_save(self):
+        tree = hierarchy.get_tree()
+        child = self._fresh(self.child)
+        child.parent_org = self.other
+        child.save()
+        self.parent.query_threshold = 20
+        self.parent.save()
+
+        new_tree = hierarchy.get_tree()
+        self.assertIsNot(new_tree, tree)
+        self.assertEqual(new_tree.parent_id(self.child.pk), self.other.pk)
+        self.assertEqual(new_tree.query_threshold(self.parent.pk), 20)
+
+    def test_invalidated_by_delete(self):
+        hierarchy.get_tree()
+        self.other.delete()
+        self.assertNotIn(self.other.pk, hierarchy.get_tree())
+
+    def test_invalidated_after_commit(self):
+        """A tree loaded before a save commits is reloaded after it."""
+        versions = []
+
+        def load_tree(sender, **kwargs):
+            # As another process could, seeing the old rows.
+            versions.append(hierarchy.get_tree().version)
+
+        post_save.connect(load_tree, sender=Organization)
+        try:
+            self.parent.save()
+        finally:
+            post_save.disconnect(load_tree, sender=Organization)
+        self.assertNotEqual(hierarchy.get_tree().version, versions[0])
+
+    def test_invalidated_by_other_processes(self):
+        """Another process bumping the shared version reloads our tree."""
+        tree = hierarchy.get_tree()
+        Organization.objects.filter(pk=self.child.pk).update(
+            parent_org=self.other
+        )
+        self.assertIs(hierarchy.get_tree(), tree)
+
+        caches['default'].incr(hierarchy.HIERARCHY_VERSION_KEY)
+        self.assertEqual(
+            hierarchy.get_tree().parent_id(self.child.pk), self.other.pk
+        )
+
+    def test_evicted_version(self):
+        """Losing the shared version counts as a change."""
+        tree = hierarchy.get_tree()
+        caches['default'].clear()
+        self.assertIsNot(hierarchy.get_tree(), tree)
+
+    def test_unknown_org(self):
+        """Orgs the tree hasn't seen fall back to the database."""
+        hierarchy.get_tree()
+        # Saved without telling anyone.
+        Organization.objects.bulk_create([Organization(name='New')])
+        new = Organization.objects.get(name='New')
+        self.assertNotIn(new.pk, hierarchy.get_tree())
+        self.assertRaises(
+            TooManyNestedOrgs,
+            Organization(name='Nope', parent_org=self._fresh(self.child)).save
+        )
+        child = Organization(name='Ok', parent_org_id=new.pk)
+        child.save()
+        self.assertEqual(hierarchy.get_tree().parent_id(child.pk), new.pk)
+
+    @override_settings(SUPERPERMS_HIERARCHY_CACHE=None)
+    def test_off(self):
+        self.assertIsNone(hierarchy.get_tree())
+        self.assertEqual(self._fresh(self.child).get_query_threshold(), 10)
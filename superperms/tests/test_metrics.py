@@ -0,0 +1,229 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+import json
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+from django.utils.unittest import TestCase
+
+from superperms.orgs import decorators, metrics
+from superperms.orgs.models import ROLE_VIEWER, Organization, OrganizationUser
+from superperms.orgs.signals import perm_checked
+from superperms.tests.test_decorators import FakeQueryRequest
+
+
+@decorators.has_perm('requires_member')
+def _fake_member_view(request):
+    return HttpResponse()
+
+
+@decorators.has_perm('requires_member')
+@decorators.has_perm('requires_viewer')
+def _fake_stacked_view(request):
+    return HttpResponse()
+
+
+class FakeStatsd(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def incr(self, name, count):
+        self.calls.append(('incr', name, count))
+
+    def timing(self, name, ms):
+        self.calls.append(('timing', name))
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create(username='member@demo.com')
+        self.viewer = User.objects.create(username='viewer@demo.com')
+        self.org = Organization.objects.create(name='Org')
+        self.org.add_member(self.user)
+        self.org.add_member(self.viewer, ROLE_VIEWER)
+
+        self.checks = []
+        perm_checked.connect(self._receive)
+
+    def tearDown(self):
+        perm_checked.disconnect(self._receive)
+        caches['default'].clear()
+        OrganizationUser.objects.all().delete()
+        Organization.objects.all().delete()
+        User.objects.all().delete()
+
+    def _receive(self, sender, **kwargs):
+        kwargs.pop('signal')
+        kwargs.pop('request')
+        self.checks.append(kwargs)
+
+
+class TestPermChecked(MetricsTestCase):
+
+    def test_outcomes(self):
+        """Each check reports its outcome, lookup and query count."""
+        _fake_member_view(FakeQueryRequest(self.user, self.org.pk))
+        _fake_member_view(FakeQueryRequest(self.viewer, self.org.pk))
+        _fake_member_view(FakeQueryRequest(
+            User.objects.create(username='nobody@demo.com'), self.org.pk
+        ))
+        _fake_member_view(FakeQueryRequest(self.user, self.org.pk + 1000))
+
+        self.assertEqual(
+            [(check['outcome'], check['cache_hit'], check['queries'])
+             for check in self.checks],
+            [
+                (decorators.ALLOWED, False, 1),
+                ('perm_denied', False, 1),
+                ('user_dne', False, 2),
+                ('org_dne', False, 2),
+            ]
+        )
+        for check in self.checks:
+            self.assertEqual(check['perm_name'], 'requires_member')
+            self.assertGreaterEqual(check['elapsed'], 0)
+
+    def test_cache_hits(self):
+        """Stacked checks and the role cache count as hits."""
+        _fake_stacked_view(FakeQueryRequest(self.user, self.org.pk))
+        self.assertEqual(
+            [(check['perm_name'], check['cache_hit'], check['queries'])
+             for check in self.checks],
+            [('requires_member', False, 1), ('requires_viewer', True, 0)]
+        )
+
+        with override_settings(SUPERPERMS_ROLE_CACHE='default'):
+            _fake_member_view(FakeQueryRequest(self.user, self.org.pk))
+            _fake_member_view(FakeQueryRequest(self.user, self.org.pk))
+        self.assertEqual(
+            [(check['cache_hit'], check['queries'])
+             for check in self.checks[2:]],
+            [(False, 1), (True, 0)]
+        )
+
+    def test_superuser(self):
+        superuser = User.objects.create(
+            username='super@demo.com', is_superuser=True
+        )
+        _fake_member_view(FakeQueryRequest(superuser, self.org.pk))
+        self.assertEqual(self.checks[0]['outcome'], decorators.ALLOWED)
+        self.assertIsNone(self.checks[0]['cache_hit'])
+        self.assertEqual(self.checks[0]['queries'], 0)
+
+
+class TestPermMetrics(MetricsTestCase):
+
+    def setUp(self):
+        super(TestPermMetrics, self).setUp()
+        self.metrics = metrics.PermMetrics('default', flush_every=3)
+        self.metrics.connect()
+
+    def tearDown(self):
+        self.metrics.disconnect()
+        super(TestPermMetrics, self).tearDown()
+
+    def test_snapshot(self):
+        _fake_member_view(FakeQueryRequest(self.user, self.org.pk))
+        _fake_member_view(FakeQueryRequest(self.viewer, self.org.pk))
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(
+            sorted(snapshot),
+            [('requires_member', decorators.ALLOWED),
+             ('requires_member', 'perm_denied')]
+        )
+        allowed = snapshot[('requires_member', decorators.ALLOWED)]
+        self.assertEqual(allowed['checks'], 1)
+        self.assertEqual(allowed['cache_misses'], 1)
+        self.assertEqual(allowed['queries'], 1)
+        self.assertEqual(sum(allowed['buckets']), 1)
+
+    def test_percentile(self):
+        buckets = [0] * (len(metrics.LATENCY_BUCKETS) + 1)
+        self.assertIsNone(metrics.percentile(buckets, 0.5))
+        buckets[0], buckets[2], buckets[-1] = 50, 45, 5
+        self.assertEqual(
+            metrics.percentile(buckets, 0.5), metrics.LATENCY_BUCKETS[0]
+        )
+        self.assertEqual(
+            metrics.percentile(buckets, 0.95), metrics.LATENCY_BUCKETS[2]
+        )
+        self.assertIsNone(metrics.percentile(buckets, 0.99))
+
+    def test_flush(self):
+        """Counts are added to the shared cache every ``flush_every``."""
+        for x in range(2):
+            _fake_member_view(FakeQueryRequest(self.user, self.org.pk))
+        self.assertEqual(metrics.read_metrics('default'), {})
+
+        _fake_member_view(FakeQueryRequest(self.user, self.org.pk))
+        self.assertEqual(self.metrics.snapshot(), {})
+        # Another process adding to the same counters.
+        other = metrics.PermMetrics('default')
+        other.record('requires_member', decorators.ALLOWED, True, 0, 0.2)
+        other.flush()
+
+        stats = metrics.read_metrics('default')[
+            ('requires_member', decorators.ALLOWED)
+        ]
+        self.assertEqual(stats['checks'], 4)
+        self.assertEqual(stats['cache_hits'], 1)
+        self.assertEqual(stats['cache_misses'], 3)
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(
+            stats['buckets'][metrics.LATENCY_BUCKETS.index(0.25)], 1
+        )
+
+        metrics.reset_metrics('default')
+        self.assertEqual(metrics.read_metrics('default'), {})
+
+    @override_settings(SUPERPERMS_METRICS='default')
+    def test_command(self):
+        _fake_member_view(FakeQueryRequest(self.user, self.org.pk))
+        _fake_member_view(FakeQueryRequest(self.viewer, self.org.pk))
+        self.metrics.flush()
+
+        out = StringIO()
+        call_command('superperms_metrics', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split()[:3], ['perm', 'outcome', 'checks'])
+        self.assertEqual(
+            [line.split()[:3] for line in lines[1:]],
+            [['requires_member', 'allowed', '1'],
+             ['requires_member', 'perm_denied', '1']]
+        )
+
+        out = StringIO()
+        call_command('superperms_metrics', json=True, reset=True, stdout=out)
+        self.assertEqual(
+            [row['checks'] for row in json.loads(out.getvalue())], [1, 1]
+        )
+        self.assertEqual(metrics.read_metrics('default'), {})
+
+
+class TestStatsdSink(MetricsTestCase):
+
+    def test_forwards_checks(self):
+        client = FakeStatsd()
+        sink = metrics.StatsdSink(client, prefix='app.perms')
+        sink.connect()
+        try:
+            _fake_member_view(FakeQueryRequest(self.viewer, self.org.pk))
+        finally:
+            sink.disconnect()
+
+        self.assertEqual(client.calls, [
+            ('incr', 'app.perms.requires_member.perm_denied', 1),
+            ('timing', 'app.perms.requires_member.latency'),
+            ('incr', 'app.perms.cache_miss', 1),
+            ('incr', 'app.perms.queries', 1),
+        ])
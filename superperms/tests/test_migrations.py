@@ -0,0 +1,151 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+import uuid
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.utils.unittest import TestCase
+
+from superperms.orgs.models import (
+    ROLE_MEMBER,
+    ROLE_OWNER,
+    ROLE_VIEWER,
+    STATUS_ACCEPTED,
+    Organization,
+    OrganizationUser,
+)
+
+
+BEFORE_INDEXES = [('orgs', '0002_organizationuser_is_parent_org_owner')]
+AFTER_INDEXES = [('orgs', '0003_membership_indexes')]
+LATEST = [('orgs', '0004_config_jsonb')]
+
+
+def _index_name(model, columns):
+    """Return the name of the index on exactly ``columns`` of ``model``."""
+    cursor = connection.cursor()
+    constraints = connection.introspection.get_constraints(
+        cursor, model._meta.db_table
+    )
+    for name, info in constraints.items():
+        if info['index'] and info['columns'] == columns:
+            return name
+
+
+def _query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return ' '.join(row[-1] for row in cursor.fetchall())
+
+
+class TestIndexes(TestCase):
+    """The hot membership queries are served by indexes."""
+
+    def test_config_key_index(self):
+        """SQLite config filters can use an index on the same key."""
+        cursor = connection.cursor()
+        cursor.execute(
+            'CREATE INDEX orgs_organization_config_plan ON orgs_organization '
+            '(json_extract(config, \'$."plan"\'))'
+        )
+        try:
+            plan = _query_plan(
+                Organization.objects.with_config({'plan': 'gold'})
+            )
+        finally:
+            cursor.execute('DROP INDEX orgs_organization_config_plan')
+        self.assertIn('USING INDEX orgs_organization_config_plan', plan)
+
+    def test_has_perm_lookup(self):
+        index = _index_name(OrganizationUser, ['user_id', 'organization_id'])
+        self.assertIsNotNone(index)
+        plan = _query_plan(OrganizationUser.objects.with_perm_context(
+        ).filter(user_id=1, organization_id=2))
+        self.assertIn(
+            'USING INDEX {0} (user_id=? AND organization_id=?)'.format(index),
+            plan
+        )
+
+    def test_owner_succession(self):
+        index = _index_name(
+            OrganizationUser, ['organization_id', 'role_level']
+        )
+        self.assertIsNotNone(index)
+        plan = _query_plan(OrganizationUser.objects.filter(
+            organization_id=2
+        ).order_by('-role_level', 'pk'))
+        self.assertIn('USING INDEX {0}'.format(index), plan)
+        # Only ties on role_level need sorting.
+        self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan)
+
+    def test_role_filter(self):
+        index = _index_name(
+            OrganizationUser, ['organization_id', 'role_level']
+        )
+        plan = _query_plan(OrganizationUser.objects.filter(
+            organization_id=2, role_level__gte=ROLE_OWNER
+        ))
+        self.assertIn(
+            'USING INDEX {0} (organization_id=? AND role_level>?)'.format(
+                index
+            ),
+            plan
+        )
+
+    def test_uid_lookup(self):
+        index = _index_name(Organization, ['uid'])
+        self.assertIsNotNone(index)
+        plan = _query_plan(Organization.objects.filter(uid=uuid.uuid4()))
+        self.assertIn('USING INDEX {0} (uid=?)'.format(index), plan)
+
+
+class TestDedupeMemberships(TestCase):
+    """Duplicate memberships are merged before the constraint goes on."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='u@demo.com')
+        self.org = Organization.objects.create(name='Org')
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(BEFORE_INDEXES)
+
+    def tearDown(self):
+        self.executor.loader.build_graph()
+        self.executor.migrate(LATEST)
+        OrganizationUser.objects.all().delete()
+        Organization.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_dedupe(self):
+        # bulk_create, since save() would keep the parent ownership current.
+        rows = [
+            OrganizationUser(
+                user=self.user, organization=self.org,
+                role_level=ROLE_VIEWER, status=STATUS_ACCEPTED
+            ),
+            OrganizationUser(
+                user=self.user, organization=self.org, role_level=ROLE_MEMBER
+            ),
+            OrganizationUser(
+                user=self.user, organization=self.org, role_level=ROLE_MEMBER,
+                is_parent_org_owner=True
+            ),
+        ]
+        OrganizationUser.objects.bulk_create(rows)
+        first_member = OrganizationUser.objects.filter(
+            role_level=ROLE_MEMBER
+        ).order_by('pk')[0]
+
+        self.executor.loader.build_graph()
+        self.executor.migrate(AFTER_INDEXES)
+
+        org_user = OrganizationUser.objects.get(
+            user=self.user, organization=self.org
+        )
+        self.assertEqual(org_user.pk, first_member.pk)
+        self.assertEqual(org_user.role_level, ROLE_MEMBER)
+        self.assertEqual(org_user.status, STATUS_ACCEPTED)
+        self.assertTrue(org_user.is_parent_org_owner)
@@ -3,8 +3,13 @@
 :license: see LICENSE for details.
 """
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import OperationalError, connection
+from django.db.models import QuerySet
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils.unittest import TestCase
 
+from superperms.orgs import decorators, models
 from superperms.orgs.exceptions import TooManyNestedOrgs
 from superperms.orgs.models import (
     ROLE_VIEWER,
@@ -68,6 +73,330 @@ class TestOrganizationUser(TestCase):
 
         self.assertEqual(refreshed_org_user3.role_level, ROLE_OWNER)
 
+    def test_owner_succession_is_scoped_to_org(self):
+        """Other orgs' members don't stand in for this org's."""
+        other_org = Organization.objects.create(name='Other')
+        OrganizationUser.objects.create(
+            user=self.user1, organization=other_org
+        )
+        org_user2 = OrganizationUser.objects.create(
+            user=self.user2, organization=self.org
+        )
+
+        with CaptureQueriesContext(connection) as ctx:
+            org_user2.delete()
+
+        self.assertFalse(OrganizationUser.objects.filter(
+            organization=self.org
+        ).exists())
+        # Begin, lock the org, reread the role, delete, clear child org
+        # ownership, look for a successor.
+        self.assertEqual(len(ctx), 6)
+
+    def test_owner_succession_locks_the_org(self):
+        """Succession runs with the org's row locked."""
+        org_user1 = OrganizationUser.objects.create(
+            user=self.user1, organization=self.org
+        )
+        OrganizationUser.objects.create(
+            user=self.user2, organization=self.org, role_level=ROLE_VIEWER
+        )
+
+        with CaptureQueriesContext(connection) as ctx:
+            org_user1.delete()
+
+        # The SQLite backend leaves off FOR UPDATE, but we still ask.
+        lock_sql = Organization.objects.select_for_update().filter(
+            pk__in=[self.org.pk]
+        ).order_by('pk').values_list('pk', flat=True).query
+        self.assertIn(str(lock_sql).split(' WHERE')[0], ctx[1]['sql'])
+        self.assertTrue(self.org.is_owner(self.user2))
+
+    def test_owner_succession_retries_on_deadlock(self):
+        """A deadlocked succession is retried from the top."""
+        org_user1 = OrganizationUser.objects.create(
+            user=self.user1, organization=self.org
+        )
+        OrganizationUser.objects.create(
+            user=self.user2, organization=self.org, role_level=ROLE_VIEWER
+        )
+        ensure_owners = models._ensure_owners
+        calls = []
+
+        def deadlock_once(org_ids):
+            calls.append(org_ids)
+            if len(calls) == 1:
+                raise OperationalError('deadlock detected')
+            return ensure_owners(org_ids)
+
+        models._ensure_owners = deadlock_once
+        try:
+            org_user1.delete()
+        finally:
+            models._ensure_owners = ensure_owners
+
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(self.org.is_member(self.user1))
+        self.assertTrue(self.org.is_owner(self.user2))
+
+    def test_owner_succession_gives_up_eventually(self):
+        """We don't retry forever, and nothing is left half done."""
+        org_user1 = OrganizationUser.objects.create(
+            user=self.user1, organization=self.org
+        )
+        ensure_owners = models._ensure_owners
+
+        def deadlock(org_ids):
+            raise OperationalError('deadlock detected')
+
+        models._ensure_owners = deadlock
+        try:
+            self.assertRaises(OperationalError, org_user1.delete)
+        finally:
+            models._ensure_owners = ensure_owners
+
+        self.assertTrue(self.org.is_owner(self.user1))
+
+    def test_queryset_delete_keeps_an_owner(self):
+        """Deleting through a queryset also promotes a new owner."""
+        other_org = Organization.objects.create(name='Other')
+        for org in (self.org, other_org):
+            OrganizationUser.objects.create(user=self.user1, organization=org)
+            OrganizationUser.objects.create(
+                user=self.user2, organization=org, role_level=ROLE_VIEWER
+            )
+            OrganizationUser.objects.create(
+                user=self.user3, organization=org, role_level=ROLE_MEMBER
+            )
+
+        OrganizationUser.objects.filter(user=self.user1).delete()
+
+        for org in (self.org, other_org):
+            self.assertEqual(
+                OrganizationUser.objects.get(
+                    organization=org, role_level=ROLE_OWNER
+                ).user,
+                self.user3
+            )
+
+        # Leaving no members at all is fine.
+        OrganizationUser.objects.filter(organization=self.org).delete()
+        self.assertFalse(OrganizationUser.objects.filter(
+            organization=self.org
+        ).exists())
+
+    def test_member_delete_locks_the_org(self):
+        """Removing a non-owner queues up behind succession, too."""
+        OrganizationUser.objects.create(
+            user=self.user1, organization=self.org
+        )
+        org_user2 = OrganizationUser.objects.create(
+            user=self.user2, organization=self.org, role_level=ROLE_MEMBER
+        )
+        lock_sql = str(Organization.objects.select_for_update().filter(
+            pk__in=[self.org.pk]
+        ).order_by('pk').values_list('pk', flat=True).query)
+
+        for delete in (
+            org_user2.delete,
+            OrganizationUser.objects.filter(role_level=ROLE_MEMBER).delete
+        ):
+            OrganizationUser.objects.get_or_create(
+                user=self.user2, organization=self.org,
+                role_level=ROLE_MEMBER
+            )
+            with CaptureQueriesContext(connection) as ctx:
+                delete()
+            self.assertTrue(any(
+                lock_sql.split(' WHERE')[0] in query['sql']
+                for query in ctx.captured_queries
+            ))
+
+    def test_stale_member_delete_keeps_an_owner(self):
+        """A member promoted since we loaded them still gets succeeded."""
+        org_user1 = OrganizationUser.objects.create(
+            user=self.user1, organization=self.org
+        )
+        stale = OrganizationUser.objects.create(
+            user=self.user2, organization=self.org, role_level=ROLE_MEMBER
+        )
+        OrganizationUser.objects.create(
+            user=self.user3, organization=self.org, role_level=ROLE_VIEWER
+        )
+        org_user1.delete()
+        self.assertTrue(self.org.is_owner(self.user2))
+
+        stale.delete()
+        self.assertTrue(self.org.is_owner(self.user3))
+
+    def test_vanished_successor(self):
+        """A successor removed before we promote them is passed over."""
+        org_user1 = OrganizationUser.objects.create(
+            user=self.user1, organization=self.org
+        )
+        member = OrganizationUser.objects.create(
+            user=self.user2, organization=self.org, role_level=ROLE_MEMBER
+        )
+        OrganizationUser.objects.create(
+            user=self.user3, organization=self.org, role_level=ROLE_VIEWER
+        )
+        update = models.OrganizationUserQuerySet.update
+        promotions = []
+
+        def delete_first_successor(queryset, **kwargs):
+            if kwargs.get('role_level') == ROLE_OWNER:
+                if not promotions:
+                    # As if deleted elsewhere, without the org lock.
+                    QuerySet.delete(
+                        OrganizationUser.objects.filter(pk=member.pk)
+                    )
+                promotions.append(queryset)
+            return update(queryset, **kwargs)
+
+        models.OrganizationUserQuerySet.update = delete_first_successor
+        try:
+            org_user1.delete()
+        finally:
+            del models.OrganizationUserQuerySet.update
+
+        self.assertEqual(len(promotions), 2)
+        self.assertTrue(self.org.is_owner(self.user3))
+
+    def _is_parent_org_owner(self, org_user):
+        return OrganizationUser.objects.get(
+            pk=org_user.pk
+        ).is_parent_org_owner
+
+    def test_is_parent_org_owner_maintained(self):
+        """Parent ownership follows roles in the parent org."""
+        child_org = Organization.objects.create(
+            name='Child', parent_org=self.org
+        )
+        parent_ou = OrganizationUser.objects.create(
+            user=self.user1, organization=self.org, role_level=ROLE_MEMBER
+        )
+        child_ou = OrganizationUser.objects.create(
+            user=self.user1, organization=child_org, role_level=ROLE_VIEWER
+        )
+        self.assertFalse(self._is_parent_org_owner(child_ou))
+
+        parent_ou.role_level = ROLE_OWNER
+        parent_ou.save()
+        self.assertTrue(self._is_parent_org_owner(child_ou))
+
+        # Joining a child org of an org we own.
+        other_child = Organization.objects.create(
+            name='Other Child', parent_org=self.org
+        )
+        other_ou = OrganizationUser.objects.create(
+            user=self.user1, organization=other_child, role_level=ROLE_VIEWER
+        )
+        self.assertTrue(self._is_parent_org_owner(other_ou))
+
+        OrganizationUser.objects.filter(pk=parent_ou.pk).delete()
+        self.assertFalse(self._is_parent_org_owner(child_ou))
+        self.assertFalse(self._is_parent_org_owner(other_ou))
+
+    def test_is_parent_org_owner_follows_parent_org(self):
+        """Moving an org to a new parent recomputes parent ownership."""
+        OrganizationUser.objects.create(user=self.user1, organization=self.org)
+        child_org = Organization.objects.create(name='Child')
+        child_ou = OrganizationUser.objects.create(
+            user=self.user1, organization=child_org, role_level=ROLE_VIEWER
+        )
+        self.assertFalse(self._is_parent_org_owner(child_ou))
+
+        child_org.parent_org = self.org
+        child_org.save()
+        self.assertTrue(self._is_parent_org_owner(child_ou))
+
+        child_org.parent_org = None
+        child_org.save()
+        self.assertFalse(self._is_parent_org_owner(child_ou))
+
+    def test_stale_parent_ownership_not_saved(self):
+        """Saving a loaded membership keeps parent ownership current."""
+        parent_ou = OrganizationUser.objects.create(
+            user=self.user1, organization=self.org, role_level=ROLE_OWNER
+        )
+        child_org = Organization.objects.create(
+            name='Child', parent_org=self.org
+        )
+        OrganizationUser.objects.create(
+            user=self.user1, organization=child_org, role_level=ROLE_VIEWER
+        )
+        loaded = OrganizationUser.objects.get(
+            user=self.user1, organization=child_org
+        )
+        self.assertTrue(loaded.is_parent_org_owner)
+
+        OrganizationUser.objects.create(user=self.user2, organization=self.org)
+        parent_ou.role_level = ROLE_MEMBER
+        parent_ou.save()
+
+        loaded.status = 'accepted'
+        loaded.save()
+        self.assertFalse(self._is_parent_org_owner(loaded))
+        self.assertEqual(
+            OrganizationUser.objects.get(pk=loaded.pk).status, 'accepted'
+        )
+
+    def test_refresh_parent_org_owners(self):
+        """Parent ownership can be recomputed after bulk changes."""
+        parent_ou = OrganizationUser.objects.create(
+            user=self.user1, organization=self.org, role_level=ROLE_MEMBER
+        )
+        child_org = Organization.objects.create(name='Child')
+        OrganizationUser.objects.bulk_create([
+            OrganizationUser(
+                user=user, organization=child_org, role_level=ROLE_VIEWER
+            )
+            for user in (self.user1, self.user2)
+        ])
+        Organization.objects.filter(pk=child_org.pk).update(
+            parent_org=self.org
+        )
+        OrganizationUser.objects.filter(pk=parent_ou.pk).update(
+            role_level=ROLE_OWNER
+        )
+
+        members = OrganizationUser.objects.filter(organization=child_org)
+        self.assertEqual(members.refresh_parent_org_owners(), 1)
+        self.assertEqual(
+            dict(members.values_list('user_id', 'is_parent_org_owner')),
+            {self.user1.pk: True, self.user2.pk: False}
+        )
+        self.assertEqual(members.refresh_parent_org_owners(), 0)
+
+        Organization.objects.filter(pk=child_org.pk).update(parent_org=None)
+        self.assertEqual(
+            OrganizationUser.objects.all().refresh_parent_org_owners(), 1
+        )
+        self.assertFalse(members.filter(is_parent_org_owner=True).exists())
+
+    def test_deferred_parent_org(self):
+        """Deferring parent_org_id costs nothing until it's needed."""
+        OrganizationUser.objects.create(user=self.user1, organization=self.org)
+        child_org = Organization.objects.create(name='Child')
+        child_ou = OrganizationUser.objects.create(
+            user=self.user1, organization=child_org, role_level=ROLE_VIEWER
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            orgs = list(Organization.objects.only('name'))
+        self.assertEqual(len(ctx), 1)
+
+        deferred = [org for org in orgs if org.pk == child_org.pk][0]
+        deferred.name = 'Renamed'
+        deferred.save()
+        self.assertNotIn('parent_org_id', deferred.__dict__)
+
+        deferred.parent_org = self.org
+        deferred.save()
+        self.assertTrue(self._is_parent_org_owner(child_ou))
+        self.assertEqual(
+            Organization.objects.get(pk=child_org.pk).name, 'Renamed'
+        )
+
 
 class TestOrganization(TestCase):
     # TODO: I know I shouldn't need these. Need to figure out what's up with
@@ -190,6 +519,71 @@ class TestOrganization(TestCase):
             list(child_org.get_exportable_fields()), parent_fields
         )
 
+    def test_get_exportable_field_names(self):
+        """Names come grouped by model, resolved through the parent."""
+        parent_org = Organization.objects.create(name='Parent')
+        child_org = Organization.objects.create(name='Child')
+        for org, model, name in (
+            (parent_org, 'Building', 'address'),
+            (parent_org, 'Building', 'year_built'),
+            (parent_org, 'Meter', 'kind'),
+            (child_org, 'Building', 'gross_floor_area'),
+        ):
+            ExportableField.objects.create(
+                organization=org, field_model=model, name=name
+            )
+
+        self.assertEqual(
+            dict(child_org.get_exportable_field_names()),
+            {'Building': frozenset(['gross_floor_area'])}
+        )
+
+        child_org.parent_org = parent_org
+        child_org.save()
+        names = child_org.get_exportable_field_names()
+        self.assertEqual(dict(names), {
+            'Building': frozenset(['address', 'year_built']),
+            'Meter': frozenset(['kind']),
+        })
+        self.assertFalse(hasattr(names, '__setitem__'))
+        self.assertIsInstance(names['Meter'], frozenset)
+
+    @override_settings(SUPERPERMS_EXPORTABLE_FIELDS_CACHE='default')
+    def test_get_exportable_field_names_cached(self):
+        """Cached until the org's, or its parent's, fields change."""
+        caches['default'].clear()
+        parent_org = Organization.objects.create(name='Parent')
+        child_org = Organization.objects.create(
+            name='Child', parent_org=parent_org
+        )
+        field = ExportableField.objects.create(
+            organization=parent_org, field_model='Building', name='address'
+        )
+
+        self.assertEqual(
+            dict(child_org.get_exportable_field_names()),
+            {'Building': frozenset(['address'])}
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            child_org.get_exportable_field_names()
+            parent_org.get_exportable_field_names()
+        self.assertEqual(len(ctx), 0)
+
+        ExportableField.objects.create(
+            organization=parent_org, field_model='Meter', name='kind'
+        )
+        self.assertEqual(
+            dict(child_org.get_exportable_field_names()),
+            {'Building': frozenset(['address']), 'Meter': frozenset(['kind'])}
+        )
+
+        field.delete()
+        self.assertEqual(
+            dict(child_org.get_exportable_field_names()),
+            {'Meter': frozenset(['kind'])}
+        )
+        caches['default'].clear()
+
     def test_get_query_threshold(self):
         """Make sure we use the parent's query threshold."""
         parent_org = Organization.objects.create(
@@ -214,6 +608,53 @@ class TestOrganization(TestCase):
         OrganizationUser.objects.create(user=self.user, organization=org)
         self.assertTrue(org.is_member(self.user))
 
+    def test_is_member_single_query(self):
+        """Membership is an existence check, not a scan of every member."""
+        org = Organization.objects.create(name='Org')
+        for x in range(10):
+            org.add_member(User.objects.create(username='u{0}'.format(x)))
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertFalse(org.is_member(self.user))
+
+        self.assertEqual(len(ctx), 1)
+        self.assertIn('LIMIT 1', ctx[0]['sql'])
+
+    def test_filter_members(self):
+        """We find which of many users are members in one go."""
+        org = Organization.objects.create(name='Org')
+        members = [
+            User.objects.create(username='m{0}'.format(x)) for x in range(3)
+        ]
+        for member in members:
+            org.add_member(member, role=ROLE_MEMBER)
+
+        users = members[:2] + [self.user]
+        self.assertSetEqual(
+            org.filter_members(users), set([members[0].pk, members[1].pk])
+        )
+        # Ids work just as well as user objects.
+        self.assertSetEqual(
+            org.filter_members([self.user.pk, members[2].pk]),
+            set([members[2].pk])
+        )
+        self.assertSetEqual(org.filter_members([]), set())
+
+    def test_get_member_roles(self):
+        """We get each member's role, and nothing for non-members."""
+        org = Organization.objects.create(name='Org')
+        viewer = User.objects.create(username='viewer')
+        org.add_member(self.user, role=ROLE_OWNER)
+        org.add_member(viewer, role=ROLE_VIEWER)
+        stranger = User.objects.create(username='stranger')
+
+        self.assertDictEqual(
+            org.get_member_roles([self.user, viewer, stranger]),
+            {self.user.pk: ROLE_OWNER, viewer.pk: ROLE_VIEWER}
+        )
+        self.assertEqual(org.get_member_role(viewer), ROLE_VIEWER)
+        self.assertIsNone(org.get_member_role(stranger))
+
     def test_add_member(self):
         """We can add a member using the convenience function."""
         org = Organization.objects.create(name='Org')
@@ -227,6 +668,145 @@ class TestOrganization(TestCase):
             user=self.user, organization=org
         ).exists())
 
+    def test_add_member_again(self):
+        """Adding an existing member with another role leaves them be."""
+        org = Organization.objects.create(name='Org')
+        org_user, created = org.add_member(self.user, role=ROLE_OWNER)
+        self.assertTrue(created)
+
+        again, created = org.add_member(self.user, role=ROLE_VIEWER)
+        self.assertFalse(created)
+        self.assertEqual(again.pk, org_user.pk)
+        self.assertEqual(org.get_member_role(self.user), ROLE_OWNER)
+
+    def test_add_members(self):
+        """We can add lots of members in a fixed number of queries."""
+        org = Organization.objects.create(name='Org')
+        org.add_member(self.user, role=ROLE_OWNER)
+        users = [
+            User.objects.create(username='u{0}'.format(x)) for x in range(20)
+        ]
+
+        with CaptureQueriesContext(connection) as ctx:
+            created = org.add_members(users + [self.user], role=ROLE_MEMBER)
+
+        # Look up existing members and insert the rest; no parent org.
+        self.assertLessEqual(len(ctx), 4)
+        self.assertEqual(len(created), 20)
+        roles = org.get_member_roles(users + [self.user])
+        self.assertEqual(roles.pop(self.user.pk), ROLE_OWNER)
+        self.assertEqual(set(roles.values()), set([ROLE_MEMBER]))
+
+    def test_add_members_parent_ownership(self):
+        """New members of child orgs pick up parent ownership."""
+        parent_org = Organization.objects.create(name='Parent')
+        parent_org.add_member(self.user, role=ROLE_OWNER)
+        child_org = Organization.objects.create(
+            name='Child', parent_org=parent_org
+        )
+        other = User.objects.create(username='other')
+
+        child_org.add_members([self.user, other], role=ROLE_VIEWER)
+
+        flags = dict(OrganizationUser.objects.filter(
+            organization=child_org
+        ).values_list('user_id', 'is_parent_org_owner'))
+        self.assertEqual(flags, {self.user.pk: True, other.pk: False})
+
+    def test_upsert_members(self):
+        """Upserting adds new members and changes existing roles."""
+        parent_org = Organization.objects.create(name='Parent')
+        child_org = Organization.objects.create(
+            name='Child', parent_org=parent_org
+        )
+        owner = User.objects.create(username='owner')
+        parent_org.add_member(owner, role=ROLE_OWNER)
+        parent_org.add_member(self.user, role=ROLE_VIEWER)
+        child_ou = OrganizationUser.objects.create(
+            user=self.user, organization=child_org, role_level=ROLE_VIEWER
+        )
+        new_user = User.objects.create(username='new')
+
+        created = parent_org.upsert_members({
+            self.user: ROLE_OWNER,
+            owner.pk: ROLE_MEMBER,
+            new_user: ROLE_VIEWER,
+        })
+
+        self.assertEqual([ou.user_id for ou in created], [new_user.pk])
+        self.assertDictEqual(
+            parent_org.get_member_roles([self.user, owner, new_user]),
+            {
+                self.user.pk: ROLE_OWNER,
+                owner.pk: ROLE_MEMBER,
+                new_user.pk: ROLE_VIEWER,
+            }
+        )
+        self.assertTrue(
+            OrganizationUser.objects.get(pk=child_ou.pk).is_parent_org_owner
+        )
+
+    def test_upsert_members_keeps_an_owner(self):
+        """Demoting every owner leaves the highest ranking one in charge."""
+        org = Organization.objects.create(name='Org')
+        member = User.objects.create(username='member')
+        org.add_member(self.user, role=ROLE_OWNER)
+        org.add_member(member, role=ROLE_VIEWER)
+
+        org.upsert_members({self.user: ROLE_MEMBER})
+
+        self.assertTrue(org.is_owner(self.user))
+
+    def test_remove_members(self):
+        """We can remove lots of members, keeping an owner around."""
+        org = Organization.objects.create(name='Org')
+        users = [
+            User.objects.create(username='u{0}'.format(x)) for x in range(10)
+        ]
+        org.add_members(users[:2], role=ROLE_OWNER)
+        org.add_members(users[2:5], role=ROLE_VIEWER)
+        org.add_members(users[5:], role=ROLE_MEMBER)
+
+        removed = org.remove_members(users[:2] + users[5:9])
+
+        self.assertEqual(removed, 6)
+        roles = org.get_member_roles(users)
+        self.assertEqual(set(roles), set(u.pk for u in users[2:5] + users[9:]))
+        self.assertEqual(roles[users[9].pk], ROLE_OWNER)
+        self.assertEqual(org.remove_members([self.user]), 0)
+
+    def test_remove_members_retries_on_deadlock(self):
+        """Bulk removal is one locked, retried change, however many batches."""
+        org = Organization.objects.create(name='Org')
+        users = [
+            User.objects.create(username='u{0}'.format(x)) for x in range(5)
+        ]
+        org.add_members(users[:4], role=ROLE_OWNER)
+        org.add_member(users[4], role=ROLE_MEMBER)
+        ensure_owners = models._ensure_owners
+        batch_size = models.MEMBERSHIP_BATCH_SIZE
+        calls = []
+
+        def deadlock_once(org_ids):
+            calls.append(org_ids)
+            if len(calls) == 1:
+                raise OperationalError('deadlock detected')
+            return ensure_owners(org_ids)
+
+        models._ensure_owners = deadlock_once
+        models.MEMBERSHIP_BATCH_SIZE = 2
+        try:
+            removed = org.remove_members(users[:4])
+        finally:
+            models._ensure_owners = ensure_owners
+            models.MEMBERSHIP_BATCH_SIZE = batch_size
+
+        self.assertEqual(calls, [[org.pk], [org.pk]])
+        self.assertEqual(removed, 4)
+        self.assertEqual(
+            org.get_member_roles(users), {users[4].pk: ROLE_OWNER}
+        )
+
     def test_remove_member(self):
         """We can remove a member."""
         org = Organization.objects.create(name='Org')
@@ -257,3 +837,67 @@ class TestOrganization(TestCase):
         # non-members aren't owners
         org.remove_member(self.user)
         self.assertFalse(org.is_owner(self.user))
+
+    def test_with_perm_matches_perms(self):
+        """SQL filtering agrees with the ``PERMS`` functions."""
+        parent_org = Organization.objects.create(name='Parent')
+        parent_org.add_member(self.user, role=ROLE_OWNER)
+        child_org = Organization.objects.create(
+            name='Child', parent_org=parent_org
+        )
+        child_org.add_member(self.user, role=ROLE_VIEWER)
+        # Not a member, so parent ownership alone isn't enough.
+        Organization.objects.create(name='Stranger', parent_org=parent_org)
+        other_org = Organization.objects.create(name='Other')
+        other_org.add_member(self.user, role=ROLE_MEMBER)
+        other_child = Organization.objects.create(
+            name='Other Child', parent_org=other_org
+        )
+        other_child.add_member(self.user, role=ROLE_OWNER)
+
+        org_users = OrganizationUser.objects.filter(user=self.user)
+        for perm_name, perm in decorators.PERMS.items():
+            expected = set(
+                org_user.organization for org_user in org_users
+                if perm(org_user)
+            )
+            self.assertSetEqual(
+                set(Organization.objects.with_perm(self.user, perm_name)),
+                expected,
+                perm_name
+            )
+
+    def test_with_perm_counts_in_sql(self):
+        """We can count and slice permitted orgs without loading them."""
+        for x in range(5):
+            org = Organization.objects.create(name='org-{0}'.format(x))
+            org.add_member(
+                self.user, role=ROLE_MEMBER if x % 2 else ROLE_VIEWER
+            )
+
+        orgs = Organization.objects.with_perm(self.user, 'can_modify_data')
+        self.assertEqual(orgs.count(), 2)
+        self.assertEqual(orgs[:1].get().name, 'org-1')
+        self.assertEqual(
+            Organization.objects.with_perm(self.user, 'can_view_data').count(),
+            5
+        )
+        self.assertEqual(
+            Organization.objects.with_perm(self.user, 'derp').count(), 0
+        )
+
+    def test_with_perm_rows_dont_repeat(self):
+        """Without DISTINCT, each permitted org still comes back once."""
+        parent_org = Organization.objects.create(name='Parent')
+        parent_org.add_member(self.user, role=ROLE_OWNER)
+        parent_org.add_member(User.objects.create(username='a@b.com'))
+        child_org = Organization.objects.create(
+            name='Child', parent_org=parent_org
+        )
+        child_org.add_member(self.user, role=ROLE_OWNER)
+
+        orgs = Organization.objects.with_perm(self.user, 'requires_owner')
+        self.assertNotIn('DISTINCT', str(orgs.query))
+        self.assertEqual(
+            sorted(orgs.values_list('name', flat=True)), ['Child', 'Parent']
+        )
@@ -0,0 +1,418 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+
+Every public API has a query budget. If a change needs more queries, raise
+the budget here deliberately rather than finding out in production.
+"""
+import inspect
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.unittest import TestCase
+
+from superperms.orgs import decorators
+from superperms.orgs.models import (
+    ROLE_MEMBER,
+    ROLE_OWNER,
+    ROLE_VIEWER,
+    ExportableField,
+    Organization,
+    OrganizationUser,
+)
+from superperms.tests.test_decorators import FakeQueryRequest
+
+
+# Queries each API may make. Transactions count a BEGIN on SQLite, and
+# membership changes that could cost the org its owner also lock its row.
+QUERY_BUDGETS = {
+    # Each PERMS function, given a ``with_perm_context()`` membership whose
+    # user we already have, as ``has_perm`` does.
+    'PERMS': 0,
+    'perm_filter': 0,
+    'check_perms': 1,
+    'get_org_user': 1,
+    'has_perm': 1,
+    'has_perm (stacked, same request)': 1,
+    'has_perm (role cache hit)': 0,
+    'has_perm (not a member)': 2,
+    'has_perm (superuser)': 0,
+    'OrganizationQuerySet.with_perm': 1,
+    'OrganizationQuerySet.with_config_key': 1,
+    'OrganizationQuerySet.with_config': 1,
+    # Begin, look up parent ownership, insert, update child memberships.
+    'OrganizationUser.save (add)': 4,
+    'OrganizationUser.save (change)': 3,
+    # Begin, lock, reread our role, delete.
+    'OrganizationUser.delete (not owner)': 4,
+    # Then clear child ownership, find a successor, and promote them here
+    # and in child orgs.
+    'OrganizationUser.delete (owner)': 8,
+    'OrganizationUserQuerySet.delete': 7,
+    # Begin, read the rows and their parents' owners, set and clear flags.
+    'OrganizationUserQuerySet.refresh_parent_org_owners': 5,
+    'Organization.save (add)': 2,
+    'Organization.save (add child)': 2,
+    'Organization.save (change parent)': 4,
+    # Collect child orgs, members and fields; begin, delete members and org.
+    'Organization.delete': 6,
+    'Organization.is_member': 1,
+    'Organization.filter_members': 1,
+    'Organization.get_member_roles': 1,
+    'Organization.get_member_role': 1,
+    'Organization.add_member': 7,
+    'Organization.remove_member': 9,
+    'Organization.add_members': 6,
+    'Organization.upsert_members': 5,
+    # Begin, lock, then per batch count, collect and delete; then as for
+    # one owner leaving.
+    'Organization.remove_members': 9,
+    'Organization.is_owner': 1,
+    'Organization.get_exportable_fields': 1,
+    'Organization.get_exportable_fields (child)': 1,
+    'Organization.get_exportable_field_names': 1,
+    'Organization.get_exportable_field_names (cached)': 0,
+    'Organization.get_effective_config': 0,
+    'Organization.get_effective_config (child)': 1,
+    'Organization.get_effective_config (cached)': 0,
+    'Organization.get_query_threshold': 0,
+    'Organization.get_query_threshold (child)': 1,
+    # One UPDATE on Postgres; begin, lock and read, write elsewhere.
+    'Organization.set_config': 3,
+    'Organization.delete_config': 3,
+    'Organization.merge_config': 3,
+    'Organization.is_parent': 0,
+    'Organization.get_parent': 0,
+    # Loads the parent; get_parent_id doesn't need to.
+    'Organization.get_parent (child)': 1,
+    'Organization.get_parent_id': 0,
+}
+
+
+def _view(request):
+    return HttpResponse()
+
+
+class TestQueryBudgets(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create(username='budget@demo.com')
+        self.other_user = User.objects.create(username='other@demo.com')
+        self.superuser = User.objects.create(
+            username='super@demo.com', is_superuser=True
+        )
+        self.org = Organization.objects.create(name='Parent')
+        self.child = Organization.objects.create(
+            name='Child', parent_org=self.org
+        )
+        self.org.add_member(self.user)
+        self.org.add_member(self.other_user, ROLE_MEMBER)
+        self.child.add_member(self.user, ROLE_VIEWER)
+        ExportableField.objects.create(
+            organization=self.org, field_model='Building', name='address'
+        )
+
+    def tearDown(self):
+        caches['default'].clear()
+        ExportableField.objects.all().delete()
+        OrganizationUser.objects.all().delete()
+        Organization.objects.all().delete()
+        User.objects.all().delete()
+
+    def assertWithinBudget(self, name, fn, *args, **kwargs):
+        """Call ``fn``, failing if it makes more queries than ``name``'s."""
+        budget = QUERY_BUDGETS[name]
+        with CaptureQueriesContext(connection) as ctx:
+            result = fn(*args, **kwargs)
+        self.assertLessEqual(
+            len(ctx), budget,
+            '{0} made {1} queries, over its budget of {2}:\n{3}'.format(
+                name, len(ctx), budget,
+                '\n'.join(query['sql'] for query in ctx.captured_queries)
+            )
+        )
+        return result
+
+    def _fresh(self, org):
+        return Organization.objects.get(pk=org.pk)
+
+    def test_every_public_method_has_a_budget(self):
+        """New public API can't sneak in without a budget."""
+        for cls in (Organization, OrganizationUser):
+            for name, member in vars(cls).items():
+                if isinstance(member, property):
+                    member = member.fget
+                if (
+                    name.startswith('_') or
+                    not inspect.isfunction(member) or
+                    member.__module__ != cls.__module__
+                ):
+                    continue
+                key = '{0}.{1}'.format(cls.__name__, name)
+                self.assertTrue(
+                    any(budget == key or budget.startswith(key + ' (')
+                        for budget in QUERY_BUDGETS),
+                    '{0} has no query budget'.format(key)
+                )
+
+    def test_perms(self):
+        for org in (self.org, self.child):
+            org_user = OrganizationUser.objects.with_perm_context().get(
+                user=self.user, organization=org
+            )
+            org_user.user = self.user
+            for perm_name, perm in decorators.PERMS.items():
+                self.assertWithinBudget('PERMS', perm, org_user)
+
+    def test_perm_filter(self):
+        for perm_name in decorators.PERMS:
+            self.assertWithinBudget(
+                'perm_filter', decorators.perm_filter, self.user, perm_name
+            )
+
+    def test_check_perms(self):
+        self.assertWithinBudget(
+            'check_perms', decorators.check_perms,
+            self.user, [self.org.pk, self.child.pk], list(decorators.PERMS)
+        )
+
+    def test_get_org_user(self):
+        self.assertWithinBudget(
+            'get_org_user', decorators.get_org_user,
+            FakeQueryRequest(self.user, self.child.pk)
+        )
+
+    def test_has_perm(self):
+        for perm_name in decorators.PERMS:
+            view = decorators.has_perm(perm_name)(_view)
+            for org in (self.org, self.child):
+                self.assertWithinBudget(
+                    'has_perm', view, FakeQueryRequest(self.user, org.pk)
+                )
+                self.assertWithinBudget(
+                    'has_perm (not a member)',
+                    view, FakeQueryRequest(self.other_user, self.child.pk)
+                )
+                self.assertWithinBudget(
+                    'has_perm (superuser)',
+                    view, FakeQueryRequest(self.superuser, org.pk)
+                )
+
+    def test_has_perm_stacked(self):
+        view = _view
+        for perm_name in decorators.PERMS:
+            view = decorators.has_perm(perm_name)(view)
+        self.assertWithinBudget(
+            'has_perm (stacked, same request)',
+            view, FakeQueryRequest(self.user, self.child.pk)
+        )
+
+    @override_settings(SUPERPERMS_ROLE_CACHE='default')
+    def test_has_perm_role_cache(self):
+        view = decorators.has_perm('requires_member')(_view)
+        view(FakeQueryRequest(self.user, self.child.pk))
+        self.assertWithinBudget(
+            'has_perm (role cache hit)',
+            view, FakeQueryRequest(self.user, self.child.pk)
+        )
+
+    def test_with_perm(self):
+        for perm_name in decorators.PERMS:
+            self.assertWithinBudget(
+                'OrganizationQuerySet.with_perm',
+                lambda: list(Organization.objects.with_perm(
+                    self.user, perm_name
+                ))
+            )
+
+    def test_config_filters(self):
+        self.assertWithinBudget(
+            'OrganizationQuerySet.with_config_key',
+            lambda: list(Organization.objects.with_config_key('a.b'))
+        )
+        self.assertWithinBudget(
+            'OrganizationQuerySet.with_config',
+            lambda: list(Organization.objects.with_config({'a': [1]}))
+        )
+
+    def test_organization_user_save_and_delete(self):
+        new_user = User.objects.create(username='new@demo.com')
+        org_user = OrganizationUser(
+            user=new_user, organization=self.org, role_level=ROLE_VIEWER
+        )
+        self.assertWithinBudget('OrganizationUser.save (add)', org_user.save)
+        org_user.role_level = ROLE_MEMBER
+        self.assertWithinBudget(
+            'OrganizationUser.save (change)', org_user.save
+        )
+        self.assertWithinBudget(
+            'OrganizationUser.delete (not owner)', org_user.delete
+        )
+
+        owner = OrganizationUser.objects.get(
+            user=self.user, organization=self.org
+        )
+        self.assertWithinBudget(
+            'OrganizationUser.delete (owner)', owner.delete
+        )
+        self.assertTrue(self.org.is_owner(self.other_user))
+
+    def test_config_writes(self):
+        org = self._fresh(self.org)
+        self.assertWithinBudget(
+            'Organization.set_config', org.set_config, 'a.b', 1
+        )
+        self.assertWithinBudget(
+            'Organization.merge_config', org.merge_config, {'c': 2}, 'a'
+        )
+        self.assertWithinBudget(
+            'Organization.delete_config', org.delete_config, 'a.b'
+        )
+        self.assertEqual(self._fresh(self.org).config, {'a': {'c': 2}})
+
+    def test_organization_user_queryset_delete(self):
+        self.assertWithinBudget(
+            'OrganizationUserQuerySet.delete',
+            OrganizationUser.objects.filter(organization=self.org).delete
+        )
+
+    def test_refresh_parent_org_owners(self):
+        OrganizationUser.objects.filter(
+            organization=self.org, user=self.other_user
+        ).update(role_level=ROLE_OWNER)
+        self.child.add_member(self.other_user, ROLE_VIEWER)
+        OrganizationUser.objects.filter(
+            organization=self.org, user=self.user
+        ).update(role_level=ROLE_MEMBER)
+        self.assertEqual(self.assertWithinBudget(
+            'OrganizationUserQuerySet.refresh_parent_org_owners',
+            OrganizationUser.objects.filter(
+                organization=self.child
+            ).refresh_parent_org_owners
+        ), 1)
+
+    def test_organization_save(self):
+        self.assertWithinBudget(
+            'Organization.save (add)', Organization(name='New').save
+        )
+        self.assertWithinBudget(
+            'Organization.save (add child)',
+            Organization(name='New child', parent_org=self.org).save
+        )
+
+        other = Organization.objects.create(name='Other parent')
+        child = self._fresh(self.child)
+        child.parent_org = other
+        self.assertWithinBudget(
+            'Organization.save (change parent)', child.save
+        )
+
+    def test_organization_delete(self):
+        self.assertWithinBudget(
+            'Organization.delete', self._fresh(self.child).delete
+        )
+
+    def test_membership_reads(self):
+        users = [self.user, self.other_user]
+        self.assertWithinBudget(
+            'Organization.is_member', self.org.is_member, self.user
+        )
+        self.assertWithinBudget(
+            'Organization.filter_members', self.org.filter_members, users
+        )
+        self.assertWithinBudget(
+            'Organization.get_member_roles', self.org.get_member_roles, users
+        )
+        self.assertWithinBudget(
+            'Organization.get_member_role', self.org.get_member_role, self.user
+        )
+        self.assertWithinBudget(
+            'Organization.is_owner', self.org.is_owner, self.user
+        )
+
+    def test_membership_writes(self):
+        users = [
+            User.objects.create(username='u{0}@demo.com'.format(x))
+            for x in range(5)
+        ]
+        self.assertWithinBudget(
+            'Organization.add_member', self.child.add_member, users[0]
+        )
+        self.assertWithinBudget(
+            'Organization.remove_member', self.child.remove_member, users[0]
+        )
+        self.assertWithinBudget(
+            'Organization.add_members', self.child.add_members, users
+        )
+        self.assertWithinBudget(
+            'Organization.upsert_members', self.org.upsert_members,
+            dict((user, ROLE_OWNER) for user in users)
+        )
+        self.assertWithinBudget(
+            'Organization.remove_members', self.org.remove_members,
+            users + [self.user]
+        )
+        self.assertTrue(self.org.is_owner(self.other_user))
+
+    def test_inherited_settings(self):
+        org = self._fresh(self.org)
+        child = self._fresh(self.child)
+        self.assertWithinBudget(
+            'Organization.get_exportable_fields',
+            lambda: list(org.get_exportable_fields())
+        )
+        fields = self.assertWithinBudget(
+            'Organization.get_exportable_fields (child)',
+            lambda: list(child.get_exportable_fields())
+        )
+        self.assertEqual([field.name for field in fields], ['address'])
+        self.assertWithinBudget(
+            'Organization.get_exportable_field_names',
+            child.get_exportable_field_names
+        )
+        with override_settings(SUPERPERMS_EXPORTABLE_FIELDS_CACHE='default'):
+            child.get_exportable_field_names()
+            self.assertWithinBudget(
+                'Organization.get_exportable_field_names (cached)',
+                org.get_exportable_field_names
+            )
+        self.assertWithinBudget(
+            'Organization.get_effective_config', org.get_effective_config
+        )
+        self.assertWithinBudget(
+            'Organization.get_effective_config (child)',
+            child.get_effective_config
+        )
+        with override_settings(SUPERPERMS_CONFIG_CACHE='default'):
+            self._fresh(self.child).get_effective_config()
+            self.assertWithinBudget(
+                'Organization.get_effective_config (cached)',
+                self._fresh(self.child).get_effective_config
+            )
+        self.assertWithinBudget(
+            'Organization.get_query_threshold', org.get_query_threshold
+        )
+        self.assertWithinBudget(
+            'Organization.get_query_threshold (child)',
+            self._fresh(self.child).get_query_threshold
+        )
+        self.assertWithinBudget(
+            'Organization.is_parent', lambda: (org.is_parent, child.is_parent)
+        )
+        self.assertWithinBudget('Organization.get_parent', org.get_parent)
+        self.assertWithinBudget(
+            'Organization.get_parent (child)',
+            self._fresh(self.child).get_parent
+        )
+        child = self._fresh(self.child)
+        self.assertEqual(
+            self.assertWithinBudget(
+                'Organization.get_parent_id',
+                lambda: (org.get_parent_id(), child.get_parent_id())
+            ),
+            (self.org.pk, self.org.pk)
+        )
@@ -0,0 +1,148 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for details.
+"""
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from django.utils.unittest import TestCase, skipUnless
+
+from superperms.orgs import thresholds
+from superperms.orgs.models import (
+    ROLE_MEMBER,
+    ROLE_VIEWER,
+    Organization,
+    OrganizationUser,
+)
+
+
+class TestThresholds(TestCase):
+
+    def setUp(self):
+        self.parent = Organization.objects.create(
+            name='Parent', query_threshold=3
+        )
+        self.child = Organization.objects.create(
+            name='Child', parent_org=self.parent, query_threshold=100
+        )
+        self.unlimited = Organization.objects.create(name='Unlimited')
+        self.strict = Organization.objects.create(
+            name='Strict', query_threshold=10
+        )
+        self.thresholds = {
+            self.parent.pk: 3,
+            self.child.pk: 3,
+            self.unlimited.pk: None,
+            self.strict.pk: 10,
+        }
+
+    def tearDown(self):
+        OrganizationUser.objects.all().delete()
+        Organization.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_resolve_thresholds(self):
+        org_ids = list(self.thresholds)
+        with CaptureQueriesContext(connection) as ctx:
+            resolved = thresholds.resolve_thresholds(org_ids)
+        self.assertEqual(len(ctx), 1)
+        self.assertEqual(resolved, self.thresholds)
+        self.assertEqual(
+            resolved,
+            dict((org.pk, org.get_query_threshold())
+                 for org in Organization.objects.all())
+        )
+
+    def _groups(self):
+        """``(count, org_id)`` pairs, and whether each is suppressed."""
+        return [
+            (2, self.parent.pk, True),
+            (3, self.parent.pk, False),
+            (2, self.child.pk, True),
+            (5, self.child.pk, False),
+            (0, self.unlimited.pk, False),
+            (9, self.strict.pk, True),
+            (10, self.strict.pk, False),
+            (1000, self.strict.pk + 1000, True),
+        ]
+
+    def _check_mask(self):
+        groups = self._groups()
+        mask = thresholds.suppressed_mask(
+            [count for count, org_id, hidden in groups],
+            [org_id for count, org_id, hidden in groups],
+            self.thresholds
+        )
+        self.assertEqual(
+            [bool(hidden) for hidden in mask],
+            [hidden for count, org_id, hidden in groups]
+        )
+
+    def test_suppressed_mask(self):
+        numpy = thresholds.numpy
+        thresholds.numpy = None
+        try:
+            self._check_mask()
+        finally:
+            thresholds.numpy = numpy
+
+    @skipUnless(thresholds.numpy, 'NumPy is not installed')
+    def test_suppressed_mask_numpy(self):
+        self._check_mask()
+        mask = thresholds.suppressed_mask([], [], self.thresholds)
+        self.assertEqual(len(mask), 0)
+
+    def test_suppress(self):
+        rows = [
+            {'organization_id': org_id, 'kind': x, 'count': count}
+            for x, (count, org_id, hidden) in enumerate(self._groups())
+        ]
+        self.assertEqual(
+            [row['kind']
+             for row in thresholds.suppress(rows, self.thresholds)],
+            [x for x, (count, org_id, hidden) in enumerate(self._groups())
+             if not hidden]
+        )
+
+    def _add_members(self, org, viewers, members):
+        users = [
+            User.objects.create(username='{0}-{1}'.format(org.name, x))
+            for x in range(viewers + members)
+        ]
+        org.add_members(users[:viewers], ROLE_VIEWER)
+        org.add_members(users[viewers:], ROLE_MEMBER)
+
+    def test_apply_threshold(self):
+        """Groups below their org's threshold are dropped in SQL."""
+        self._add_members(self.parent, 2, 3)
+        self._add_members(self.child, 4, 1)
+        self._add_members(self.unlimited, 1, 0)
+        self._add_members(self.strict, 9, 1)
+
+        counts = OrganizationUser.objects.values(
+            'organization_id', 'role_level'
+        ).annotate(count=Count('pk')).order_by()
+
+        with CaptureQueriesContext(connection) as ctx:
+            kept = set(
+                (row['organization_id'], row['role_level'], row['count'])
+                for row in thresholds.apply_threshold(counts)
+            )
+        # Resolving thresholds, then the aggregate itself.
+        self.assertEqual(len(ctx), 2)
+        self.assertIn('HAVING', ctx.captured_queries[1]['sql'])
+        self.assertEqual(kept, set([
+            (self.parent.pk, ROLE_MEMBER, 3),
+            (self.child.pk, ROLE_VIEWER, 4),
+            (self.unlimited.pk, ROLE_VIEWER, 1),
+        ]))
+
+        self.assertEqual(
+            kept,
+            set((row['organization_id'], row['role_level'], row['count'])
+                for row in thresholds.suppress(counts, self.thresholds))
+        )
+        self.assertEqual(
+            list(thresholds.apply_threshold(counts, {})), []
+        )